@@ -1,16 +1,24 @@
 # Исправленная админ панель для VPN бота с поддержкой медиа в рассылке
 import logging
 import asyncio
+import html
 from aiogram import types, F
-from aiogram.filters import Command
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
-from config import ADMIN_IDS, DB_PATH
-import aiosqlite
+from aiogram.filters import Command, StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, BufferedInputFile
+from config import ADMIN_IDS
+from db import connect_db
+from locks import single_flight
+from broadcasts import broadcast_manager, format_job, job_controls
+from segments import count_segment, list_segment, segment_title
+from slow_queries import slow_query_log
+from profiler import run_profile, is_profiling, PROFILE_MODES
+from scheduler import job_scheduler, format_jobs
+from config import SLOW_QUERY_MS
 from datetime import datetime, timedelta
 from database import (
     get_user_stats, 
     get_payment_stats, 
-    get_users_by_status, 
     find_user_by_id,
     extend_user_subscription,
     delete_user,
@@ -26,154 +34,35 @@ from database import (
 
 # Список ID администраторов берётся из .env через config.ADMIN_IDS
 
-# Состояния для админ панели
-admin_states = {}
+# Состояния админ панели, в которых ждём ID пользователя (хранятся в db.state_storage через FSM)
+USER_ID_STATES = ("waiting_user_id", "waiting_user_id_for_subscription", "waiting_referrer_id", "waiting_referrer_detailed")
+
+# Предел длины текста сообщения Telegram (в единицах UTF-16)
+MESSAGE_LIMIT = 4096
+
+def _utf16_len(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+def join_within_limit(header: str, parts: list, separator: str = "\n\n", limit: int = MESSAGE_LIMIT) -> str:
+    """Склеивает HTML-фрагменты целиком, пока текст помещается в limit.
+
+    Обрезка посередине может разорвать тег или сущность, и Telegram отклонит сообщение
+    («can't parse entities»), поэтому не поместившиеся фрагменты отбрасываются целиком.
+    """
+    text = header
+    # Место под пометку об отброшенных фрагментах оставляем всегда
+    reserve = _utf16_len(f"{separator}… и ещё {len(parts)}")
+    for index, part in enumerate(parts):
+        candidate = f"{text}{separator}{part}"
+        if _utf16_len(candidate) + reserve > limit:
+            return f"{text}{separator}… и ещё {len(parts) - index}"
+        text = candidate
+    return text
 
 def is_admin(user_id: int) -> bool:
     """Проверяет, является ли пользователь администратором"""
     return user_id in ADMIN_IDS
 
-async def get_broadcast_users(broadcast_type: str):
-    """Получает список пользователей для рассылки по типу"""
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            if broadcast_type == "all":
-                # Все пользователи бота
-                cursor = await conn.execute("SELECT user_id FROM bot_users")
-                users = await cursor.fetchall()
-                return [user[0] for user in users]
-            
-            elif broadcast_type == "active":
-                # Только активные пользователи
-                cursor = await conn.execute(
-                    "SELECT user_id, expiry_date FROM users WHERE subscribed = 1"
-                )
-                all_users = await cursor.fetchall()
-                active_users = []
-                
-                for user_id, expiry_date in all_users:
-                    if expiry_date and is_subscription_active_check(expiry_date):
-                        active_users.append(user_id)
-                
-                return active_users
-            
-            elif broadcast_type == "inactive":
-                # Неактивные пользователи (истекшие подписки)
-                cursor = await conn.execute(
-                    "SELECT user_id, expiry_date FROM users WHERE subscribed = 1"
-                )
-                all_users = await cursor.fetchall()
-                inactive_users = []
-                
-                for user_id, expiry_date in all_users:
-                    if expiry_date and not is_subscription_active_check(expiry_date):
-                        inactive_users.append(user_id)
-                
-                return inactive_users
-            
-            elif broadcast_type == "expiring":
-                # Пользователи с истекающими подписками (в ближайшие 3 дня)
-                cursor = await conn.execute(
-                    "SELECT user_id, expiry_date FROM users WHERE subscribed = 1"
-                )
-                all_users = await cursor.fetchall()
-                expiring_users = []
-                
-                for user_id, expiry_date in all_users:
-                    if expiry_date:
-                        try:
-                            formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                            for fmt in formats:
-                                try:
-                                    exp_date = datetime.strptime(expiry_date, fmt)
-                                    days_left = (exp_date - datetime.now()).days
-                                    if 0 <= days_left <= 3:
-                                        expiring_users.append(user_id)
-                                    break
-                                except ValueError:
-                                    continue
-                        except:
-                            pass
-                
-                return expiring_users
-            
-            return []
-    
-    except Exception as e:
-        logging.error(f"Ошибка получения пользователей для рассылки: {e}")
-        return []
-
-async def send_broadcast_message(bot, message_text: str, broadcast_type: str, photo_file_id: str = None):
-    """Отправляет рассылку пользователям"""
-    try:
-        users = await get_broadcast_users(broadcast_type)
-        
-        if not users:
-            return {
-                'success': 0,
-                'failed': 0,
-                'blocked': 0,
-                'total': 0
-            }
-        
-        success = 0
-        failed = 0
-        blocked = 0
-        
-        for user_id in users:
-            try:
-                if photo_file_id and message_text:
-                    # Отправляем фото с подписью
-                    await bot.send_photo(
-                        chat_id=user_id,
-                        photo=photo_file_id,
-                        caption=message_text,
-                        parse_mode="HTML"
-                    )
-                elif photo_file_id:
-                    # Отправляем только фото
-                    await bot.send_photo(
-                        chat_id=user_id,
-                        photo=photo_file_id
-                    )
-                elif message_text:
-                    # Отправляем только текст
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=message_text,
-                        parse_mode="HTML"
-                    )
-                else:
-                    continue
-                
-                success += 1
-                
-                # Небольшая задержка между сообщениями
-                await asyncio.sleep(0.05)
-                
-            except Exception as e:
-                if "bot was blocked" in str(e).lower() or "user is deactivated" in str(e).lower():
-                    blocked += 1
-                else:
-                    failed += 1
-                    logging.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
-        
-        return {
-            'success': success,
-            'failed': failed,
-            'blocked': blocked,
-            'total': len(users)
-        }
-    
-    except Exception as e:
-        logging.error(f"Ошибка в send_broadcast_message: {e}")
-        return {
-            'success': 0,
-            'failed': 0,
-            'blocked': 0,
-            'total': 0
-        }
-
 def get_admin_main_keyboard():
     """Главная клавиатура админ панели"""
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -197,10 +86,11 @@ def get_admin_main_keyboard():
         ]
     ])
 
+@single_flight('admin_stats')
 async def get_admin_stats():
     """Получает базовую статистику для админ панели"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             # Всего пользователей бота (кто запускал /start)
             cursor = await conn.execute("SELECT COUNT(*) FROM bot_users")
             result = await cursor.fetchone()
@@ -254,7 +144,7 @@ async def get_admin_stats():
 async def get_detailed_stats():
     """Получает подробную статистику"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             # Всего пользователей бота
             cursor = await conn.execute("SELECT COUNT(*) FROM bot_users")
             result = await cursor.fetchone()
@@ -378,110 +268,6 @@ def is_subscription_active_check(expiry_date_str: str) -> bool:
         logging.error(f"Ошибка проверки даты {expiry_date_str}: {e}")
         return False
 
-async def send_broadcast_message(bot, message_text: str = None, target_type: str = "all", photo_url: str = None):
-    """Отправляет рассылку пользователям с поддержкой фото"""
-    try:
-        # Получаем список пользователей в зависимости от типа
-        if target_type == "all":
-            query = "SELECT user_id FROM bot_users"  # Всем пользователям бота
-        elif target_type == "active":
-            query = """SELECT user_id FROM users 
-                       WHERE subscribed = 1"""
-        elif target_type == "inactive":
-            query = """SELECT user_id FROM bot_users 
-                       WHERE user_id NOT IN (
-                           SELECT user_id FROM users WHERE subscribed = 1
-                       )"""
-        elif target_type == "expiring":
-            query = """SELECT user_id FROM users 
-                       WHERE subscribed = 1"""
-        else:
-            return {"success": 0, "failed": 0, "blocked": 0}
-        
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(query)
-            users = await cursor.fetchall()
-        
-        # Дополнительная фильтрация для активных и истекающих
-        if target_type == "active":
-            filtered_users = []
-            for (user_id,) in users:
-                # Проверяем активность подписки
-                cursor = await conn.execute(
-                    "SELECT expiry_date FROM users WHERE user_id = ?",
-                    (user_id,)
-                )
-                row = await cursor.fetchone()
-                if row and row[0] and is_subscription_active_check(row[0]):
-                    filtered_users.append((user_id,))
-            users = filtered_users
-        elif target_type == "expiring":
-            filtered_users = []
-            for (user_id,) in users:
-                cursor = await conn.execute(
-                    "SELECT expiry_date FROM users WHERE user_id = ?",
-                    (user_id,)
-                )
-                row = await cursor.fetchone()
-                if row and row[0]:
-                    try:
-                        formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                        for fmt in formats:
-                            try:
-                                exp_date = datetime.strptime(row[0], fmt)
-                                days_left = (exp_date - datetime.now()).days
-                                if 0 <= days_left <= 3:
-                                    filtered_users.append((user_id,))
-                                break
-                            except ValueError:
-                                continue
-                    except:
-                        pass
-            users = filtered_users
-        
-        success_count = 0
-        failed_count = 0
-        blocked_count = 0
-        
-        for (user_id,) in users:
-            try:
-                if photo_url:
-                    # Отправляем фото с подписью
-                    await bot.send_photo(
-                        chat_id=user_id,
-                        photo=photo_url,
-                        caption=message_text,
-                        parse_mode="HTML"
-                    )
-                else:
-                    # Отправляем только текст
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=message_text,
-                        parse_mode="HTML"
-                    )
-                success_count += 1
-                
-                # Небольшая задержка чтобы не превысить лимиты API
-                await asyncio.sleep(0.05)
-                
-            except Exception as e:
-                if "blocked" in str(e).lower() or "forbidden" in str(e).lower():
-                    blocked_count += 1
-                else:
-                    failed_count += 1
-                logging.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
-        
-        return {
-            "success": success_count,
-            "failed": failed_count,
-            "blocked": blocked_count,
-            "total": len(users)
-        }
-    except Exception as e:
-        logging.error(f"Ошибка рассылки: {e}")
-        return {"success": 0, "failed": 0, "blocked": 0}
-
 def register_admin_handlers(dp):
     """Регистрирует обработчики админ панели"""
     
@@ -509,6 +295,45 @@ def register_admin_handlers(dp):
             text=admin_text,
             reply_markup=get_admin_main_keyboard()
         )
+
+    @dp.message(Command("profile"))
+    async def profile_command(message: Message):
+        """/profile [секунды] [sample|cpu] [mem] — профиль работающего бота документом"""
+        if not is_admin(message.from_user.id):
+            return
+
+        seconds, mode, memory = 30, 'sample', False
+        for arg in (message.text or '').split()[1:]:
+            if arg.isdigit():
+                seconds = int(arg)
+            elif arg in PROFILE_MODES:
+                mode = arg
+            elif arg == 'mem':
+                memory = True
+            else:
+                await message.answer(
+                    "Использование: <code>/profile [секунды] [sample|cpu] [mem]</code>\n"
+                    "sample — семплирование стека (по умолчанию), cpu — cProfile, mem — снимки tracemalloc"
+                )
+                return
+
+        if is_profiling():
+            await message.answer("⏳ Профилирование уже идёт, дождитесь отчёта")
+            return
+
+        await message.answer(f"⏱ Профилирую {seconds} с (режим {mode}{', память' if memory else ''})...")
+        try:
+            report = await run_profile(seconds, mode, memory)
+        except Exception as e:
+            logging.error(f"Ошибка профилирования: {e}")
+            await message.answer(f"❌ Ошибка профилирования: {e}")
+            return
+
+        filename = f"profile_{mode}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        await message.answer_document(
+            BufferedInputFile(report.encode('utf-8'), filename=filename),
+            caption=f"📈 Профиль за {seconds} с"
+        )
     
     @dp.callback_query(F.data == "admin_stats")
     async def admin_stats_callback(callback: types.CallbackQuery):
@@ -585,13 +410,13 @@ def register_admin_handlers(dp):
         )
     
     @dp.callback_query(F.data == "admin_find_user")
-    async def admin_find_user_callback(callback: types.CallbackQuery):
+    async def admin_find_user_callback(callback: types.CallbackQuery, state: FSMContext):
         """Поиск пользователя"""
         if not is_admin(callback.from_user.id):
             await callback.answer("❌ Нет доступа", show_alert=True)
             return
         
-        admin_states[callback.from_user.id] = "waiting_user_id"
+        await state.set_state("waiting_user_id")
         
         await callback.message.edit_text(
             text="<b>🔍 Поиск пользователя</b>\n\nОтправьте ID пользователя для поиска:",
@@ -600,14 +425,11 @@ def register_admin_handlers(dp):
             ])
         )
     
-    # ИСПРАВЛЕННЫЙ обработчик - только для админов и только в состоянии поиска
-    @dp.message(F.text.regexp(r'^\d+$') & F.from_user.id.in_(ADMIN_IDS))
-    async def handle_user_id_input(message: Message):
+    # Только для админов и только в состоянии ожидания ID — остальные сообщения идут обычным хендлерам бота
+    @dp.message(StateFilter(*USER_ID_STATES), F.text.regexp(r'^\d+$') & F.from_user.id.in_(ADMIN_IDS))
+    async def handle_user_id_input(message: Message, state: FSMContext):
         """Обработка ввода ID пользователя - ТОЛЬКО для админов"""
-        state_value = admin_states.get(message.from_user.id)
-        if state_value not in ("waiting_user_id", "waiting_user_id_for_subscription", "waiting_referrer_id", "waiting_referrer_detailed"):
-            # Не в нужном состоянии — просто выходим, чтобы отработали обычные хендлеры бота
-            return
+        state_value = await state.get_state()
         if state_value == "waiting_user_id":
             user_id = int(message.text)
             user_data = await find_user_by_id(user_id)
@@ -674,7 +496,7 @@ def register_admin_handlers(dp):
                         ])
                 else:
                     # Пользователь без подписки - проверяем, есть ли он в bot_users
-                    async with aiosqlite.connect(DB_PATH) as conn:
+                    async with connect_db() as conn:
                         cursor = await conn.execute(
                             "SELECT user_id, first_name FROM bot_users WHERE user_id = ?",
                             (user_id,)
@@ -705,7 +527,7 @@ def register_admin_handlers(dp):
                         ])
                         
                         await message.answer(user_info, reply_markup=keyboard)
-                        admin_states.pop(message.from_user.id, None)
+                        await state.clear()
                         return
                 
                 await message.answer(user_info, reply_markup=keyboard)
@@ -718,12 +540,12 @@ def register_admin_handlers(dp):
                 )
             
             # Сбрасываем состояние
-            admin_states.pop(message.from_user.id, None)
+            await state.clear()
         elif state_value == "waiting_user_id_for_subscription":
             user_id = int(message.text)
             
             # Проверяем, есть ли пользователь в bot_users
-            async with aiosqlite.connect(DB_PATH) as conn:
+            async with connect_db() as conn:
                 cursor = await conn.execute(
                     "SELECT user_id, first_name FROM bot_users WHERE user_id = ?",
                     (user_id,)
@@ -773,7 +595,7 @@ def register_admin_handlers(dp):
                 )
             
             # Сбрасываем состояние
-            admin_states.pop(message.from_user.id, None)
+            await state.clear()
             return
         elif state_value == "waiting_referrer_detailed":
             try:
@@ -784,7 +606,7 @@ def register_admin_handlers(dp):
                 referrals = await get_referral_details(referrer_id)
                 
                 # Получаем информацию о пользователе
-                async with aiosqlite.connect(DB_PATH) as conn:
+                async with connect_db() as conn:
                     cursor = await conn.execute(
                         "SELECT username, first_name, referral_balance FROM bot_users WHERE user_id = ?",
                         (referrer_id,)
@@ -846,7 +668,7 @@ def register_admin_handlers(dp):
                 )
             
             # Сбрасываем состояние
-            admin_states.pop(message.from_user.id, None)
+            await state.clear()
             return
         elif state_value == "waiting_referrer_id":
             try:
@@ -898,7 +720,7 @@ def register_admin_handlers(dp):
                 )
             
             # Сбрасываем состояние
-            admin_states.pop(message.from_user.id, None)
+            await state.clear()
             return
     
     @dp.callback_query(F.data.startswith("extend_user_"))
@@ -1037,7 +859,7 @@ def register_admin_handlers(dp):
             return
         
         try:
-            active_users = await get_users_by_status("active", 15)
+            active_users = await list_segment("active", 15)
             
             if not active_users:
                 text = "<b>👥 Активные пользователи</b>\n\nНет активных пользователей"
@@ -1064,7 +886,7 @@ def register_admin_handlers(dp):
             return
         
         try:
-            expiring_users = await get_users_by_status("expiring", 15)
+            expiring_users = await list_segment("expiring", 15)
             
             if not expiring_users:
                 text = "<b>⏰ Истекающие подписки</b>\n\nНет истекающих подписок в ближайшие 3 дня"
@@ -1091,7 +913,7 @@ def register_admin_handlers(dp):
             return
         
         try:
-            expired_users = await get_users_by_status("expired", 15)
+            expired_users = await list_segment("expired", 15)
             
             if not expired_users:
                 text = "<b>❌ Истекшие подписки</b>\n\nНет истекших подписок"
@@ -1112,13 +934,13 @@ def register_admin_handlers(dp):
     
     
     @dp.callback_query(F.data == "admin_give_subscription")
-    async def admin_give_subscription_callback(callback: types.CallbackQuery):
+    async def admin_give_subscription_callback(callback: types.CallbackQuery, state: FSMContext):
         """Выдача подписки пользователю"""
         if not is_admin(callback.from_user.id):
             await callback.answer("❌ Нет доступа", show_alert=True)
             return
         
-        admin_states[callback.from_user.id] = "waiting_user_id_for_subscription"
+        await state.set_state("waiting_user_id_for_subscription")
         
         await callback.message.edit_text(
             text="<b>🎁 Выдача подписки</b>\n\nОтправьте ID пользователя, которому хотите выдать подписку:",
@@ -1135,7 +957,7 @@ def register_admin_handlers(dp):
             return
         
         try:
-            async with aiosqlite.connect(DB_PATH) as conn:
+            async with connect_db() as conn:
                 cursor = await conn.execute(
                     """SELECT bu.user_id, bu.first_name, bu.first_interaction,
                           CASE WHEN u.user_id IS NOT NULL THEN 1 ELSE 0 END as has_subscription
@@ -1216,6 +1038,10 @@ def register_admin_handlers(dp):
                 InlineKeyboardButton(text="🗑 Очистить БД", callback_data="admin_clear_db"),
                 InlineKeyboardButton(text="📊 Пересчет статистики", callback_data="admin_recalc_stats")
             ],
+            [
+                InlineKeyboardButton(text="🐢 Медленные запросы", callback_data="admin_slow_queries"),
+                InlineKeyboardButton(text="⏱ Фоновые задачи", callback_data="admin_jobs")
+            ],
             [
                 InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back_main")
             ]
@@ -1226,6 +1052,80 @@ def register_admin_handlers(dp):
             reply_markup=manage_keyboard
         )
 
+    @dp.callback_query(F.data.in_({"admin_slow_queries", "admin_slow_queries_reset"}))
+    async def admin_slow_queries_callback(callback: types.CallbackQuery):
+        """Топ медленных SQL-запросов с планами выполнения"""
+        if not is_admin(callback.from_user.id):
+            await callback.answer("❌ Нет доступа", show_alert=True)
+            return
+
+        if callback.data == "admin_slow_queries_reset":
+            slow_query_log.reset()
+
+        statements = slow_query_log.top(limit=5)
+        if not SLOW_QUERY_MS:
+            text = "<b>🐢 Медленные запросы</b>\n\nЖурнал выключен (SLOW_QUERY_MS=0)."
+        elif not statements:
+            text = f"<b>🐢 Медленные запросы</b>\n\nЗапросов дольше {SLOW_QUERY_MS} мс не было."
+        else:
+            text = f"<b>🐢 Медленные запросы</b> (порог {SLOW_QUERY_MS} мс, по суммарному времени)\n"
+            for i, statement in enumerate(statements, 1):
+                block = (
+                    f"\n<b>{i}.</b> {statement.count} раз, всего <code>{statement.total * 1000:.0f}</code> мс, "
+                    f"сред. <code>{statement.average * 1000:.0f}</code> мс, макс. <code>{statement.max * 1000:.0f}</code> мс\n"
+                    f"<code>{html.escape(statement.sql[:300])}</code>\n"
+                    f"Параметры: <code>{html.escape(statement.parameters[:100])}</code>\n"
+                )
+                if statement.plan:
+                    block += f"<pre>{html.escape(statement.plan[:400])}</pre>\n"
+                if len(text) + len(block) > 4000:
+                    break
+                text += block
+
+        await callback.message.edit_text(
+            text=text,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [
+                    InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_slow_queries"),
+                    InlineKeyboardButton(text="🧹 Сбросить", callback_data="admin_slow_queries_reset")
+                ],
+                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_manage")]
+            ])
+        )
+        await callback.answer()
+
+    @dp.callback_query((F.data == "admin_jobs") | F.data.startswith("admin_job_run_"))
+    async def admin_jobs_callback(callback: types.CallbackQuery):
+        """Фоновые задачи: расписание, последние запуски, ручной запуск"""
+        if not is_admin(callback.from_user.id):
+            await callback.answer("❌ Нет доступа", show_alert=True)
+            return
+
+        if callback.data.startswith("admin_job_run_"):
+            job = job_scheduler.jobs.get(callback.data[len("admin_job_run_"):])
+            if not job or not job_scheduler.started:
+                await callback.answer("Задачи выполняет ведущий процесс", show_alert=True)
+                return
+            await callback.answer(f"Запускаю {job.name}...")
+            await job_scheduler.run_once(job)
+
+        # Каждая строка format_jobs закрывает свои теги — режем только по строкам
+        text = join_within_limit("<b>⏱ Фоновые задачи</b>\n", format_jobs(job_scheduler).split("\n"), "\n")
+        run_buttons = [
+            InlineKeyboardButton(text=f"▶️ {name}", callback_data=f"admin_job_run_{name}")
+            for name in job_scheduler.jobs
+        ]
+        await callback.message.edit_text(
+            text=text,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                *[run_buttons[i:i + 2] for i in range(0, len(run_buttons), 2)],
+                [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_jobs")],
+                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_manage")]
+            ])
+        )
+        if callback.data == "admin_jobs":
+            await callback.answer()
+
     @dp.callback_query(F.data == "admin_clear_db")
     async def admin_clear_db_callback(callback: types.CallbackQuery):
         """Очистка базы данных"""
@@ -1264,7 +1164,7 @@ def register_admin_handlers(dp):
             return
     
         try:
-            async with aiosqlite.connect(DB_PATH) as conn:
+            async with connect_db() as conn:
                 await conn.execute("DELETE FROM users")
                 await conn.execute("DELETE FROM bot_users")
                 await conn.execute("DELETE FROM payments")
@@ -1371,6 +1271,16 @@ def register_admin_handlers(dp):
                 InlineKeyboardButton(text="⏰ Истекающим подпискам", callback_data="broadcast_expiring"),
                 InlineKeyboardButton(text="❌ Неактивным", callback_data="broadcast_inactive")
             ],
+            [
+                InlineKeyboardButton(text="🆓 Только пробный период", callback_data="broadcast_trial-only"),
+                InlineKeyboardButton(text="💤 Ни разу не оплачивали", callback_data="broadcast_never-paid")
+            ],
+            [
+                InlineKeyboardButton(text="👥 Рефереры", callback_data="broadcast_referrers")
+            ],
+            [
+                InlineKeyboardButton(text="📋 История рассылок", callback_data="admin_broadcast_history")
+            ],
             [
                 InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back_main")
             ]
@@ -1388,34 +1298,86 @@ def register_admin_handlers(dp):
         )
 
     @dp.callback_query(F.data.startswith("broadcast_"))
-    async def broadcast_callback(callback: types.CallbackQuery):
+    async def broadcast_callback(callback: types.CallbackQuery, state: FSMContext):
         """Обработчик выбора типа рассылки"""
         if not is_admin(callback.from_user.id):
             await callback.answer("❌ Нет доступа", show_alert=True)
             return
         
-        broadcast_type = callback.data.split("_")[1]
+        broadcast_type = callback.data.split("_", 1)[1]
         
-        type_names = {
-            "all": "всем пользователям",
-            "active": "активным пользователям",
-            "inactive": "неактивным пользователям",
-            "expiring": "пользователям с истекающими подписками"
-        }
+        try:
+            recipients = await count_segment(broadcast_type)
+        except ValueError:
+            await callback.answer("Неизвестная аудитория", show_alert=True)
+            return
         
-        admin_states[callback.from_user.id] = f"waiting_broadcast_{broadcast_type}"
+        await state.set_state("waiting_broadcast")
+        await state.set_data({'segment': broadcast_type})
         
         await callback.message.edit_text(
-            text=f"""<b>📢 Рассылка {type_names.get(broadcast_type, 'выбранной группе')}</b>
+            text=f"""<b>📢 Рассылка: {segment_title(broadcast_type)}</b>
+
+<b>Получателей:</b> <code>{recipients}</code>
 
 Отправьте сообщение или фото с подписью, которое хотите разослать.
 
-<blockquote><i>⚠️ Будьте осторожны! Отменить рассылку будет невозможно.</i></blockquote>""",
+<blockquote><i>⚠️ Рассылка пойдёт в фоне: прогресс будет обновляться в отдельном сообщении, там же её можно приостановить или отменить.</i></blockquote>""",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_broadcast")]
             ])
         )
 
+    @dp.callback_query(F.data == "admin_broadcast_history")
+    async def admin_broadcast_history_callback(callback: types.CallbackQuery):
+        """История рассылок с итоговой статистикой"""
+        if not is_admin(callback.from_user.id):
+            await callback.answer("❌ Нет доступа", show_alert=True)
+            return
+        
+        jobs = await broadcast_manager.recent_jobs()
+        if jobs:
+            history_text = join_within_limit("<b>📋 Последние рассылки</b>", [format_job(job) for job in jobs])
+        else:
+            history_text = "<b>📋 Последние рассылки</b>\n\nРассылок ещё не было"
+        
+        await callback.message.edit_text(
+            text=history_text,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_broadcast")]
+            ])
+        )
+
+    @dp.callback_query(F.data.startswith("bcjob_"))
+    async def broadcast_job_control_callback(callback: types.CallbackQuery):
+        """Пауза / продолжение / отмена фоновой рассылки"""
+        if not is_admin(callback.from_user.id):
+            await callback.answer("❌ Нет доступа", show_alert=True)
+            return
+        
+        _, action, job_id = callback.data.split("_")
+        job_id = int(job_id)
+        actions = {
+            "pause": (broadcast_manager.pause, "⏸ Рассылка будет приостановлена после текущей пачки"),
+            "resume": (broadcast_manager.resume, "▶️ Рассылка продолжена"),
+            "cancel": (broadcast_manager.cancel, "⛔ Рассылка отменена"),
+        }
+        if action not in actions:
+            await callback.answer()
+            return
+        
+        handler, done_text = actions[action]
+        if not await handler(job_id):
+            await callback.answer("Действие недоступно для текущего статуса рассылки", show_alert=True)
+            return
+        
+        job = await broadcast_manager.get_job(job_id)
+        try:
+            await callback.message.edit_text(text=format_job(job), reply_markup=job_controls(job))
+        except Exception:
+            pass
+        await callback.answer(done_text)
+
     @dp.callback_query(F.data == "admin_referrals")
     async def admin_referrals_callback(callback: types.CallbackQuery):
         """Обработчик рефералов"""
@@ -1465,13 +1427,13 @@ def register_admin_handlers(dp):
             await callback.answer("Ошибка получения данных", show_alert=True)
 
     @dp.callback_query(F.data == "admin_find_referrer")
-    async def admin_find_referrer_callback(callback: types.CallbackQuery):
+    async def admin_find_referrer_callback(callback: types.CallbackQuery, state: FSMContext):
         """Поиск реферера"""
         if not is_admin(callback.from_user.id):
             await callback.answer("❌ Нет доступа", show_alert=True)
             return
         
-        admin_states[callback.from_user.id] = "waiting_referrer_id"
+        await state.set_state("waiting_referrer_id")
         
         await callback.message.edit_text(
             text="<b>🔍 Поиск реферера</b>\n\nОтправьте ID пользователя для просмотра его рефералов:",
@@ -1525,19 +1487,13 @@ def register_admin_handlers(dp):
             await callback.answer("Ошибка получения данных", show_alert=True)
 
     # Обработчик сообщений для рассылки
-    @dp.message((F.text | F.photo) & F.from_user.id.in_(ADMIN_IDS))
-    async def handle_broadcast_message(message: Message):
+    @dp.message(StateFilter("waiting_broadcast"), (F.text | F.photo) & F.from_user.id.in_(ADMIN_IDS))
+    async def handle_broadcast_message(message: Message, state: FSMContext):
         """Обработка сообщения для рассылки - ТОЛЬКО для админов"""
-        state = admin_states.get(message.from_user.id, "")
-        if not state.startswith("waiting_broadcast_"):
-            # Не в режиме ожидания текста для рассылки — выходим
-            return
-        
-        if state.startswith("waiting_broadcast_"):
-            broadcast_type = state.split("_")[2]
-            
-            # Отправляем уведомление о начале рассылки
-            await message.answer("📤 Начинаю рассылку...")
+        broadcast_type = (await state.get_data()).get('segment')
+        if broadcast_type:
+            # Сообщение с прогрессом, которое задание будет обновлять
+            progress_message = await message.answer("📤 Подготавливаю рассылку...")
             
             # Определяем тип сообщения
             message_text = None
@@ -1551,24 +1507,17 @@ def register_admin_handlers(dp):
                 # Если только текст
                 message_text = message.text
             
-            # Выполняем рассылку
-            from bot import bot  # Импортируем бота
-            result = await send_broadcast_message(bot, message_text, broadcast_type, photo_file_id)
-            
-            # Отправляем результат
-            result_text = f"""
-<b>📊 Результат рассылки</b>
-
-<b>Успешно отправлено:</b> <code>{result['success']}</code>
-<b>Ошибки отправки:</b> <code>{result['failed']}</code>
-<b>Заблокировали бота:</b> <code>{result['blocked']}</code>
-<b>Всего пользователей:</b> <code>{result.get('total', 0)}</code>
-"""
-            
-            await message.answer(result_text)
+            # Фиксируем аудиторию сегмента; отправку подхватит ведущий процесс
+            await broadcast_manager.create(
+                admin_id=message.chat.id,
+                progress_message_id=progress_message.message_id,
+                segment=broadcast_type,
+                text=message_text,
+                photo_file_id=photo_file_id
+            )
             
             # Сбрасываем состояние
-            admin_states.pop(message.from_user.id, None)
+            await state.clear()
 
     @dp.callback_query(F.data == "admin_referral_analytics")
     async def admin_referral_analytics_callback(callback: types.CallbackQuery):
@@ -1582,7 +1531,7 @@ def register_admin_handlers(dp):
             stats = await get_all_referral_stats()
             
             # Получаем топ рефереров с детальной информацией
-            async with aiosqlite.connect(DB_PATH) as conn:
+            async with connect_db() as conn:
                 cursor = await conn.execute(
                     """SELECT 
                         r.referrer_id,
@@ -1646,13 +1595,13 @@ def register_admin_handlers(dp):
             await callback.answer("Ошибка получения данных", show_alert=True)
 
     @dp.callback_query(F.data == "admin_find_referrer_detailed")
-    async def admin_find_referrer_detailed_callback(callback: types.CallbackQuery):
+    async def admin_find_referrer_detailed_callback(callback: types.CallbackQuery, state: FSMContext):
         """Поиск реферера с детальной информацией"""
         if not is_admin(callback.from_user.id):
             await callback.answer("❌ Нет доступа", show_alert=True)
             return
         
-        admin_states[callback.from_user.id] = "waiting_referrer_detailed"
+        await state.set_state("waiting_referrer_detailed")
         
         await callback.message.edit_text(
             text="<b>🔍 Детальная информация о реферере</b>\n\nОтправьте ID пользователя для просмотра детальной статистики:",
@@ -1669,7 +1618,7 @@ def register_admin_handlers(dp):
             return
         
         try:
-            async with aiosqlite.connect(DB_PATH) as conn:
+            async with connect_db() as conn:
                 # Рефералы за последние 7 дней
                 cursor = await conn.execute(
                     """SELECT 
@@ -1708,7 +1657,7 @@ def register_admin_handlers(dp):
             return
         
         try:
-            async with aiosqlite.connect(DB_PATH) as conn:
+            async with connect_db() as conn:
                 cursor = await conn.execute(
                     """SELECT 
                         user_id,
@@ -1752,7 +1701,7 @@ def register_admin_handlers(dp):
             return
         
         try:
-            async with aiosqlite.connect(DB_PATH) as conn:
+            async with connect_db() as conn:
                 # Статистика по часам за последние 24 часа
                 cursor = await conn.execute(
                     """SELECT 
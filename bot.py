@@ -1,38 +1,55 @@
 import logging
 import asyncio
 import aiohttp
-import aiosqlite
 from urllib.parse import quote
 from aiogram import types, F, Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ChatMemberStatus
+from aiogram.exceptions import TelegramForbiddenError
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message, LabeledPrice
 from datetime import datetime
 
-from config import TOKEN, WELCOME_GIF_URL, STARS_PROVIDER_TOKEN, ADMIN_IDS, PRICES, CHANNEL_ID, DB_PATH
+from config import (
+    TOKEN, WELCOME_GIF_URL, STARS_PROVIDER_TOKEN, ADMIN_IDS, PRICES, CHANNEL_ID, METRICS_HOST, METRICS_PORT,
+    BOT_MODE, BOT_WORKER, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_WORKERS, WEBHOOK_MAX_CONCURRENCY
+)
+from db import connect_db, state_storage
 from database import (
-    init_db, check_user_payment, add_payment, get_user_data, add_bot_user,
-    get_users_expiring_in_days, get_all_users_expiring_in_days, 
-    mark_user_notified, has_paid_subscription, has_used_trial, grant_trial_14d,
-    attach_referrer_chain, get_referral_overview, calculate_amount_for_period, accrue_referral_commissions,
-    check_referral_data
+    init_db, optimize_db, check_user_payment, add_payment, get_user_data, get_user_snapshot, UserSnapshot, add_bot_user,
+    mark_user_notified, flush_notification_flags, notification_flags, mark_bot_blocked, clear_bot_blocked, grant_trial_14d,
+    attach_referrer_chain, get_referral_overview, calculate_amount_for_period, accrue_referral_commissions
+)
+from payment import (
+    create_payment, check_payment_status, cancel_all_payment_tasks, active_payment_tasks, resume_payment_checks,
+    payment_checks, fetch_payment
 )
-from payment import create_payment, check_payment_status, cancel_all_payment_tasks
-from yookassa import Payment
+from events import event_bus, PaymentSucceeded, event_stats
+from expiry_scheduler import expiry_scheduler, REFILL_INTERVAL, RELOAD_INTERVAL
+from delivery import delivery, delivery_stats, LANE_NOTIFICATION, LANES
+from broadcasts import broadcast_manager, POLL_INTERVAL as BROADCAST_POLL_INTERVAL
+from instrumentation import setup_instrumentation, http_trace_config
+from metrics import registry, metrics_server
+from loop_watchdog import loop_watchdog
+from leader import leader
+from throttling import setup_throttling
+from callback_ack import setup_early_ack, drain_callback_tasks
+from locks import single_flight
+from scheduler import job_scheduler
+from logging_setup import setup_logging
+from webhook import WebhookHandler, serve_webhook, run_workers, cleanup_webhook_updates
 from keyboards import (
     create_main_keyboard, get_subscription_keyboard, get_profile_keyboard, get_user_keyboard
 )
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("bot.log"), logging.StreamHandler()]
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
 from admin_panel import register_admin_handlers
-dp = Dispatcher()
+# Состояния FSM хранятся в SQLite: общие для webhook-процессов и не теряются при перезапуске
+dp = Dispatcher(storage=state_storage)
 register_admin_handlers(dp)
 
 def get_price_for_period(period: str) -> int:
@@ -85,7 +102,7 @@ async def cmd_start(message: Message, command: Command = None):
                 logger.info(f"Обработка реферальной ссылки: {user.id} -> {referrer_id}")
                 if referrer_id > 0 and referrer_id != user.id:
                     # Проверяем, что пользователь еще не был в боте
-                    async with aiosqlite.connect(DB_PATH) as conn:
+                    async with connect_db() as conn:
                         cursor = await conn.execute(
                             "SELECT first_interaction FROM bot_users WHERE user_id = ?",
                             (user.id,)
@@ -106,18 +123,23 @@ async def cmd_start(message: Message, command: Command = None):
             logger.info(f"Payload '{payload}' не является числом")
         if payload and payload.lower() == "trial14":
             # выдаём триал только если не использован ранее и нет платёжной подписки
-            if not await has_paid_subscription(user.id) and not await has_used_trial(user.id):
-                granted = await grant_trial_14d(user.id)
-                if granted:
-                    await message.answer(
-                        """
+            # (проверка и отметка выполняются атомарно внутри grant_trial_14d)
+            granted = await grant_trial_14d(
+                user.id,
+                username=user.username,
+                first_name=user.first_name,
+                last_name=user.last_name
+            )
+            if granted:
+                await message.answer(
+                    """
 <b>🎁 Включили бесплатный доступ на 14 дней!</b>
 
 Нажмите «Активировать VPN», чтобы получить ключ и подключиться.
-                        """,
-                        reply_markup=create_main_keyboard()
-                    )
-                    return
+                    """,
+                    reply_markup=create_main_keyboard()
+                )
+                return
             # Уже пользовался или есть платная подписка
             await message.answer(
                 """
@@ -160,40 +182,41 @@ async def cmd_start(message: Message, command: Command = None):
 
 
 
-async def get_vpn_info(user_id: int):
-    """Получает информацию о VPN для пользователя"""
-    user_data = await get_user_data(user_id)
-    has_paid = await check_user_payment(user_id)
-    
-    if not user_data:
-        return None, None, None
-    
-    expiry_date, config = user_data
-    is_active = has_paid
-
-    # Получаем sub_key от сервера
+@single_flight('panel_sub_key')
+async def get_sub_key(user_id: int):
+    """Получает sub_key пользователя от сервера; None — не удалось"""
     timeout = aiohttp.ClientTimeout(total=10)
     headers = {"X-API-Key": "18181818", "Accept": "application/json"}
     
     try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with aiohttp.ClientSession(timeout=timeout, trace_configs=[http_trace_config('panel')]) as session:
             async with session.get(f"https://shardtg.ru/sub/{user_id}", headers=headers) as resp:
                 if resp.status != 200:
-                    return None, None, None
+                    return None
                 data = await resp.json()
     except Exception:
+        return None
+
+    return data.get("sub_key") or None
+
+async def get_vpn_info(user_id: int, snapshot: UserSnapshot = None):
+    """Получает информацию о VPN для пользователя"""
+    if snapshot is None:
+        snapshot = await get_user_snapshot(user_id)
+    
+    if not snapshot.has_subscription:
         return None, None, None
 
-    sub_key = data.get("sub_key")
+    sub_key = await get_sub_key(user_id)
     if not sub_key:
         return None, None, None
 
     miniapp_link = f"https://shardtg.ru/subscription/{sub_key}"
-    return miniapp_link, expiry_date, is_active
+    return miniapp_link, snapshot.expiry_date, snapshot.is_active
 
-async def send_vpn_message(message_or_callback, user_id: int, is_edit: bool = False):
+async def send_vpn_message(message_or_callback, user_id: int, is_edit: bool = False, snapshot: UserSnapshot = None):
     """Отправляет или редактирует сообщение с информацией о VPN"""
-    vpn_info = await get_vpn_info(user_id)
+    vpn_info = await get_vpn_info(user_id, snapshot)
     
     if vpn_info[0] is None:
         if is_edit:
@@ -235,25 +258,21 @@ async def send_vpn_message(message_or_callback, user_id: int, is_edit: bool = Fa
             parse_mode="HTML", disable_web_page_preview=True
         )
 
-@dp.message(F.text == "🌐Активировать VPN")
+@dp.message(F.text == "🌐Активировать VPN", flags={'throttle': 'vpn'})
 async def connect_vpn(message: Message):
     user_id = message.from_user.id
-    user_data = await get_user_data(user_id)
+    snapshot = await get_user_snapshot(user_id)
     
-    if not user_data:
-        return await show_subscription_options(message)
+    if not snapshot.has_subscription:
+        return await show_subscription_options(message, snapshot)
     
-    await send_vpn_message(message, user_id)
+    await send_vpn_message(message, user_id, snapshot=snapshot)
                                                 
-async def show_subscription_options(message: Message):
-    """Показывает варианты подписки"""
-    user_id = message.from_user.id
-    
-    # Проверяем, была ли у пользователя платная подписка
-    has_paid = await has_paid_subscription(user_id)
-    
-    # Проверяем, есть ли данные о подписке (для истекших подписок)
-    user_data = await get_user_data(user_id)
+def subscription_options_text(snapshot: UserSnapshot):
+    """Текст и клавиатура выбора подписки"""
+    # Платная подписка когда-либо и данные о подписке (для истекших подписок)
+    has_paid = snapshot.has_paid
+    user_data = snapshot.has_subscription
     
     # Показываем специальную подписку только для новых пользователей (без платежей и без данных)
     show_special = not has_paid and not user_data
@@ -270,13 +289,16 @@ async def show_subscription_options(message: Message):
 
 <blockquote><i>🔐 Быстрый, стабильный и защищённый VPN.</i></blockquote>
 """
-    
-    await message.answer(
-        text=text,
-        reply_markup=get_subscription_keyboard(show_special),
-    )
+    return text, get_subscription_keyboard(show_special)
 
-@dp.callback_query(F.data.startswith('sub_'))
+async def show_subscription_options(message: Message, snapshot: UserSnapshot = None):
+    """Показывает варианты подписки"""
+    if snapshot is None:
+        snapshot = await get_user_snapshot(message.chat.id)
+    text, reply_markup = subscription_options_text(snapshot)
+    await message.answer(text=text, reply_markup=reply_markup)
+
+@dp.callback_query(F.data.startswith('sub_'), flags={'throttle': 'payment'})
 async def subscription_callback(callback: types.CallbackQuery):
     """Обработчик выбора подписки"""
     try:
@@ -335,49 +357,16 @@ async def subscription_callback(callback: types.CallbackQuery):
         logger.error(f"Ошибка в обработчике подписки: {e}")
         await callback.answer("Произошла ошибка. Попробуйте позже.", show_alert=True)
 
-@dp.callback_query(F.data == 'back')
+@dp.callback_query(F.data == 'back', flags={'early_ack': True})
 async def back_to_subscriptions(callback: types.CallbackQuery):
     """Возврат к выбору подписки"""
     try:
-        user_id = callback.from_user.id
-        
-        # Проверяем, была ли у пользователя платная подписка
-        has_paid = await has_paid_subscription(user_id)
-        
-        # Проверяем, есть ли данные о подписке (для истекших подписок)
-        user_data = await get_user_data(user_id)
-        
-        # Показываем специальную подписку только для новых пользователей (без платежей и без данных)
-        show_special = not has_paid and not user_data
-        
-        if user_data and not has_paid:
-            # Истекшая подписка
-            text = """<b>👨🏻‍💻Ваша подписка истекла — продлите её:</b>
-
-<blockquote><i>🔐 Быстрый, стабильный и защищённый VPN.</i></blockquote>
-"""
-        else:
-            # Новая подписка
-            text = """<b>👨🏻‍💻Чтобы подключиться — выбери подписку:</b>
-
-<blockquote><i>🔐 Быстрый, стабильный и защищённый VPN.</i></blockquote>
-"""
-        
-        await callback.message.edit_text(
-            text=text,
-            reply_markup=get_subscription_keyboard(show_special)
-        )
-        # Ответ на коллбек может быть просрочен — игнорируем ошибку таймаута
-        try:
-            await callback.answer()
-        except Exception:
-            pass
+        snapshot = await get_user_snapshot(callback.from_user.id)
+        text, reply_markup = subscription_options_text(snapshot)
+        await callback.message.edit_text(text=text, reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"Ошибка при возврате к подпискам: {e}")
-        try:
-            await callback.answer("Произошла ошибка. Попробуйте позже.", show_alert=True)
-        except Exception:
-            pass
+        await callback.answer("Произошла ошибка. Попробуйте позже.", show_alert=True)
         
 @dp.callback_query(F.data.startswith('check_pay:'))
 async def check_payment_callback(callback: types.CallbackQuery):
@@ -385,7 +374,7 @@ async def check_payment_callback(callback: types.CallbackQuery):
     payment_id = callback.data.split(':')[1]
     
     try:
-        payment = await Payment.find_one(payment_id)
+        payment = await fetch_payment(payment_id)
         
         if payment.status == "succeeded":
             await callback.answer("Оплата уже подтверждена!", show_alert=True)
@@ -408,17 +397,16 @@ async def check_payment_callback(callback: types.CallbackQuery):
 
 async def get_profile_info(user_id: int):
     """Получает информацию профиля пользователя"""
-    has_paid = await check_user_payment(user_id)
-    user_data = await get_user_data(user_id)
+    snapshot = await get_user_snapshot(user_id)
     
-    if has_paid and user_data:
-        expiry_date, _ = user_data
+    if snapshot.is_active and snapshot.has_subscription:
+        expiry_date = snapshot.expiry_date
         text = f"""<b>👾 Ваш профиль</b>
 
 📌Статус подписки - <b>Активна 🟢</b>
 ⏳Действует до - <b>{expiry_date}</b>"""
         return text, get_profile_keyboard(True)
-    elif user_data:
+    elif snapshot.has_subscription:
         text = f"""<b>👾 Ваш профиль</b>
 
 Статус подписки - <b>не Активна 🔴</b>
@@ -448,20 +436,13 @@ async def subscribe_from_profile(callback: types.CallbackQuery):
     await show_subscription_options(callback.message)
     await callback.answer()
 
-@dp.callback_query(F.data == 'referrals')
+@dp.callback_query(F.data == 'referrals', flags={'throttle': 'referrals', 'early_ack': True})
 async def referrals_callback(callback: types.CallbackQuery):
     """Обработчик кнопки партнерской программы"""
     try:
         user_id = callback.from_user.id
         overview = await get_referral_overview(user_id)
-        
-        # Отладочная информация
-        logger.info(f"Реферальная статистика для {user_id}: {overview}")
-        
-        # Дополнительная отладка
-        debug_data = await check_referral_data(user_id)
-        logger.info(f"Отладочные данные для {user_id}: {debug_data}")
-        
+
         me = await bot.get_me()
         bot_username = me.username or ""
         link = f"https://t.me/{bot_username}?start={user_id}"
@@ -557,13 +538,13 @@ async def show_instructions_from_vpn(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == 'back_to_vpn')
+@dp.callback_query(F.data == 'back_to_vpn', flags={'early_ack': True})
 async def back_to_vpn_callback(callback: types.CallbackQuery):
     """Возврат к отображению VPN информации"""
     user_id = callback.from_user.id
-    user_data = await get_user_data(user_id)
+    snapshot = await get_user_snapshot(user_id)
     
-    if not user_data:
+    if not snapshot.has_subscription:
         await callback.message.edit_text(
             text="""<b>👨🏻‍💻Чтобы подключиться — выбери подписку:</b>
 
@@ -571,7 +552,7 @@ async def back_to_vpn_callback(callback: types.CallbackQuery):
             reply_markup=get_subscription_keyboard(True)
         )
     else:
-        await send_vpn_message(callback, user_id, is_edit=True)
+        await send_vpn_message(callback, user_id, is_edit=True, snapshot=snapshot)
     
     await callback.answer()
 
@@ -599,14 +580,14 @@ async def show_instructions(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith('instruction_'))
+@dp.callback_query(F.data.startswith('instruction_'), flags={'early_ack': 'spinner'})
 async def show_device_instructions(callback: types.CallbackQuery):
     """Показывает инструкцию для конкретного устройства"""
     device = callback.data.split('_')[1]
     user_id = callback.from_user.id
     
     # Получаем конфиг пользователя
-    user_data = await get_user_data(user_id)
+    user_data = (await get_user_snapshot(user_id)).user_data
     if not user_data:
         await callback.answer("Ошибка получения конфигурации", show_alert=True)
         return
@@ -614,34 +595,15 @@ async def show_device_instructions(callback: types.CallbackQuery):
     expiry_date, config = user_data
     config_clean = str(config).strip('\"\'')
     
-    # Отладочная информация
-    print(f"DEBUG instructions: user_id={user_id}, config={config}, config_clean={config_clean}")
-    
     # Проверяем, что config не пустой
     if not config_clean or config_clean == 'None':
         await callback.answer("❌ Ошибка: конфигурация VPN не найдена. Обратитесь в поддержку.", show_alert=True)
         return
     
     # Получаем sub_key для ссылки (как в активации VPN)
-    timeout = aiohttp.ClientTimeout(total=10)
-    headers = {
-        "X-API-Key": "18181818",
-        "Accept": "application/json",
-    } 
-    try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(f"https://shardtg.ru/sub/{user_id}", headers=headers) as resp:
-                if resp.status != 200:
-                    await callback.answer("Не удалось получить ссылку. Попробуйте позже.", show_alert=True)
-                    return
-                data = await resp.json()
-    except Exception:
-        await callback.answer("Сервер временно недоступен. Попробуйте позже.", show_alert=True)
-        return
-
-    sub_key = data.get("sub_key")
+    sub_key = await get_sub_key(user_id)
     if not sub_key:
-        await callback.answer("Ошибка получения ссылки. Попробуйте позже.", show_alert=True)
+        await callback.answer("Не удалось получить ссылку. Попробуйте позже.", show_alert=True)
         return
 
     miniapp_link = f"https://shardtg.ru/subscription/{sub_key}"
@@ -745,10 +707,9 @@ async def renew_subscription(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
     # Проверяем, есть ли у пользователя данные о подписке (активной или истекшей)
-    user_data = await get_user_data(user_id)
-    has_paid = await check_user_payment(user_id)
+    snapshot = await get_user_snapshot(user_id)
     
-    if user_data or has_paid:
+    if snapshot.has_subscription or snapshot.is_active:
         # У пользователя есть подписка (активная или истекшая) - показываем варианты продления
         await callback.message.answer(
             text="""<b>🔒Продли подписку и оставайся в безопасности!</b>
@@ -763,12 +724,12 @@ async def renew_subscription(callback: types.CallbackQuery):
             "У вас нет подписки. Оформите новую подписку.",
             show_alert=True
         )
-        await show_subscription_options(callback.message)
+        await show_subscription_options(callback.message, snapshot)
     
     await callback.answer()
 
 # ----- Обработка оплаты через Telegram Stars -----
-@dp.callback_query(F.data.startswith('pay_stars_'))
+@dp.callback_query(F.data.startswith('pay_stars_'), flags={'throttle': 'payment'})
 async def pay_stars_callback(callback: types.CallbackQuery):
     """Отправляет пользователю счёт на оплату в Telegram Stars"""
     period = callback.data.split('_')[2]
@@ -822,20 +783,40 @@ async def successful_payment_handler(message: Message):
             await message.answer("Ошибка активации подписки. Обратитесь в поддержку.")
             return
 
+        event_bus.publish(PaymentSucceeded(
+            user_id=user_id,
+            chat_id=message.chat.id,
+            period_months=period_months,
+            payment_method='stars',
+            amount_rub=calculate_amount_for_period(period_months),
+            was_active=was_active
+        ))
+
+# ----- Подписчики события успешной оплаты -----
+@event_bus.subscribe(PaymentSucceeded, retries=2)
+async def confirm_payment_to_user(event: PaymentSucceeded):
+    """Отправляет пользователю подтверждение оплаты"""
+    # Удаляем сообщение с платежом (для ЮKassa)
+    if event.message_id:
+        try:
+            await bot.delete_message(chat_id=event.chat_id, message_id=event.message_id)
+        except Exception as e:
+            logger.warning(f"Не удалось удалить сообщение: {e}")
 
-        user_data = await get_user_data(user_id)
-        expiry_date = user_data[0] if user_data else "не определена"
+    user_data = await get_user_data(event.user_id)
+    expiry_date = user_data[0] if user_data else "не определена"
 
-        action_word = "продлена" if was_active else "активирована"
+    action_word = "продлена" if event.was_active else "активирована"
 
-        # Определяем текст периода для отображения
-        if period_months == 0:
-            period_text = "7 дней"
-        else:
-            period_text = f"{period_months} мес."
-        
-        await message.answer(
-            text=f"""<b>✅ Оплата успешно выполнена</b>
+    # Определяем текст периода для отображения
+    if event.period_months == 0:
+        period_text = "7 дней"
+    else:
+        period_text = f"{event.period_months} мес."
+
+    await bot.send_message(
+        chat_id=event.chat_id,
+        text=f"""<b>✅ Оплата успешно выполнена</b>
 
 ✨Ваша подписка на <b>Shard VPN</b> {action_word}!
 
@@ -843,139 +824,209 @@ async def successful_payment_handler(message: Message):
 ⏳Дата окончания: <b>{expiry_date}</b>
 
 <blockquote><i>🔹 Нажмите «Активировать VPN», чтобы начать пользоваться.</i></blockquote>""",
-            message_effect_id="5046509860389126442",
-            reply_markup=create_main_keyboard()
-        )
-        # Реферальные начисления
-        try:
-            amount_rub = calculate_amount_for_period(period_months)
-            await accrue_referral_commissions(user_id, amount_rub, method='stars', bot=bot)
-        except Exception as e:
-            logger.error(f"Ошибка начисления реферальных: {e}")
-async def send_notification(user_id: int, text: str, notification_type: str):
-    """Отправляет уведомление пользователю"""
+        message_effect_id="5046509860389126442",
+        reply_markup=create_main_keyboard()
+    )
+
+@event_bus.subscribe(PaymentSucceeded, retries=0)
+async def accrue_referrals_for_payment(event: PaymentSucceeded):
+    """Реферальные начисления (не повторяем: начисление не идемпотентно)"""
+    await accrue_referral_commissions(event.user_id, event.amount_rub, method=event.payment_method, bot=bot)
+
+async def send_notification(user_id: int, text: str, notification_type: str, expiry_at: str = None) -> bool:
+    """Отправляет уведомление пользователю; False — не удалось, стоит повторить позже"""
     try:
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔄 Продлить подписку", callback_data='renew_sub')]
         ])
-        await bot.send_message(chat_id=user_id, text=text, reply_markup=keyboard)
-        await mark_user_notified(user_id, notification_type)
+        await delivery.send_message(user_id, text, lane=LANE_NOTIFICATION, reply_markup=keyboard)
+        await mark_user_notified(user_id, notification_type, expiry_at)
+    except TelegramForbiddenError:
+        # Пользователь заблокировал бота — больше не пытаемся ему писать
+        await mark_bot_blocked([user_id])
     except Exception as e:
         logger.error(f"Ошибка отправки уведомления {user_id}: {e}")
+        return False
+    return True
+
+@dp.my_chat_member(F.chat.type == "private")
+async def bot_membership_changed(update: types.ChatMemberUpdated):
+    """Пользователь заблокировал или разблокировал бота"""
+    status = update.new_chat_member.status
+    if status == ChatMemberStatus.KICKED:
+        await mark_bot_blocked([update.from_user.id])
+    elif status == ChatMemberStatus.MEMBER:
+        await clear_bot_blocked(update.from_user.id)
+
+# Тексты уведомлений об окончании подписки по типам
+EXPIRY_NOTIFICATION_TEXTS = {
+    '3d': (
+        "⏳ <b>Ваша подписка истекает через 3 дня</b>\n\n"
+        "<blockquote><i>Не теряйте доступ к быстрому и безопасному VPN — продлите подписку заранее.</i></blockquote>\n\n"
+        "Дата окончания: <code>{expiry}</code>"
+    ),
+    '2d': (
+        "⏳ <b>Ваша подписка скоро истечёт</b>\n\n"
+        "<blockquote><i>Осталось 2 дня. Не теряйте защиту и скорость — продлите заранее.</i></blockquote>\n\n"
+        "Дата окончания: <code>{expiry}</code>"
+    ),
+    '1d': (
+        "⚠️ <b>Ваша подписка истекает завтра!</b>\n\n"
+        "<blockquote><i>Последний день доступа. Продлите подписку, чтобы не потерять защиту.</i></blockquote>\n\n"
+        "Дата окончания: <code>{expiry}</code>"
+    ),
+    'expired': (
+        "❌ <b>Ваша подписка истекла</b>\n\n"
+        "<blockquote><i>Доступ завершён. Продлите подписку, чтобы продолжить пользоваться VPN.</i></blockquote>\n\n"
+        "Дата окончания: <code>{expiry}</code>"
+    ),
+}
 
-async def main():
+async def send_expiry_notification(user_id: int, notification_type: str, expiry_at: str) -> bool:
+    """Отправляет уведомление об окончании подписки (вызывается планировщиком в момент срока)"""
+    expiry = datetime.strptime(expiry_at, '%Y-%m-%d %H:%M').strftime('%d.%m.%Y %H:%M')
+    text = EXPIRY_NOTIFICATION_TEXTS[notification_type].format(expiry=expiry)
+    return await send_notification(user_id, text, notification_type, expiry_at)
+
+def register_metrics():
+    """Метрики состояния бота, считываемые при каждом запросе /metrics"""
+    registry.gauge('bot_pending_payments', "Платежи YooKassa, ожидающие подтверждения",
+                   lambda: len(active_payment_tasks))
+    registry.gauge('bot_notifications_scheduled', "Уведомления об окончании подписки в планировщике",
+                   lambda: len(expiry_scheduler))
+    registry.gauge('bot_notification_flags_pending', "Отметки об уведомлениях, ещё не записанные в БД",
+                   lambda: len(notification_flags))
+    registry.gauge('bot_delivery_queue', "Сообщения в очередях сервиса доставки",
+                   lambda: {lane: delivery.queued(lane) for lane in LANES}, label='lane')
+    registry.gauge('bot_delivery_total', "Итоги отправки сообщений (sent_broadcast — пропускная способность рассылок)",
+                   lambda: dict(delivery_stats), kind='counter', label='event')
+    registry.gauge('bot_broadcasts_running', "Выполняющиеся рассылки", lambda: len(broadcast_manager))
+    registry.gauge('bot_events_total', "Опубликованные и обработанные доменные события",
+                   lambda: dict(event_stats), kind='counter', label='event')
+
+
+def register_jobs():
+    """Периодические задачи; выполняются только в ведущем процессе"""
+    # Новые подписки, вошедшие в горизонт планировщика уведомлений
+    job_scheduler.add('expiry_refill', expiry_scheduler.refill, interval=REFILL_INTERVAL, jitter=60)
+    if BOT_MODE == 'webhook' and WEBHOOK_WORKERS > 1:
+        # Подписки, изменённые другими воркерами, доходят до расписания ведущего только сверкой с БД
+        job_scheduler.add('expiry_reload', expiry_scheduler.reload, interval=RELOAD_INTERVAL, jitter=30)
+    # Просроченные состояния FSM и записи проверок платежей (общая таблица)
+    job_scheduler.add('fsm_purge', state_storage.purge, interval=60 * 60, jitter=60, run_at_start=True)
+    if BOT_MODE == 'webhook':
+        job_scheduler.add('webhook_dedup_cleanup', cleanup_webhook_updates, interval=10 * 60, jitter=30)
+    job_scheduler.add('db_optimize', optimize_db, cron='30 4 * * *', timeout=10 * 60)
+    # Рассылки, созданные или продолженные админом в любом процессе
+    job_scheduler.add('broadcasts_poll', broadcast_manager.poll, interval=BROADCAST_POLL_INTERVAL, run_at_start=True)
+
+async def start_background_jobs():
+    """Запуск фоновых задач процессом, ставшим ведущим"""
+    # Закрываем пачки рассылок и продолжаем проверки платежей, прерванные перезапуском или падением
+    # прежнего ведущего; сами рассылки подхватывает задача broadcasts_poll
+    await broadcast_manager.start(bot)
+    await resume_payment_checks(bot)
+    # Уведомления об окончании подписки отправляются планировщиком точно в срок
+    expiry_scheduler.start(send_expiry_notification, flush_notification_flags)
+    job_scheduler.start()
+
+async def stop_background_jobs():
+    """Остановка фоновых задач при потере роли ведущего или выключении"""
+    # Периодические задачи дорабатывают текущий запуск (до 10 секунд)
+    await job_scheduler.stop()
+    try:
+        await asyncio.wait_for(expiry_scheduler.stop(), timeout=5.0)
+    except asyncio.TimeoutError:
+        logger.warning("Планировщик уведомлений не завершился в течение 5 секунд")
+    # Рассылки останавливаются после текущей пачки и продолжатся у следующего ведущего
+    await broadcast_manager.stop()
+
+async def main(worker: int = BOT_WORKER):
+    """Запуск бота. Апдейты обрабатывает каждый процесс, фоновые задачи — только ведущий (leader.py)"""
     await init_db()
-    shutdown_event = asyncio.Event()
-    
-    # Запускаем фоновую задачу уведомления об истечении подписки через 2 дня
-    async def notify_expiring_loop():
-        while not shutdown_event.is_set():
-            try:
-                users = await get_users_expiring_in_days(2, 500)
-                for user_id, expiry in users:
-                    if shutdown_event.is_set():
-                        break
-                    text = (
-                        "⏳ <b>Ваша подписка скоро истечёт</b>\n\n"
-                        "<blockquote><i>Осталось 2 дня. Не теряйте защиту и скорость — продлите заранее.</i></blockquote>\n\n"
-                        f"Дата окончания: <code>{expiry}</code>"
-                    )
-                    await send_notification(user_id, text, '2d')
-                
-                await asyncio.wait_for(shutdown_event.wait(), timeout=60 * 60)
-            except asyncio.TimeoutError:
-                pass
-            except Exception as e:
-                logger.error(f"Ошибка в notify_expiring_loop: {e}")
-                await asyncio.wait_for(shutdown_event.wait(), timeout=60 * 10)
 
-    # Запускаем фоновую задачу уведомлений для всех пользователей
-    async def notify_all_expiring_loop():
-        while not shutdown_event.is_set():
-            try:
-                # Уведомления за 3 дня
-                users_3d = await get_all_users_expiring_in_days(3, 500)
-                for user_id, expiry, _ in users_3d:
-                    if shutdown_event.is_set():
-                        break
-                    text = (
-                        f"⏳ <b>Ваша подписка истекает через 3 дня</b>\n\n"
-                        "<blockquote><i>Не теряйте доступ к быстрому и безопасному VPN — продлите подписку заранее.</i></blockquote>\n\n"
-                        f"Дата окончания: <code>{expiry}</code>"
-                    )
-                    await send_notification(user_id, text, '3d')
-
-                if shutdown_event.is_set():
-                    break
-
-                # Уведомления за 1 день
-                users_1d = await get_all_users_expiring_in_days(1, 500)
-                for user_id, expiry, _ in users_1d:
-                    if shutdown_event.is_set():
-                        break
-                    text = (
-                        f"⚠️ <b>Ваша подписка истекает завтра!</b>\n\n"
-                        "<blockquote><i>Последний день доступа. Продлите подписку, чтобы не потерять защиту.</i></blockquote>\n\n"
-                        f"Дата окончания: <code>{expiry}</code>"
-                    )
-                    await send_notification(user_id, text, '1d')
-
-                if shutdown_event.is_set():
-                    break
-
-                # Уведомления об истечении
-                users_expired = await get_all_users_expiring_in_days(0, 500)
-                for user_id, expiry, _ in users_expired:
-                    if shutdown_event.is_set():
-                        break
-                    text = (
-                        f"❌ <b>Ваша подписка истекла</b>\n\n"
-                        f"<blockquote><i>Доступ завершён. Продлите подписку, чтобы продолжить пользоваться VPN.</i></blockquote>\n\n"
-                        f"Дата окончания: <code>{expiry}</code>"
-                    )
-                    await send_notification(user_id, text, 'expired')
-
-                await asyncio.wait_for(shutdown_event.wait(), timeout=60 * 60)
-            except asyncio.TimeoutError:
-                pass
-            except Exception as e:
-                logger.error(f"Ошибка в notify_all_expiring_loop: {e}")
-                await asyncio.wait_for(shutdown_event.wait(), timeout=60 * 10)
-
-    # Создаем задачи и сохраняем ссылки на них
-    task1 = asyncio.create_task(notify_expiring_loop())
-    task2 = asyncio.create_task(notify_all_expiring_loop())
+    # Все рассылки и уведомления идут через общий сервис доставки с лимитами Telegram
+    delivery.start(bot)
+
+    # Замеры времени обработки апдейтов (хендлер, SQL, панель, YooKassa, Telegram)
+    setup_instrumentation(dp, bot)
+    # Лимиты частоты на создание платежей, партнёрку и выдачу ключа (THROTTLE_LIMITS)
+    setup_throttling(dp)
+    # Медленные кнопки (панель, БД) получают ответ сразу, а результат — правкой сообщения
+    setup_early_ack(dp, bot)
+    loop_watchdog.start()
+    if METRICS_PORT:
+        register_metrics()
+        await metrics_server.start(METRICS_HOST, METRICS_PORT + worker)
+
+    # Рассылки, уведомления, периодические задачи и возобновление проверок платежей ведёт один процесс
+    register_jobs()
+    leader.start(start_background_jobs, stop_background_jobs)
     
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == 'webhook':
+            handler = WebhookHandler(
+                dp, bot, WEBHOOK_SECRET, WEBHOOK_MAX_CONCURRENCY, shared_dedup=WEBHOOK_WORKERS > 1
+            )
+            await serve_webhook(handler, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, reuse_port=WEBHOOK_WORKERS > 1)
+        else:
+            # Если раньше был включён webhook, getUpdates без этого не работает
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     finally:
-        # Устанавливаем флаг завершения
-        shutdown_event.set()
-        
+        # Дорабатываем нажатия, на которые уже ответили пользователю
+        await drain_callback_tasks()
+
         # Отменяем все активные задачи проверки платежей
         await cancel_all_payment_tasks()
+
+        # Даём обработчикам событий (подтверждения, начисления) завершиться
+        await event_bus.shutdown()
         
-        # Ждем завершения задач с таймаутом
-        try:
-            await asyncio.wait_for(asyncio.gather(task1, task2, return_exceptions=True), timeout=5.0)
-        except asyncio.TimeoutError:
-            logger.warning("Некоторые фоновые задачи не завершились в течение 5 секунд")
-        
-        # Отменяем оставшиеся задачи
-        for task in [task1, task2]:
-            if not task.done():
-                task.cancel()
-                try:
-                    await task
-                except asyncio.CancelledError:
-                    pass
+        # Останавливаем планировщик и рассылки и сразу отдаём роль ведущего другому процессу
+        await leader.stop()
+
+        # Досылаем уведомления из очереди и останавливаем сервис доставки
+        await delivery.stop()
+
+        # Записываем отметки об отправленных уведомлениях
+        await flush_notification_flags()
+
+        await state_storage.close()
+        await payment_checks.close()
+
+        await metrics_server.stop()
+        await loop_watchdog.stop()
+        await bot.session.close()
+
+async def set_webhook():
+    """Регистрирует webhook в Telegram (один раз, до запуска процессов)"""
+    await bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET or None,
+        max_connections=min(100, WEBHOOK_MAX_CONCURRENCY * WEBHOOK_WORKERS),
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    await bot.session.close()
+    logger.info(f"Webhook установлен: {WEBHOOK_URL}")
+
+def run_webhook_worker(index: int):
+    """Точка входа webhook-процесса (запускается через spawn)"""
+    asyncio.run(main(index))
 
 if __name__ == '__main__':
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        loop.run_until_complete(main())
-    except KeyboardInterrupt:
-        pass
-    finally:
-        loop.close()
+    if BOT_MODE == 'webhook':
+        asyncio.run(set_webhook())
+        if WEBHOOK_WORKERS > 1:
+            run_workers(run_webhook_worker, WEBHOOK_WORKERS)
+        else:
+            asyncio.run(main())
+    else:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(main())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            loop.close()
@@ -0,0 +1,320 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from datetime import datetime
+
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import SendMessage, SendPhoto
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from db import connect_db
+from database import mark_bot_blocked
+from delivery import delivery, LANE_BROADCAST
+from segments import compile_segment, segment_title
+
+# Статусы задания рассылки
+STATUS_RUNNING = 'running'
+STATUS_PAUSED = 'paused'
+STATUS_CANCELLED = 'cancelled'
+STATUS_DONE = 'done'
+
+STATUS_NAMES = {
+    STATUS_RUNNING: "⏳ идёт",
+    STATUS_PAUSED: "⏸ на паузе",
+    STATUS_CANCELLED: "⛔ отменена",
+    STATUS_DONE: "✅ завершена",
+}
+
+# Получателей за одну пачку: после каждой пачки фиксируем статусы и проверяем паузу/отмену
+BATCH_SIZE = 50
+# Как часто обновлять сообщение админа с прогрессом
+PROGRESS_INTERVAL = 5.0
+# Как часто ведущий процесс ищет задания со статусом 'running', которые ещё не выполняет
+POLL_INTERVAL = 2.0
+
+JOB_COLUMNS = ('id', 'admin_id', 'progress_message_id', 'segment', 'text', 'photo_file_id',
+               'status', 'total', 'sent', 'failed', 'blocked', 'created_at', 'finished_at')
+
+
+class BroadcastManager:
+    """Фоновые рассылки с сохранением состояния в БД.
+
+    Аудитория фиксируется при создании задания (broadcast_recipients), дальше
+    получатели обрабатываются пачками через сервис доставки. Перед отправкой пачка
+    помечается как 'sending', после — итоговым статусом, поэтому после перезапуска
+    задание продолжается с первого необработанного получателя, а неизвестные
+    (отправка прервалась посередине) повторно не отправляются.
+
+    Рассылки выполняет только ведущий процесс (leader.py): создание, пауза,
+    продолжение и отмена лишь меняют broadcast_jobs.status в любом процессе,
+    ведущий подхватывает задания со статусом 'running' периодической задачей
+    poll(), а выполняющееся задание перечитывает статус перед каждой пачкой.
+    """
+
+    def __init__(self):
+        self._bot = None
+        self._tasks = {}
+        self._stopping = True
+
+    def __len__(self) -> int:
+        """Количество выполняющихся сейчас рассылок"""
+        return len(self._tasks)
+
+    async def start(self, bot):
+        """Ведущий процесс: запоминает бота и закрывает пачки, прерванные перезапуском.
+
+        Сами задания со статусом 'running' запускает poll().
+        """
+        self._bot = bot
+        self._stopping = False
+        async with connect_db() as conn:
+            cursor = await conn.execute(
+                "SELECT job_id, COUNT(*) FROM broadcast_recipients WHERE status = 'sending' GROUP BY job_id"
+            )
+            interrupted = await cursor.fetchall()
+            for job_id, unknown in interrupted:
+                await conn.execute(
+                    "UPDATE broadcast_recipients SET status = 'unknown' WHERE job_id = ? AND status = 'sending'",
+                    (job_id,)
+                )
+                await conn.execute("UPDATE broadcast_jobs SET failed = failed + ? WHERE id = ?", (unknown, job_id))
+            await conn.commit()
+
+    async def poll(self):
+        """Запускает задания со статусом 'running', которые этот процесс ещё не выполняет"""
+        if self._stopping:
+            return
+        async with connect_db() as conn:
+            cursor = await conn.execute("SELECT id FROM broadcast_jobs WHERE status = ?", (STATUS_RUNNING,))
+            running = [row[0] for row in await cursor.fetchall()]
+        for job_id in running:
+            if job_id not in self._tasks:
+                logging.info(f"Запускаем рассылку #{job_id}")
+                self._launch(job_id)
+
+    async def stop(self, timeout: float = 10.0):
+        """Останавливает задания после текущей пачки, статус 'running' сохраняется для продолжения"""
+        self._stopping = True
+        if not self._tasks:
+            return
+        tasks = list(self._tasks.values())
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def create(self, admin_id: int, progress_message_id: int, segment: str,
+                     text: str = None, photo_file_id: str = None) -> int:
+        """Создаёт задание рассылки и фиксирует аудиторию сегмента; отправку подхватит ведущий процесс"""
+        segment_sql, params = compile_segment(segment)
+        async with connect_db() as conn:
+            cursor = await conn.execute(
+                """INSERT INTO broadcast_jobs (admin_id, progress_message_id, segment, text, photo_file_id, status, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (admin_id, progress_message_id, segment, text, photo_file_id, STATUS_RUNNING,
+                 datetime.now().strftime('%d.%m.%Y %H:%M'))
+            )
+            job_id = cursor.lastrowid
+            # Снимок аудитории одним запросом, без выгрузки списка в память
+            cursor = await conn.execute(
+                f"INSERT OR IGNORE INTO broadcast_recipients (job_id, user_id) SELECT :job_id, user_id FROM ({segment_sql})",
+                {**params, 'job_id': job_id}
+            )
+            await conn.execute("UPDATE broadcast_jobs SET total = ? WHERE id = ?", (cursor.rowcount, job_id))
+            await conn.commit()
+
+        return job_id
+
+    async def pause(self, job_id: int) -> bool:
+        """Ставит задание на паузу (вступает в силу после текущей пачки)"""
+        return await self._set_status(job_id, STATUS_PAUSED, (STATUS_RUNNING,))
+
+    async def resume(self, job_id: int) -> bool:
+        """Продолжает приостановленное задание"""
+        return await self._set_status(job_id, STATUS_RUNNING, (STATUS_PAUSED,))
+
+    async def cancel(self, job_id: int) -> bool:
+        """Отменяет задание; оставшиеся получатели не получат сообщение"""
+        return await self._set_status(job_id, STATUS_CANCELLED, (STATUS_RUNNING, STATUS_PAUSED), finished=True)
+
+    async def get_job(self, job_id: int) -> dict:
+        async with connect_db() as conn:
+            cursor = await conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM broadcast_jobs WHERE id = ?", (job_id,))
+            row = await cursor.fetchone()
+        return dict(zip(JOB_COLUMNS, row)) if row else None
+
+    async def recent_jobs(self, limit: int = 10) -> list:
+        """Последние задания рассылки (для истории в админке)"""
+        async with connect_db() as conn:
+            cursor = await conn.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM broadcast_jobs ORDER BY id DESC LIMIT ?", (limit,)
+            )
+            rows = await cursor.fetchall()
+        return [dict(zip(JOB_COLUMNS, row)) for row in rows]
+
+    async def _set_status(self, job_id: int, status: str, allowed: tuple, finished: bool = False) -> bool:
+        placeholders = ','.join('?' * len(allowed))
+        finished_at = datetime.now().strftime('%d.%m.%Y %H:%M') if finished else None
+        async with connect_db() as conn:
+            cursor = await conn.execute(
+                f"""UPDATE broadcast_jobs SET status = ?, finished_at = COALESCE(?, finished_at)
+                    WHERE id = ? AND status IN ({placeholders})""",
+                (status, finished_at, job_id, *allowed)
+            )
+            await conn.commit()
+            return cursor.rowcount == 1
+
+    async def _status(self, job_id: int) -> str:
+        async with connect_db() as conn:
+            cursor = await conn.execute("SELECT status FROM broadcast_jobs WHERE id = ?", (job_id,))
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    def _launch(self, job_id: int):
+        task = asyncio.create_task(self._run(job_id), name=f"broadcast_{job_id}")
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _run(self, job_id: int):
+        try:
+            job = await self.get_job(job_id)
+            make_method = _method_factory(job['text'], job['photo_file_id'])
+            await self._show_progress(job)
+            last_progress = time.monotonic()
+            last_user_id = -1
+
+            # Пауза и отмена приходят из любого процесса только через БД — проверяем перед каждой пачкой
+            while not self._stopping and await self._status(job_id) == STATUS_RUNNING:
+                async with connect_db() as conn:
+                    # Пачка забирается одним UPDATE: если после смены ведущего задание на короткое время
+                    # выполняют два процесса, один получатель не достанется обоим
+                    cursor = await conn.execute(
+                        """UPDATE broadcast_recipients SET status = 'sending'
+                           WHERE job_id = ? AND user_id IN (
+                               SELECT user_id FROM broadcast_recipients
+                               WHERE job_id = ? AND status = 'pending' AND user_id > ?
+                               ORDER BY user_id LIMIT ?)
+                           RETURNING user_id""",
+                        (job_id, job_id, last_user_id, BATCH_SIZE)
+                    )
+                    user_ids = sorted(row[0] for row in await cursor.fetchall())
+                    await conn.commit()
+                if not user_ids:
+                    await self._set_status(job_id, STATUS_DONE, (STATUS_RUNNING,), finished=True)
+                    break
+
+                futures = [await delivery.submit(make_method(user_id), LANE_BROADCAST) for user_id in user_ids]
+                await asyncio.wait(futures)
+                await self._save_batch(job_id, user_ids, futures)
+                last_user_id = user_ids[-1]
+
+                if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    await self._show_progress(await self.get_job(job_id))
+                    last_progress = time.monotonic()
+
+            job = await self.get_job(job_id)
+            await self._show_progress(job)
+            if job['status'] == STATUS_DONE:
+                logging.info(
+                    f"Рассылка #{job_id} завершена: отправлено {job['sent']}, "
+                    f"заблокировали {job['blocked']}, ошибок {job['failed']} из {job['total']}"
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка рассылки #{job_id}: {e}", exc_info=True)
+
+    async def _save_batch(self, job_id: int, user_ids: list, futures: list):
+        """Фиксирует итог пачки: статусы получателей и счётчики задания"""
+        statuses = []
+        totals = Counter()
+        for user_id, future in zip(user_ids, futures):
+            if future.cancelled():
+                status = 'failed'
+            elif isinstance(future.exception(), TelegramForbiddenError):
+                status = 'blocked'
+            elif future.exception():
+                status = 'failed'
+            else:
+                status = 'sent'
+            totals[status] += 1
+            statuses.append((status, job_id, user_id))
+
+        async with connect_db() as conn:
+            await conn.executemany(
+                "UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND user_id = ?", statuses
+            )
+            await conn.execute(
+                "UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ?, blocked = blocked + ? WHERE id = ?",
+                (totals['sent'], totals['failed'], totals['blocked'], job_id)
+            )
+            await conn.commit()
+
+        # Заблокировавших бота исключаем из будущих рассылок и уведомлений
+        await mark_bot_blocked(user_id for status, _, user_id in statuses if status == 'blocked')
+
+    async def _show_progress(self, job: dict):
+        """Обновляет сообщение админа с прогрессом"""
+        if not self._bot or not job or not job['progress_message_id']:
+            return
+        try:
+            await self._bot.edit_message_text(
+                chat_id=job['admin_id'],
+                message_id=job['progress_message_id'],
+                text=format_job(job),
+                reply_markup=job_controls(job)
+            )
+        except Exception as e:
+            # В том числе «message is not modified», если с прошлого обновления ничего не изменилось
+            logging.debug(f"Не удалось обновить прогресс рассылки #{job['id']}: {e}")
+
+
+def _method_factory(text: str, photo_file_id: str):
+    def make_method(user_id):
+        if photo_file_id:
+            # Фото (с подписью, если есть)
+            return SendPhoto(chat_id=user_id, photo=photo_file_id, caption=text or None, parse_mode="HTML")
+        return SendMessage(chat_id=user_id, text=text, parse_mode="HTML")
+    return make_method
+
+
+def _segment_label(name: str) -> str:
+    try:
+        return segment_title(name)
+    except ValueError:
+        return name
+
+
+def format_job(job: dict) -> str:
+    """Текст с прогрессом/итогами задания рассылки"""
+    processed = job['sent'] + job['failed'] + job['blocked']
+    percent = processed * 100 // job['total'] if job['total'] else 100
+    text = f"""<b>📤 Рассылка #{job['id']}</b> — {STATUS_NAMES.get(job['status'], job['status'])}
+
+<b>Аудитория:</b> {_segment_label(job['segment'])}
+<b>Обработано:</b> <code>{processed}/{job['total']}</code> ({percent}%)
+<b>Успешно отправлено:</b> <code>{job['sent']}</code>
+<b>Заблокировали бота:</b> <code>{job['blocked']}</code>
+<b>Ошибки отправки:</b> <code>{job['failed']}</code>
+<b>Создана:</b> <code>{job['created_at']}</code>"""
+    if job['finished_at']:
+        text += f"\n<b>Завершена:</b> <code>{job['finished_at']}</code>"
+    return text
+
+
+def job_controls(job: dict):
+    """Кнопки управления заданием рассылки"""
+    if job['status'] == STATUS_RUNNING:
+        toggle = InlineKeyboardButton(text="⏸ Пауза", callback_data=f"bcjob_pause_{job['id']}")
+    elif job['status'] == STATUS_PAUSED:
+        toggle = InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"bcjob_resume_{job['id']}")
+    else:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        toggle,
+        InlineKeyboardButton(text="⛔ Отменить", callback_data=f"bcjob_cancel_{job['id']}")
+    ]])
+
+
+broadcast_manager = BroadcastManager()
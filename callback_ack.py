@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import AnswerCallbackQuery
+from aiogram.types import CallbackQuery, InlineKeyboardMarkup
+
+from metrics import registry
+
+# Сколько секунд может работать хендлер после раннего ответа на callback
+TASK_TIMEOUT = 60.0
+SPINNER = "⏳"
+ERROR_TEXT = "⚠️ Не удалось выполнить действие. Попробуйте позже."
+
+callback_task_duration = registry.histogram(
+    'bot_callback_task_duration_seconds', "Время работы хендлеров после раннего ответа на callback", ('handler',),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
+callback_tasks = registry.counter(
+    'bot_callback_tasks_total', "Хендлеры после раннего ответа на callback по результату", ('handler', 'result')
+)
+
+
+class _Acked:
+    """Callback, на который уже ответили: повторные ответы хендлера перехватываются"""
+
+    __slots__ = ('callback_id', 'chat_id', 'message_id', 'edited', 'notified')
+
+    def __init__(self, callback: CallbackQuery):
+        self.callback_id = callback.id
+        self.chat_id = callback.message.chat.id if callback.message else callback.from_user.id
+        self.message_id = callback.message.message_id if callback.message else None
+        self.edited = False
+        self.notified = False
+
+
+_acked: ContextVar = ContextVar('acked_callback', default=None)
+_tasks = set()
+
+
+def _spinner_markup(callback: CallbackQuery):
+    """Клавиатура сообщения, где у нажатой кнопки перед текстом стоят часики; None — кнопки нет"""
+    # У недоступного (слишком старого) сообщения клавиатуры нет
+    markup = getattr(callback.message, 'reply_markup', None)
+    if not isinstance(markup, InlineKeyboardMarkup):
+        return None
+    found = False
+    rows = []
+    for row in markup.inline_keyboard:
+        new_row = []
+        for button in row:
+            if button.callback_data == callback.data and not found:
+                found = True
+                button = button.model_copy(update={'text': f"{SPINNER} {button.text}"})
+            new_row.append(button)
+        rows.append(new_row)
+    return InlineKeyboardMarkup(inline_keyboard=rows) if found else None
+
+
+class EarlyAckMiddleware(BaseMiddleware):
+    """Сразу отвечает на callback и дорабатывает хендлер в фоновой задаче.
+
+    Включается флагом хендлера: flags={'early_ack': True}, а с 'spinner' нажатая
+    кнопка ещё и получает часики, пока хендлер работает. Telegram ждёт ответа на
+    callback не больше ~15 секунд, а панель и БД иногда отвечают дольше — тогда
+    answer() падает с «query is too old», а у пользователя до этого момента
+    крутятся часики. После раннего ответа хендлер пишет результат правкой
+    сообщения; его собственные callback.answer() перехватывает
+    AckedAnswerMiddleware (текст уведомления уходит сообщением в чат).
+    Ошибка или превышение TASK_TIMEOUT логируются, пользователь получает
+    сообщение об ошибке, а часики на кнопке убираются.
+    """
+
+    async def __call__(self, handler, event, data):
+        mode = get_flag(data, 'early_ack')
+        if not mode or not isinstance(event, CallbackQuery):
+            return await handler(event, data)
+
+        try:
+            await event.answer()
+        except Exception as e:
+            # Уже просрочен — всё равно выполняем действие, результат придёт правкой сообщения
+            logging.debug(f"Не удалось сразу ответить на callback: {e}")
+
+        original_markup = None
+        if mode == 'spinner':
+            markup = _spinner_markup(event)
+            if markup is not None:
+                try:
+                    await event.message.edit_reply_markup(reply_markup=markup)
+                    original_markup = event.message.reply_markup
+                except Exception as e:
+                    logging.debug(f"Не удалось показать часики на кнопке: {e}")
+
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        acked = _Acked(event)
+        token = _acked.set(acked)
+        try:
+            task = asyncio.create_task(
+                self._supervise(handler, event, data, name, acked, original_markup), name=f"callback_{name}"
+            )
+        finally:
+            _acked.reset(token)
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+        return None
+
+    async def _supervise(self, handler, event: CallbackQuery, data: dict, name: str, acked: _Acked,
+                         original_markup):
+        started = time.perf_counter()
+        result = 'ok'
+        try:
+            await asyncio.wait_for(handler(event, data), timeout=TASK_TIMEOUT)
+        except asyncio.CancelledError:
+            result = 'cancelled'
+            raise
+        except TelegramBadRequest as e:
+            if 'message is not modified' not in str(e):
+                result = 'error'
+                logging.error(f"Ошибка хендлера {name} после ответа на callback: {e}")
+        except asyncio.TimeoutError:
+            result = 'timeout'
+            logging.error(f"Хендлер {name} не уложился в {TASK_TIMEOUT:g} с после ответа на callback")
+        except Exception as e:
+            result = 'error'
+            logging.error(f"Ошибка хендлера {name} после ответа на callback: {e}", exc_info=True)
+        finally:
+            elapsed = time.perf_counter() - started
+            callback_task_duration.observe(elapsed, name)
+            callback_tasks.inc(name, result)
+
+        # Часики снимаем, если хендлер сам не заменил сообщение
+        if original_markup is not None and not acked.edited:
+            try:
+                await event.message.edit_reply_markup(reply_markup=original_markup)
+            except Exception as e:
+                logging.debug(f"Не удалось убрать часики с кнопки: {e}")
+        # Если хендлер уже показал свою ошибку, общую не дублируем
+        if result in ('error', 'timeout') and not acked.notified:
+            try:
+                await event.bot.send_message(acked.chat_id, ERROR_TEXT)
+            except Exception as e:
+                logging.warning(f"Не удалось сообщить пользователю об ошибке {name}: {e}")
+
+
+class AckedAnswerMiddleware(BaseRequestMiddleware):
+    """Перехватывает ответы на callback, на который уже ответил EarlyAckMiddleware.
+
+    Повторный answerCallbackQuery Telegram отклонит, поэтому пустой ответ просто
+    пропускается, а уведомление с текстом (обычно ошибка с show_alert)
+    отправляется сообщением в чат. Заодно отмечает, что хендлер правил нажатое сообщение.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        acked = _acked.get()
+        if acked is None:
+            return await make_request(bot, method)
+        if isinstance(method, AnswerCallbackQuery) and method.callback_query_id == acked.callback_id:
+            if method.text:
+                acked.notified = True
+                await bot.send_message(acked.chat_id, method.text)
+            return True
+        if type(method).__name__.startswith('EditMessage') and getattr(method, 'message_id', None) == acked.message_id:
+            acked.edited = True
+        return await make_request(bot, method)
+
+
+def setup_early_ack(dp, bot):
+    """Подключает ранний ответ на callback к диспетчеру и сессии бота"""
+    dp.callback_query.middleware(EarlyAckMiddleware())
+    bot.session.middleware(AckedAnswerMiddleware())
+
+
+async def drain_callback_tasks(timeout: float = 10.0):
+    """При остановке даёт начатым хендлерам доработать до timeout секунд и прерывает оставшиеся"""
+    if not _tasks:
+        return
+    tasks = list(_tasks)
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        logging.warning(f"Хендлер {task.get_name()} не завершился за {timeout:g} с, прерываем")
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -53,6 +53,66 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_NAME = os.getenv('DB_NAME', 'users.db')
 DB_PATH = os.path.join(BASE_DIR, DB_NAME)
 
+# Номер webhook-процесса (задаётся при запуске нескольких процессов, 0 — первый из них)
+BOT_WORKER = int(os.getenv('BOT_WORKER', '0'))
+
+# Логирование: JSON-строки в UTF-8 с ротацией по времени и размеру
+LOG_FILE = os.path.join(BASE_DIR, os.getenv('LOG_FILE', 'bot.log'))
+if os.getenv('BOT_WORKER') is not None:
+    # У каждого webhook-процесса (включая нулевой) свой файл: ротация из нескольких процессов
+    # в один файл небезопасна; без суффикса пишет только родительский или единственный процесс
+    LOG_FILE = f"{LOG_FILE}.worker{BOT_WORKER}"
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Уровни отдельных логгеров: "aiogram.event=WARNING,database=DEBUG"
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(20 * 1024 * 1024)))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', 'midnight')
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '14'))
+# Не больше N одинаковых (с одного места вызова) DEBUG-записей за окно в секундах
+LOG_DEBUG_SAMPLE_LIMIT = int(os.getenv('LOG_DEBUG_SAMPLE_LIMIT', '20'))
+LOG_DEBUG_SAMPLE_WINDOW = int(os.getenv('LOG_DEBUG_SAMPLE_WINDOW', '60'))
+
+# Апдейты дольше этого бюджета логируются с разбивкой времени (0 — не логировать)
+UPDATE_LATENCY_BUDGET_MS = int(os.getenv('UPDATE_LATENCY_BUDGET_MS', '1000'))
+
+# SQL-запросы дольше порога попадают в журнал медленных запросов с планом (0 — выключен)
+SLOW_QUERY_MS = int(os.getenv('SLOW_QUERY_MS', '200'))
+
+# Блокировка event loop дольше порога логируется со стеком блокирующего кода (0 — выключено)
+LOOP_LAG_THRESHOLD_MS = int(os.getenv('LOOP_LAG_THRESHOLD_MS', '300'))
+
+# Встроенный сервер метрик Prometheus (0 — выключен)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Режим получения апдейтов: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+# Публичный адрес, на который Telegram шлёт апдейты (например https://bot.example.com/webhook)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+# Процессов на одном порту (SO_REUSEPORT) и одновременно обрабатываемых апдейтов в каждом
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '1'))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv('WEBHOOK_MAX_CONCURRENCY', '100'))
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    raise ValueError("WEBHOOK_URL не установлен в переменных окружения (BOT_MODE=webhook)")
+
+# Ограничение частоты нажатий на тяжёлые кнопки: класс=N/T — не больше N нажатий за T секунд на пользователя
+# (payment — создание платежа, referrals — партнёрская программа, vpn — выдача ключа через панель)
+THROTTLE_LIMITS = os.getenv('THROTTLE_LIMITS', 'payment=3/60,referrals=5/30,vpn=3/30')
+
+# Фоновые задачи (уведомления, рассылки, проверки платежей) ведёт один процесс — владелец аренды;
+# при падении ведущего роль переходит к другому процессу не позже чем через столько секунд
+LEADER_LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', '15'))
+
+# Состояния FSM (админ-панель и т.п.) в SQLite: сколько живёт неиспользуемое состояние, секунд
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', str(24 * 60 * 60)))
+# Сколько секунд процесс доверяет своей копии состояния; при нескольких процессах кэш выключен,
+# иначе процесс может не увидеть состояние, записанное соседом
+FSM_CACHE_TTL = float(os.getenv('FSM_CACHE_TTL', '0' if BOT_MODE == 'webhook' and WEBHOOK_WORKERS > 1 else '300'))
+
 # Miniapp Configuration
 MINIAPP_BASE_URL = os.getenv('MINIAPP_BASE_URL')
 if not MINIAPP_BASE_URL:
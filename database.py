@@ -1,15 +1,24 @@
-import aiosqlite
+import asyncio
+from collections import defaultdict
 from datetime import datetime, timedelta
 import aiohttp
 import logging
-from config import DB_PATH, PRICES
+from config import PRICES
+from db import connect_db
+from locks import serialized_per_user, single_flight
+from expiry_scheduler import expiry_scheduler
+from delivery import delivery, LANE_NOTIFICATION
+from instrumentation import http_trace_config
 from dateutil.relativedelta import relativedelta
+from aiogram.exceptions import TelegramForbiddenError
 
 __all__ = [
     'init_db',
     'check_user_payment',
     'add_payment',
     'get_user_data',
+    'get_user_snapshot',
+    'UserSnapshot',
     'get_vpn_config',
     'get_vpn_config_days',
     'extend_vpn_config',
@@ -17,7 +26,6 @@ __all__ = [
     'get_user_stats',
     'delete_user',
     'extend_user_subscription',
-    'get_users_by_status',
     'get_payment_stats',
     'add_bot_user',
     'give_user_subscription',
@@ -35,6 +43,9 @@ __all__ = [
     'get_all_referral_stats',
     'get_all_users_expiring_in_days',
     'mark_user_notified',
+    'flush_notification_flags',
+    'mark_bot_blocked',
+    'clear_bot_blocked',
     'has_paid_subscription',
     'has_used_trial',
     'grant_trial_14d',
@@ -45,9 +56,39 @@ __all__ = [
     'calculate_amount_for_period'
 ]
 
+# Платёж считается оплатой, если это не пробный период и не подарок от админа. Единственное
+# определение для has_paid_subscription, снимка пользователя и сегментов рассылок (segments.py);
+# колонка без алиаса — подставляется в подзапросы по одной таблице payments
+PAID_PAYMENT_SQL = "payment_method NOT IN ('trial', 'admin_gift')"
+
+# Флаги уведомлений об окончании подписки по типу — единственный источник имён колонок
+NOTIFICATION_FLAGS = {
+    '3d': 'notified_3d',
+    '2d': 'notified_expiring_2d',
+    '1d': 'notified_1d',
+    'expired': 'notified_expired',
+}
+# Сброс всех флагов, когда у подписки появляется новая дата окончания
+RESET_NOTIFICATION_FLAGS_SQL = ", ".join(f"{column} = 0" for column in NOTIFICATION_FLAGS.values())
+
+# Отметки об уведомлениях пишутся пачкой: не реже раза в секунду или по накоплении
+FLAG_FLUSH_DELAY = 1.0
+FLAG_FLUSH_SIZE = 500
+
+# SQL-выражение, приводящее expiry_date ('%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d') к 'YYYY-MM-DD HH:MM'
+EXPIRY_AT_SQL = """CASE
+    WHEN substr(expiry_date, 3, 1) = '.' THEN
+        substr(expiry_date, 7, 4) || '-' || substr(expiry_date, 4, 2) || '-' || substr(expiry_date, 1, 2) || ' ' || substr(expiry_date, 12, 5)
+    WHEN length(expiry_date) >= 16 THEN substr(expiry_date, 1, 16)
+    WHEN length(expiry_date) = 10 THEN expiry_date || ' 00:00'
+END"""
+
 async def init_db():
     """Инициализация базы данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with connect_db() as db:
+        # WAL: читатели не ждут писателя, несколько процессов (webhook-воркеры) пишут без долгих блокировок
+        await db.execute("PRAGMA journal_mode=WAL")
+
         # Таблица пользователей VPN
         await db.execute('''CREATE TABLE IF NOT EXISTS users
                          (user_id INTEGER PRIMARY KEY,
@@ -154,25 +195,86 @@ async def init_db():
                           created_at TEXT,
                           method TEXT)''')
 
+        # Дата окончания в сортируемом виде 'YYYY-MM-DD HH:MM' (вычисляемая колонка из expiry_date
+        # любого из поддерживаемых форматов) — позволяет фильтровать и сортировать по индексу
+        try:
+            await db.execute(f"""ALTER TABLE users ADD COLUMN expiry_at TEXT
+                                 GENERATED ALWAYS AS ({EXPIRY_AT_SQL}) VIRTUAL""")
+        except Exception:
+            pass
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_expiry_at ON users (expiry_at)")
+
+        # Фоновые рассылки: задание и состояние каждого получателя (для продолжения после перезапуска)
+        await db.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs
+                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                          admin_id INTEGER,
+                          progress_message_id INTEGER,
+                          segment TEXT,
+                          text TEXT,
+                          photo_file_id TEXT,
+                          status TEXT DEFAULT 'running',
+                          total INTEGER DEFAULT 0,
+                          sent INTEGER DEFAULT 0,
+                          failed INTEGER DEFAULT 0,
+                          blocked INTEGER DEFAULT 0,
+                          created_at TEXT,
+                          finished_at TEXT)''')
+        await db.execute('''CREATE TABLE IF NOT EXISTS broadcast_recipients
+                         (job_id INTEGER,
+                          user_id INTEGER,
+                          status TEXT DEFAULT 'pending',
+                          PRIMARY KEY (job_id, user_id)) WITHOUT ROWID''')
+
+        # update_id, принятые webhook-процессами (отсев повторов между процессами)
+        await db.execute('''CREATE TABLE IF NOT EXISTS webhook_updates
+                         (update_id INTEGER PRIMARY KEY,
+                          received_at INTEGER)''')
+
+        # Аренда роли ведущего процесса (leader.py): только он выполняет фоновые задачи
+        await db.execute('''CREATE TABLE IF NOT EXISTS leader_lease
+                         (name TEXT PRIMARY KEY,
+                          holder TEXT NOT NULL,
+                          expires_at REAL NOT NULL)''')
+
+        # Когда пользователь заблокировал бота (NULL — доступен для сообщений)
+        try:
+            await db.execute("ALTER TABLE bot_users ADD COLUMN blocked_at TEXT DEFAULT NULL")
+        except Exception:
+            pass
+
+        # Индексы для сегментов аудитории (segments.py)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_method ON payments (user_id, payment_method)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_bot_users_referrer ON bot_users (referrer_id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_bot_users_blocked ON bot_users (user_id) WHERE blocked_at IS NOT NULL")
+
         await db.commit()
 
+async def optimize_db():
+    """Обслуживание БД (ночная задача планировщика): статистика для планировщика запросов и усечение WAL"""
+    async with connect_db() as db:
+        await db.execute("PRAGMA optimize")
+        cursor = await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        busy, wal_pages, checkpointed = await cursor.fetchone()
+    if busy:
+        logging.info(f"Checkpoint WAL выполнен не полностью: перенесено {checkpointed} из {wal_pages} страниц")
+
 async def add_bot_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
     """Добавляет пользователя в таблицу всех пользователей бота"""
     try:
         current_time = datetime.now().strftime('%d.%m.%Y %H:%M')
         
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             # Проверяем, есть ли уже такой пользователь
             cursor = await conn.execute(
-                "SELECT user_id FROM bot_users WHERE user_id = ?",
+                "SELECT user_id, blocked_at FROM bot_users WHERE user_id = ?",
                 (user_id,)
             )
             existing = await cursor.fetchone()
             
             if existing:
-                # Обновляем последнее взаимодействие
+                # Обновляем последнее взаимодействие (пользователь снова пишет боту — снимаем отметку о блокировке)
                 await conn.execute(
-                    "UPDATE bot_users SET last_interaction = ?, username = ?, first_name = ?, last_name = ? WHERE user_id = ?",
+                    "UPDATE bot_users SET last_interaction = ?, username = ?, first_name = ?, last_name = ?, blocked_at = NULL WHERE user_id = ?",
                     (current_time, username, first_name, last_name, user_id)
                 )
                 logging.info(f"Обновлен пользователь бота: {user_id}")
@@ -185,14 +287,60 @@ async def add_bot_user(user_id: int, username: str = None, first_name: str = Non
                 logging.info(f"Добавлен новый пользователь бота: {user_id} ({first_name})")
             
             await conn.commit()
+            
+            if existing and existing[1]:
+                await _reschedule_from_db(conn, user_id)
             return True
     except Exception as e:
         logging.error(f"Ошибка добавления пользователя бота {user_id}: {e}")
         return False
 
+async def mark_bot_blocked(user_ids) -> None:
+    """Отмечает пользователей, заблокировавших бота: рассылки и уведомления их пропускают"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    blocked_at = datetime.now().strftime('%d.%m.%Y %H:%M')
+    try:
+        async with connect_db() as conn:
+            await conn.executemany(
+                "UPDATE bot_users SET blocked_at = ? WHERE user_id = ? AND blocked_at IS NULL",
+                [(blocked_at, user_id) for user_id in user_ids]
+            )
+            await conn.commit()
+        for user_id in user_ids:
+            expiry_scheduler.unschedule(user_id)
+        logging.info(f"Отмечено заблокировавших бота: {len(user_ids)}")
+    except Exception as e:
+        logging.error(f"Ошибка отметки заблокировавших бота {user_ids[:10]}: {e}")
+
+async def clear_bot_blocked(user_id: int) -> None:
+    """Снимает отметку о блокировке бота (пользователь разблокировал бота)"""
+    try:
+        async with connect_db() as conn:
+            cursor = await conn.execute(
+                "UPDATE bot_users SET blocked_at = NULL WHERE user_id = ? AND blocked_at IS NOT NULL",
+                (user_id,)
+            )
+            await conn.commit()
+            if cursor.rowcount:
+                await _reschedule_from_db(conn, user_id)
+    except Exception as e:
+        logging.error(f"Ошибка снятия отметки о блокировке {user_id}: {e}")
+
+async def _reschedule_from_db(conn, user_id: int) -> None:
+    """Возвращает уведомления об окончании подписки пользователю, снова доступному для сообщений"""
+    cursor = await conn.execute(
+        "SELECT expiry_at FROM users WHERE user_id = ? AND subscribed = 1 AND expiry_at IS NOT NULL",
+        (user_id,)
+    )
+    row = await cursor.fetchone()
+    if row:
+        expiry_scheduler.reschedule(user_id, datetime.strptime(row[0], '%Y-%m-%d %H:%M'))
+
 async def check_user_payment(user_id: int) -> bool:
     """Проверяет активную подписку пользователя"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with connect_db() as db:
         cursor = await db.execute(
             "SELECT expiry_date FROM users WHERE user_id=?",
             (user_id,)
@@ -219,6 +367,7 @@ async def check_user_payment(user_id: int) -> bool:
         logging.error(f"Ошибка проверки подписки для {user_id}: {e}")
         return False
 
+@serialized_per_user
 async def add_payment(user_id: int, period_months: int, payment_method: str = 'yookassa') -> bool:
     """Добавляет платеж и обновляет подписку"""
     try:
@@ -234,7 +383,7 @@ async def add_payment(user_id: int, period_months: int, payment_method: str = 'y
             except Exception:
                 amount = 0
         
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             cursor = await conn.execute(
                 "SELECT user_id FROM bot_users WHERE user_id = ?",
                 (user_id,)
@@ -327,11 +476,7 @@ async def add_payment(user_id: int, period_months: int, payment_method: str = 'y
                     payment_date.strftime('%d.%m.%Y %H:%M')
                 )
             )
-            # Сбрасываем флаг уведомления об истечении за 2 дня
-            await conn.execute(
-                "UPDATE users SET notified_expiring_2d = 0 WHERE user_id = ?",
-                (user_id,)
-            )
+            # Флаги уведомлений сброшены: INSERT OR REPLACE записывает строку заново со значениями по умолчанию
             
             # Добавляем запись о платеже
             await conn.execute('''
@@ -342,6 +487,7 @@ async def add_payment(user_id: int, period_months: int, payment_method: str = 'y
             )
             
             await conn.commit()
+            expiry_scheduler.reschedule(user_id, expiry_date)
             logging.info(f"Подписка успешно добавлена для пользователя {user_id} на {period_months} мес. До {expiry_date.strftime('%d.%m.%Y %H:%M')}")
             return True
             
@@ -367,7 +513,7 @@ async def get_vpn_config(user_id: int, period_months: int) -> str:
     }
     
     try:
-        async with aiohttp.ClientSession() as session:
+        async with aiohttp.ClientSession(trace_configs=[http_trace_config('panel')]) as session:
             async with session.post(url, json=data, headers=headers) as resp:
                 if resp.status == 200:
                     return await resp.text()
@@ -393,7 +539,7 @@ async def get_vpn_config_days(user_id: int, days: int) -> str:
         }
         
         try:
-            async with aiohttp.ClientSession() as session:
+            async with aiohttp.ClientSession(trace_configs=[http_trace_config('panel')]) as session:
                 async with session.post(url, json=data, headers=headers) as resp:
                     if resp.status == 200:
                         return await resp.text()
@@ -409,7 +555,7 @@ async def get_vpn_config_days(user_id: int, days: int) -> str:
 
 async def get_user_data(user_id: int):
     """Получает данные пользователя из БД"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         cursor = await conn.execute(
             "SELECT expiry_date, config FROM users WHERE user_id=?",
             (user_id,)
@@ -419,10 +565,60 @@ async def get_user_data(user_id: int):
             return row
         return None
 
+class UserSnapshot:
+    """Всё, что хендлерам нужно знать о пользователе, одним запросом (get_user_snapshot)"""
+
+    __slots__ = ('user_id', 'expiry_date', 'config', 'trial_used', 'referrer_id', 'referral_balance',
+                 'has_paid', 'is_active')
+
+    def __init__(self, user_id: int, expiry_date, config, trial_used, referrer_id, referral_balance, has_paid):
+        self.user_id = user_id
+        self.expiry_date = expiry_date
+        self.config = config
+        self.trial_used = bool(trial_used)
+        self.referrer_id = referrer_id
+        self.referral_balance = round(float(referral_balance or 0), 2)
+        # Была ли когда-либо платная (не пробная) подписка
+        self.has_paid = bool(has_paid)
+        # Подписка действует сейчас (то же, что check_user_payment)
+        self.is_active = is_subscription_active_check(expiry_date)
+
+    @property
+    def has_subscription(self) -> bool:
+        """Есть данные подписки — активной или истекшей (то же, что непустой get_user_data)"""
+        return bool(self.expiry_date)
+
+    @property
+    def user_data(self):
+        """(expiry_date, config) как у get_user_data или None"""
+        return (self.expiry_date, self.config) if self.expiry_date else None
+
+    def __repr__(self) -> str:
+        return f"UserSnapshot(user_id={self.user_id}, active={self.is_active}, paid={self.has_paid})"
+
+
+async def get_user_snapshot(user_id: int) -> UserSnapshot:
+    """Подписка, данные из bot_users и наличие платных оплат одним запросом.
+
+    Все части выбираются по первичному ключу или по idx_payments_user_method,
+    строка возвращается, даже если пользователя нет ни в одной таблице.
+    """
+    async with connect_db() as conn:
+        cursor = await conn.execute(
+            f"""SELECT u.expiry_date, u.config, b.trial_used, b.referrer_id, b.referral_balance,
+                      EXISTS (SELECT 1 FROM payments p WHERE p.user_id = k.user_id AND {PAID_PAYMENT_SQL})
+               FROM (SELECT ? AS user_id) k
+               LEFT JOIN users u ON u.user_id = k.user_id
+               LEFT JOIN bot_users b ON b.user_id = k.user_id""",
+            (user_id,)
+        )
+        row = await cursor.fetchone()
+    return UserSnapshot(user_id, *row)
+
 async def extend_vpn_config(user_id: int, days: int) -> bool:
     """Продлевает конфигурацию VPN на сервере"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             cursor = await conn.execute(
                 "SELECT config FROM users WHERE user_id=?",
                 (user_id,)
@@ -434,7 +630,7 @@ async def extend_vpn_config(user_id: int, days: int) -> bool:
                 
             config_id = row[0].strip('"\'')  # Удаляем лишние кавычки
             
-        async with aiohttp.ClientSession() as session:
+        async with aiohttp.ClientSession(trace_configs=[http_trace_config('panel')]) as session:
             async with session.post(
                 "https://shardtg.ru/extendconfig",
                 json={
@@ -459,7 +655,7 @@ async def extend_vpn_config(user_id: int, days: int) -> bool:
 
 async def get_all_users(limit: int = 50, offset: int = 0):
     """Получает всех пользователей с пагинацией"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         cursor = await conn.execute(
             """SELECT user_id, subscribed, payment_date, expiry_date, config, last_update 
                FROM users ORDER BY payment_date DESC LIMIT ? OFFSET ?""",
@@ -469,7 +665,7 @@ async def get_all_users(limit: int = 50, offset: int = 0):
 
 async def get_user_stats():
     """Получает статистику пользователей"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         stats = {}
         
         # Всего пользователей бота (кто запускал /start)
@@ -539,100 +735,10 @@ def is_subscription_active_check(expiry_date_str: str) -> bool:
         logging.error(f"Ошибка проверки даты {expiry_date_str}: {e}")
         return False
 
-async def get_users_by_status(status: str, limit: int = 20):
-    """Получает пользователей по статусу"""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            "SELECT user_id, expiry_date, subscribed FROM users ORDER BY payment_date DESC"
-        )
-        all_users = await cursor.fetchall()
-        
-        result = []
-        count = 0
-        
-        for user_id, expiry_date, subscribed in all_users:
-            if count >= limit:
-                break
-                
-            is_active = False
-            if expiry_date and subscribed:
-                is_active = is_subscription_active_check(expiry_date)
-            
-            if status == "active" and is_active:
-                result.append((user_id, expiry_date))
-                count += 1
-            elif status == "expired" and subscribed and not is_active and expiry_date:
-                result.append((user_id, expiry_date))
-                count += 1
-            elif status == "expiring" and is_active and expiry_date:
-                # Проверяем, истекает ли в ближайшие 3 дня
-                try:
-                    formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                    for fmt in formats:
-                        try:
-                            exp_date = datetime.strptime(expiry_date, fmt)
-                            days_left = (exp_date - datetime.now()).days
-                            if 0 <= days_left <= 3:
-                                result.append((user_id, expiry_date))
-                                count += 1
-                            break
-                        except ValueError:
-                            continue
-                except:
-                    pass
-        
-        return result
-
-async def get_users_expiring_in_days(days: int = 2, limit: int = 100):
-    """Возвращает пользователей, у кого подписка истекает через days дней, и кто ещё не уведомлён"""
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT user_id, expiry_date FROM users WHERE subscribed = 1 AND expiry_date IS NOT NULL AND COALESCE(notified_expiring_2d, 0) = 0"
-            )
-            rows = await cursor.fetchall()
-
-        result = []
-        now = datetime.now()
-
-        for user_id, expiry_date in rows:
-            if not expiry_date:
-                continue
-            for fmt in ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']:
-                try:
-                    exp = datetime.strptime(expiry_date, fmt)
-                    delta_days = (exp.date() - now.date()).days
-                    if delta_days == days:
-                        result.append((user_id, exp.strftime('%d.%m.%Y %H:%M')))
-                    break
-                except ValueError:
-                    continue
-            if len(result) >= limit:
-                break
-
-        return result
-    except Exception as e:
-        logging.error(f"Ошибка get_users_expiring_in_days: {e}")
-        return []
-
-async def mark_user_notified_expiring(user_id: int, field: str):
-    """Ставит флаг уведомления по полю (например, notified_expiring_3d)"""
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute(
-                f"UPDATE users SET {field} = 1 WHERE user_id = ?",
-                (user_id,)
-            )
-            await conn.commit()
-            return True
-    except Exception as e:
-        print(f"Ошибка mark_user_notified_expiring: {e}")
-        return False
-
 async def get_all_users_expiring_in_days(days: int, limit: int = 100):
     """Возвращает всех пользователей с подпиской, у кого подписка истекает через days дней"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             # Определяем поле для проверки уведомления
             if days == 3:
                 notification_field = "COALESCE(u.notified_3d, 0) = 0"
@@ -680,34 +786,88 @@ async def get_all_users_expiring_in_days(days: int, limit: int = 100):
         logging.error(f"Ошибка get_all_users_expiring_in_days: {e}")
         return []
 
-async def mark_user_notified(user_id: int, notification_type: str):
-    """Ставит флаг уведомления для пользователя"""
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            field_map = {
-                '2d': 'notified_expiring_2d',
-                '3d': 'notified_3d',
-                '1d': 'notified_1d', 
-                'expired': 'notified_expired'
-            }
-            field = field_map.get(notification_type)
-            if field:
-                await conn.execute(
-                    f"UPDATE users SET {field} = 1 WHERE user_id = ?",
-                    (user_id,)
-                )
+class NotificationFlagBuffer:
+    """Копит отметки об отправленных уведомлениях и пишет их в БД пачками.
+
+    Одна транзакция на сброс, в ней по одному executemany на тип уведомления.
+    Отметка ставится, только если дата окончания не изменилась с момента отправки,
+    чтобы отложенная запись не погасила флаги, сброшенные продлением.
+    """
+
+    def __init__(self):
+        self._pending = defaultdict(list)
+        self._size = 0
+        self._full = asyncio.Event()
+        self._task = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, user_id: int, notification_type: str, expiry_at: str = None) -> bool:
+        if notification_type not in NOTIFICATION_FLAGS:
+            return False
+        self._pending[notification_type].append((user_id, expiry_at, expiry_at))
+        self._size += 1
+        if self._size >= FLAG_FLUSH_SIZE:
+            self._full.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later(), name="notification_flags_flush")
+        return True
+
+    async def _flush_later(self):
+        # Пока буфер пополняется во время записи — продолжаем сбрасывать
+        while self._size:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=FLAG_FLUSH_DELAY)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Записывает накопленные отметки, возвращает их количество"""
+        if not self._size:
+            return 0
+        pending, size = self._pending, self._size
+        self._pending, self._size = defaultdict(list), 0
+        self._full.clear()
+        try:
+            async with connect_db() as conn:
+                for notification_type, rows in pending.items():
+                    # Имя колонки берётся только из NOTIFICATION_FLAGS
+                    column = NOTIFICATION_FLAGS[notification_type]
+                    await conn.executemany(
+                        f"UPDATE users SET {column} = 1 WHERE user_id = ? AND (? IS NULL OR expiry_at = ?)",
+                        rows
+                    )
                 await conn.commit()
-                return True
-        return False
-    except Exception as e:
-        logging.error(f"Ошибка mark_user_notified: {e}")
-        return False
+            return size
+        except Exception as e:
+            logging.error(f"Ошибка записи флагов уведомлений ({size} шт.): {e}")
+            # Вернём в буфер, запишем при следующем сбросе
+            for notification_type, rows in pending.items():
+                self._pending[notification_type].extend(rows)
+            self._size += size
+            return 0
+
+
+notification_flags = NotificationFlagBuffer()
+
+async def mark_user_notified(user_id: int, notification_type: str, expiry_at: str = None):
+    """Ставит флаг уведомления для пользователя (запись в БД пачкой, см. NotificationFlagBuffer)
+
+    expiry_at — дата окончания ('YYYY-MM-DD HH:MM'), о которой уведомили.
+    """
+    return notification_flags.add(user_id, notification_type, expiry_at)
+
+async def flush_notification_flags() -> int:
+    """Немедленно записывает накопленные флаги уведомлений (при остановке бота)"""
+    return await notification_flags.flush()
 
 
 async def get_payment_stats():
     """Получает статистику платежей"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             stats = {}
             
             # Доход за сегодня
@@ -784,16 +944,18 @@ async def get_payment_stats():
 
 async def delete_user(user_id: int):
     """Удаляет пользователя из БД"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         await conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
         await conn.execute("DELETE FROM payments WHERE user_id = ?", (user_id,))
         await conn.execute("DELETE FROM bot_users WHERE user_id = ?", (user_id,))
         await conn.commit()
+        expiry_scheduler.unschedule(user_id)
         return True
 
+@serialized_per_user
 async def extend_user_subscription(user_id: int, days: int):
     """Продлевает подписку пользователя"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         cursor = await conn.execute(
             "SELECT expiry_date FROM users WHERE user_id = ?",
             (user_id,)
@@ -817,10 +979,11 @@ async def extend_user_subscription(user_id: int, days: int):
                     new_expiry = current_expiry + timedelta(days=days)
 
                     await conn.execute(
-                        "UPDATE users SET expiry_date = ?, subscribed = 1, notified_expiring_2d = 0 WHERE user_id = ?",
+                        f"UPDATE users SET expiry_date = ?, subscribed = 1, {RESET_NOTIFICATION_FLAGS_SQL} WHERE user_id = ?",
                         (new_expiry.strftime('%d.%m.%Y %H:%M'), user_id)
                     )
                     await conn.commit()
+                    expiry_scheduler.reschedule(user_id, new_expiry)
 
                     # Пытаемся продлить на VPN сервере (в днях)
                     await extend_vpn_config(user_id, days)
@@ -834,7 +997,7 @@ async def extend_user_subscription(user_id: int, days: int):
 
 async def find_user_by_id(user_id: int):
     """Находит пользователя по ID"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         cursor = await conn.execute(
             """SELECT user_id, subscribed, payment_date, expiry_date, config, last_update 
                FROM users WHERE user_id = ?""",
@@ -844,17 +1007,18 @@ async def find_user_by_id(user_id: int):
 
 async def block_user(user_id: int):
     """Блокирует пользователя"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         await conn.execute(
             "UPDATE users SET subscribed = 0 WHERE user_id = ?",
             (user_id,)
         )
         await conn.commit()
+        expiry_scheduler.unschedule(user_id)
         return True
 
 async def unblock_user(user_id: int):
     """Разблокирует пользователя"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         cursor = await conn.execute(
             "SELECT expiry_date FROM users WHERE user_id = ?",
             (user_id,)
@@ -880,11 +1044,13 @@ async def unblock_user(user_id: int):
                         (user_id,)
                     )
                     await conn.commit()
+                    expiry_scheduler.reschedule(user_id, expiry_date)
                     return True
             except Exception as e:
                 logging.error(f"Ошибка разблокировки пользователя: {e}")
         return False
 
+@serialized_per_user
 async def give_user_subscription(user_id: int, days: int):
     """Выдает подписку пользователю (создает новую запись)"""
     try:
@@ -901,7 +1067,7 @@ async def give_user_subscription(user_id: int, days: int):
             logging.error(f"Не удалось получить конфиг для user_id={user_id}")
             return False
         
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             # Создаем новую подписку
             await conn.execute('''
                 INSERT OR REPLACE INTO users 
@@ -928,6 +1094,7 @@ async def give_user_subscription(user_id: int, days: int):
             )
             
             await conn.commit()
+            expiry_scheduler.reschedule(user_id, expiry_date)
             logging.info(f"Админская подписка выдана пользователю {user_id} на {days} дней. До {expiry_date.strftime('%d.%m.%Y %H:%M')}")
             return True
             
@@ -937,28 +1104,31 @@ async def give_user_subscription(user_id: int, days: int):
 
 
 
+@serialized_per_user
 async def deactivate_user_subscription(user_id: int):
     """Деактивирует подписку пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             # Устанавливаем дату окончания на вчера
             yesterday = datetime.now() - timedelta(days=1)
             
             await conn.execute(
-                "UPDATE users SET subscribed = 0, expiry_date = ?, notified_expiring_2d = 0 WHERE user_id = ?",
+                f"UPDATE users SET subscribed = 0, expiry_date = ?, {RESET_NOTIFICATION_FLAGS_SQL} WHERE user_id = ?",
                 (yesterday.strftime('%d.%m.%Y %H:%M'), user_id)
             )
             await conn.commit()
+            expiry_scheduler.unschedule(user_id)
             logging.info(f"Подписка пользователя {user_id} деактивирована. Дата окончания установлена на {yesterday.strftime('%d.%m.%Y %H:%M')}")
             return True
     except Exception as e:
         logging.error(f"Ошибка деактивации подписки: {e}")
         return False
 
+@serialized_per_user
 async def activate_user_subscription(user_id: int):
     """Активирует подписку пользователя (если дата не истекла критично)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             cursor = await conn.execute(
                 "SELECT expiry_date FROM users WHERE user_id = ?",
                 (user_id,)
@@ -986,6 +1156,7 @@ async def activate_user_subscription(user_id: int):
                                 (user_id,)
                             )
                             await conn.commit()
+                            expiry_scheduler.reschedule(user_id, expiry_date)
                             
                             # Пытаемся активировать на VPN сервере
                             await extend_vpn_config(user_id, max(1, -days_expired))
@@ -996,10 +1167,11 @@ async def activate_user_subscription(user_id: int):
                             # Если истекла давно, продлеваем на 7 дней от текущей даты
                             new_expiry = datetime.now() + timedelta(days=7)
                             await conn.execute(
-                                "UPDATE users SET subscribed = 1, expiry_date = ?, notified_expiring_2d = 0 WHERE user_id = ?",
+                                f"UPDATE users SET subscribed = 1, expiry_date = ?, {RESET_NOTIFICATION_FLAGS_SQL} WHERE user_id = ?",
                                 (new_expiry.strftime('%d.%m.%Y %H:%M'), user_id)
                             )
                             await conn.commit()
+                            expiry_scheduler.reschedule(user_id, new_expiry)
                             
                             # Продлеваем на VPN сервере
                             await extend_vpn_config(user_id, 7)
@@ -1025,7 +1197,7 @@ async def generate_referral_code(user_id: int) -> str:
     code_data = f"{user_id}_{random.randint(1000, 9999)}"
     code = hashlib.md5(code_data.encode()).hexdigest()[:8].upper()
     
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         # Проверяем уникальность кода
         cursor = await conn.execute(
             "SELECT user_id FROM bot_users WHERE referral_code = ?",
@@ -1048,7 +1220,7 @@ async def generate_referral_code(user_id: int) -> str:
 
 async def get_referral_code(user_id: int) -> str:
     """Получает реферальный код пользователя или создает новый"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         cursor = await conn.execute(
             "SELECT referral_code FROM bot_users WHERE user_id = ?",
             (user_id,)
@@ -1065,7 +1237,7 @@ async def add_referral(referrer_id: int, referred_id: int) -> bool:
     try:
         current_time = datetime.now().strftime('%d.%m.%Y %H:%M')
         
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             # Проверяем, что реферал еще не был добавлен
             cursor = await conn.execute(
                 "SELECT id FROM referrals WHERE referred_id = ?",
@@ -1103,7 +1275,7 @@ async def add_referral(referrer_id: int, referred_id: int) -> bool:
 
 async def get_referral_stats(user_id: int) -> dict:
     """Получает статистику рефералов пользователя"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         # Общее количество рефералов
         cursor = await conn.execute(
             "SELECT COUNT(*) FROM referrals WHERE referrer_id = ?",
@@ -1139,7 +1311,7 @@ async def get_referral_stats(user_id: int) -> dict:
 
 async def get_referral_earnings(user_id: int) -> float:
     """Получает общий заработок пользователя с рефералов"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         cursor = await conn.execute(
             "SELECT COALESCE(SUM(reward_amount), 0) FROM referrals WHERE referrer_id = ? AND reward_given = 1",
             (user_id,)
@@ -1149,7 +1321,7 @@ async def get_referral_earnings(user_id: int) -> float:
 
 async def get_referral_details(user_id: int) -> list:
     """Получает детальную информацию о рефералах пользователя для админки"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         cursor = await conn.execute(
             """SELECT 
                 r.referred_id,
@@ -1172,7 +1344,7 @@ async def get_referral_details(user_id: int) -> list:
 
 async def get_all_referral_stats() -> dict:
     """Получает общую статистику рефералов для админки"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with connect_db() as conn:
         # Общее количество рефералов
         cursor = await conn.execute("SELECT COUNT(*) FROM referrals")
         total_referrals = (await cursor.fetchone())[0]
@@ -1221,11 +1393,11 @@ async def get_all_referral_stats() -> dict:
         }
 
 async def has_paid_subscription(user_id: int) -> bool:
-    """Проверяет, была ли у пользователя когда-либо платная подписка"""
+    """Проверяет, оплачивал ли пользователь когда-либо подписку (PAID_PAYMENT_SQL)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             cursor = await conn.execute(
-                "SELECT 1 FROM payments WHERE user_id = ? AND payment_method != 'trial' LIMIT 1",
+                f"SELECT 1 FROM payments WHERE user_id = ? AND {PAID_PAYMENT_SQL} LIMIT 1",
                 (user_id,)
             )
             result = await cursor.fetchone()
@@ -1237,7 +1409,7 @@ async def has_paid_subscription(user_id: int) -> bool:
 async def has_used_trial(user_id: int) -> bool:
     """Проверяет, использовал ли пользователь пробный период"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             cursor = await conn.execute(
                 "SELECT trial_used FROM bot_users WHERE user_id = ?",
                 (user_id,)
@@ -1248,39 +1420,78 @@ async def has_used_trial(user_id: int) -> bool:
         logging.error(f"Ошибка has_used_trial: {e}")
         return False
 
-async def grant_trial_14d(user_id: int) -> bool:
-    """Выдаёт пробный доступ на 14 дней единожды"""
-    try:
-        # если нет записи в bot_users — создаём
-        await add_bot_user(user_id)
+@serialized_per_user
+async def grant_trial_14d(user_id: int, username: str = None, first_name: str = None, last_name: str = None) -> bool:
+    """Выдаёт пробный доступ на 14 дней единожды.
 
-        # проверяем, не использовал ли триал ранее
-        if await has_used_trial(user_id):
+    Триал сначала атомарно «занимается» условным UPDATE (trial_used 0 -> 1), и только
+    после этого запрашивается конфиг у панели. Если панель не выдала конфиг, флаг откатывается.
+    """
+    now = datetime.now()
+    current_time = now.strftime('%d.%m.%Y %H:%M')
+    try:
+        async with connect_db() as conn:
+            # если нет записи в bot_users — создаём
+            await conn.execute(
+                "INSERT OR IGNORE INTO bot_users (user_id, username, first_name, last_name, first_interaction, last_interaction) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, username, first_name, last_name, current_time, current_time)
+            )
+            # занимаем триал: только если он не использован и нет платной подписки
+            cursor = await conn.execute(
+                """UPDATE bot_users SET trial_used = 1, last_interaction = ?
+                   WHERE user_id = ? AND COALESCE(trial_used, 0) = 0
+                   AND NOT EXISTS (SELECT 1 FROM payments WHERE user_id = ? AND payment_method != 'trial')""",
+                (current_time, user_id, user_id)
+            )
+            claimed = cursor.rowcount == 1
+            await conn.commit()
+        if not claimed:
             return False
+    except Exception as e:
+        logging.error(f"Ошибка grant_trial_14d: {e}", exc_info=True)
+        return False
 
-        # выдаём подписку на 14 дней через унифицированный путь
-        success = await give_user_subscription(user_id, 14)
-        if not success:
+    try:
+        config_id = await get_vpn_config_days(user_id, 14)
+        if not config_id:
+            logging.error(f"Не удалось получить конфиг для user_id={user_id}")
+            await _release_trial_claim(user_id)
             return False
 
-        # отмечаем триал как использованный
-        async with aiosqlite.connect(DB_PATH) as conn:
+        expiry_date = now + timedelta(days=14)
+        async with connect_db() as conn:
             await conn.execute(
-                "UPDATE bot_users SET trial_used = 1 WHERE user_id = ?",
-                (user_id,)
+                """INSERT OR REPLACE INTO users
+                   (user_id, subscribed, payment_date, expiry_date, config, last_update, notified_expiring_2d)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (user_id, True, current_time, expiry_date.strftime('%d.%m.%Y %H:%M'), config_id, current_time, 0)
             )
             # логируем псевдо-платёж типа trial для аналитики
-            now = datetime.now().strftime('%d.%m.%Y %H:%M')
             await conn.execute(
                 "INSERT INTO payments (user_id, amount, period, payment_date, payment_method) VALUES (?, ?, ?, ?, ?)",
-                (user_id, 0, 0, now, 'trial')
+                (user_id, 0, 0, current_time, 'trial')
             )
             await conn.commit()
+        expiry_scheduler.reschedule(user_id, expiry_date)
+        logging.info(f"Пробный доступ выдан пользователю {user_id} до {expiry_date.strftime('%d.%m.%Y %H:%M')}")
         return True
     except Exception as e:
         logging.error(f"Ошибка grant_trial_14d: {e}", exc_info=True)
+        await _release_trial_claim(user_id)
         return False
 
+async def _release_trial_claim(user_id: int) -> None:
+    """Возвращает триал, если выдать конфиг не удалось, чтобы пользователь мог попробовать ещё раз"""
+    try:
+        async with connect_db() as conn:
+            await conn.execute(
+                "UPDATE bot_users SET trial_used = 0 WHERE user_id = ?",
+                (user_id,)
+            )
+            await conn.commit()
+    except Exception as e:
+        logging.error(f"Не удалось откатить trial_used для {user_id}: {e}")
+
 def calculate_amount_for_period(period_months: int) -> int:
     """Возвращает сумму в рублях для периода (0 => спец 7 дней = 1₽)."""
     if period_months == 0:
@@ -1295,7 +1506,7 @@ async def attach_referrer_chain(new_user_id: int, referrer_1_id: int) -> bool:
     if new_user_id == referrer_1_id:
         return False
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             # Проверяем, нет ли уже привязки
             cursor = await conn.execute(
                 "SELECT referrer_id FROM bot_users WHERE user_id = ?",
@@ -1349,45 +1560,48 @@ async def attach_referrer_chain(new_user_id: int, referrer_1_id: int) -> bool:
 async def get_uplines(user_id: int):
     """Возвращает кортеж (lvl1, lvl2, lvl3) для данного пользователя."""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            # lvl1
-            cursor = await conn.execute(
-                "SELECT referrer_id FROM bot_users WHERE user_id = ?",
-                (user_id,)
-            )
-            row = await cursor.fetchone()
-            lvl1 = row[0] if row and row[0] else None
-            lvl2 = None
-            lvl3 = None
-            if lvl1:
-                cursor = await conn.execute(
-                    "SELECT referrer_id FROM bot_users WHERE user_id = ?",
-                    (lvl1,)
-                )
-                row = await cursor.fetchone()
-                lvl2 = row[0] if row and row[0] else None
-                if lvl2:
-                    cursor = await conn.execute(
-                        "SELECT referrer_id FROM bot_users WHERE user_id = ?",
-                        (lvl2,)
-                    )
-                    row = await cursor.fetchone()
-                    lvl3 = row[0] if row and row[0] else None
-            return (lvl1, lvl2, lvl3)
+        async with connect_db() as conn:
+            return await _fetch_uplines(conn, user_id)
     except Exception as e:
         logging.error(f"Ошибка get_uplines: {e}")
         return (None, None, None)
 
+async def _fetch_uplines(conn, user_id: int):
+    """Поднимает три уровня рефереров одним запросом на переданном соединении."""
+    cursor = await conn.execute(
+        """SELECT b1.referrer_id, b2.referrer_id, b3.referrer_id
+           FROM bot_users b1
+           LEFT JOIN bot_users b2 ON b2.user_id = b1.referrer_id
+           LEFT JOIN bot_users b3 ON b3.user_id = b2.referrer_id
+           WHERE b1.user_id = ?""",
+        (user_id,)
+    )
+    row = await cursor.fetchone()
+    if not row:
+        return (None, None, None)
+    lvl1 = row[0] or None
+    lvl2 = (row[1] or None) if lvl1 else None
+    lvl3 = (row[2] or None) if lvl2 else None
+    return (lvl1, lvl2, lvl3)
+
+# Фоновые задачи отправки реферальных уведомлений (держим ссылки, чтобы их не собрал GC)
+referral_notification_tasks = set()
+
 async def accrue_referral_commissions(payer_id: int, amount_rub: float, method: str = 'unknown', bot=None) -> None:
-    """Начисляет вознаграждения трём уровням (35%/10%/5%) и пишет лог."""
+    """Начисляет вознаграждения трём уровням (35%/10%/5%) и пишет лог.
+
+    Все уровни записываются одной короткой транзакцией (UPDATE ... RETURNING балансов +
+    executemany в referral_rewards), уведомления рефереров отправляются отдельной задачей уже после commit.
+    """
     try:
         if amount_rub is None or amount_rub <= 0:
             return
-        lvl1, lvl2, lvl3 = await get_uplines(payer_id)
         shares = [0.35, 0.10, 0.05]
-        beneficiaries = [lvl1, lvl2, lvl3]
         now = datetime.now().strftime('%d.%m.%Y %H:%M')
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
+            beneficiaries = await _fetch_uplines(conn, payer_id)
+
+            rewards = []
             for level, (beneficiary, share) in enumerate(zip(beneficiaries, shares), start=1):
                 if not beneficiary:
                     continue
@@ -1396,47 +1610,79 @@ async def accrue_referral_commissions(payer_id: int, amount_rub: float, method:
                 reward = round(amount_rub * share, 2)
                 if reward <= 0:
                     continue
-                await conn.execute(
-                    "UPDATE bot_users SET referral_balance = COALESCE(referral_balance, 0) + ? WHERE user_id = ?",
-                    (reward, beneficiary)
-                )
-                await conn.execute(
-                    "INSERT INTO referral_rewards (payer_id, beneficiary_id, level, amount, created_at, method) VALUES (?, ?, ?, ?, ?, ?)",
-                    (payer_id, beneficiary, level, reward, now, method)
-                )
-                
-                # Отправляем уведомление рефереру
-                if bot:
-                    try:
-                        # Получаем новый баланс
-                        cursor = await conn.execute(
-                            "SELECT referral_balance FROM bot_users WHERE user_id = ?",
-                            (beneficiary,)
-                        )
-                        new_balance = (await cursor.fetchone())[0]
-                        
-                        # Определяем период подписки
-                        period_text = "7 дней" if amount_rub == 1 else f"{int(amount_rub/99)} мес." if amount_rub >= 99 else f"{int(amount_rub/279)} мес." if amount_rub >= 279 else f"{int(amount_rub/549)} мес." if amount_rub >= 549 else f"{int(amount_rub/999)} мес."
-                        
-                        # Определяем процент
-                        percentage = int(share * 100)
-                        
-                        notification_text = f"""🎁 <b>Ваше реферальное вознаграждение!</b>
+                rewards.append((payer_id, beneficiary, level, reward, now, method))
+
+            if not rewards:
+                return
+
+            # Одним UPDATE на все уровни; одному пользователю на нескольких уровнях — сумма.
+            # Только существующим пользователям: реферер мог быть удалён, а фантомная
+            # строка bot_users попала бы в сегменты рассылок и статистику
+            totals = {}
+            for _, beneficiary, _, reward, _, _ in rewards:
+                totals[beneficiary] = totals.get(beneficiary, 0) + reward
+            cases = ' '.join('WHEN ? THEN ?' for _ in totals)
+            params = [value for item in totals.items() for value in item] + list(totals)
+            cursor = await conn.execute(
+                f"""UPDATE bot_users
+                    SET referral_balance = COALESCE(referral_balance, 0) + CASE user_id {cases} END
+                    WHERE user_id IN ({', '.join('?' for _ in totals)})
+                    RETURNING user_id, referral_balance""",
+                params
+            )
+            balances = {user_id: balance or 0 for user_id, balance in await cursor.fetchall()}
+            skipped = set(totals) - set(balances)
+            if skipped:
+                logging.warning(f"Реферальное вознаграждение не начислено: нет пользователей {sorted(skipped)}")
+            rewards = [reward for reward in rewards if reward[1] in balances]
+            if not rewards:
+                await conn.rollback()
+                return
+
+            await conn.executemany(
+                "INSERT INTO referral_rewards (payer_id, beneficiary_id, level, amount, created_at, method) VALUES (?, ?, ?, ?, ?, ?)",
+                rewards
+            )
+            await conn.commit()
+
+        # Уведомления отправляем вне транзакции, чтобы медленный Telegram не держал блокировку БД
+        if bot:
+            notifications = [
+                (beneficiary, level, reward, shares[level - 1], balances[beneficiary])
+                for _, beneficiary, level, reward, _, _ in rewards
+            ]
+            task = asyncio.create_task(_send_referral_notifications(amount_rub, notifications))
+            referral_notification_tasks.add(task)
+            task.add_done_callback(referral_notification_tasks.discard)
+    except Exception as e:
+        logging.error(f"Ошибка accrue_referral_commissions: {e}", exc_info=True)
+
+async def _send_referral_notifications(amount_rub: float, notifications: list) -> None:
+    """Отправляет реферерам уведомления о начислении (после фиксации транзакции)."""
+    # Определяем период подписки
+    period_text = "7 дней" if amount_rub == 1 else f"{int(amount_rub/99)} мес." if amount_rub >= 99 else f"{int(amount_rub/279)} мес." if amount_rub >= 279 else f"{int(amount_rub/549)} мес." if amount_rub >= 549 else f"{int(amount_rub/999)} мес."
+
+    sends = []
+    for beneficiary, level, reward, share, new_balance in notifications:
+        # Определяем процент
+        percentage = int(share * 100)
+
+        notification_text = f"""🎁 <b>Ваше реферальное вознаграждение!</b>
 
 Вы получили <b>{reward:.2f} ₽ ({percentage}%)</b> за покупку <b>{period_text} подписки</b> приглашённым пользователем по {level}-й линии.
 
 💰 <b>Текущий реферальный баланс: {new_balance:.2f}₽</b>"""
-                        
-                        await bot.send_message(
-                            chat_id=beneficiary,
-                            text=notification_text
-                        )
-                    except Exception as e:
-                        logging.error(f"Ошибка отправки уведомления рефереру {beneficiary}: {e}")
-            
-            await conn.commit()
-    except Exception as e:
-        logging.error(f"Ошибка accrue_referral_commissions: {e}", exc_info=True)
+
+        sends.append(delivery.send_message(beneficiary, notification_text, lane=LANE_NOTIFICATION))
+
+    results = await asyncio.gather(*sends, return_exceptions=True)
+    blocked = []
+    for (beneficiary, *_), result in zip(notifications, results):
+        if isinstance(result, TelegramForbiddenError):
+            blocked.append(beneficiary)
+        elif isinstance(result, Exception):
+            logging.error(f"Ошибка отправки уведомления рефереру {beneficiary}: {result}")
+    await mark_bot_blocked(blocked)
 
 async def debug_referral_chain(user_id: int) -> dict:
     """Отладочная функция для проверки реферальной цепочки"""
@@ -1448,7 +1694,7 @@ async def debug_referral_chain(user_id: int) -> dict:
         'level3_refs': []
     }
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             # Получаем реферера пользователя
             cursor = await conn.execute(
                 "SELECT referrer_id FROM bot_users WHERE user_id = ?",
@@ -1493,6 +1739,7 @@ async def debug_referral_chain(user_id: int) -> dict:
     
     return result
 
+@single_flight('referral_overview')
 async def get_referral_overview(user_id: int) -> dict:
     """Возвращает сводку для партнёрской программы: баланс, сегодня, counts по 1/2/3 линиям."""
     result = {
@@ -1507,7 +1754,7 @@ async def get_referral_overview(user_id: int) -> dict:
         debug_info = await debug_referral_chain(user_id)
         
         # Баланс
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             cursor = await conn.execute(
                 "SELECT COALESCE(referral_balance, 0) FROM bot_users WHERE user_id = ?",
                 (user_id,)
@@ -1520,18 +1767,11 @@ async def get_referral_overview(user_id: int) -> dict:
         result['level2'] = len(debug_info['level2_refs'])
         result['level3'] = len(debug_info['level3_refs'])
         
-        # Отладочная информация
-        logging.info(f"Отладка рефералов для {user_id}:")
-        logging.info(f"  Реферер: {debug_info['referrer_id']}")
-        logging.info(f"  1-я линия: {debug_info['level1_refs']} (всего: {result['level1']})")
-        logging.info(f"  2-я линия: {debug_info['level2_refs']} (всего: {result['level2']})")
-        logging.info(f"  3-я линия: {debug_info['level3_refs']} (всего: {result['level3']})")
-        
         # Рефералы за сегодня
         today = datetime.now().strftime('%d.%m.%Y')
         today_count = 0
         
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             # 1-я линия за сегодня
             if debug_info['level1_refs']:
                 cursor = await conn.execute(
@@ -1580,7 +1820,7 @@ async def check_referral_data(user_id: int) -> dict:
     }
     
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with connect_db() as conn:
             # Проверяем, есть ли пользователь в bot_users
             cursor = await conn.execute(
                 "SELECT user_id, referrer_id, first_interaction FROM bot_users WHERE user_id = ?",
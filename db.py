@@ -0,0 +1,50 @@
+import logging
+import sqlite3
+import time
+
+import aiosqlite
+from config import DB_PATH, FSM_STATE_TTL, FSM_CACHE_TTL
+from fsm_storage import SQLiteStorage
+
+# Наблюдатели за SQL: callback(sql, parameters, elapsed_seconds) после каждого выполненного запроса
+query_observers = []
+
+
+class TimedConnection(aiosqlite.Connection):
+    """aiosqlite-соединение, замеряющее время каждого SQL-запроса.
+
+    Все операции aiosqlite (execute/executemany у соединения и курсора) проходят
+    через _execute в задаче вызывающего кода, поэтому наблюдатели видят контекст
+    текущего апдейта (contextvars).
+    """
+
+    async def _execute(self, fn, *args, **kwargs):
+        if not args or not isinstance(args[0], str) or not query_observers:
+            # fetch*/commit и т.п. — не отдельные запросы
+            return await super()._execute(fn, *args, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            return await super()._execute(fn, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            parameters = args[1] if len(args) > 1 else None
+            for observer in query_observers:
+                try:
+                    observer(args[0], parameters, elapsed)
+                except Exception as e:
+                    logging.debug(f"Ошибка наблюдателя SQL: {e}")
+
+
+def connect_db(database: str = None, **kwargs) -> TimedConnection:
+    """Открывает соединение с БД бота (замена aiosqlite.connect(DB_PATH))"""
+    path = database or DB_PATH
+
+    def connector() -> sqlite3.Connection:
+        return sqlite3.connect(path, **kwargs)
+
+    return TimedConnection(connector, 64)
+
+
+# Состояния FSM (диалоги админ-панели и т.п.) — общие для всех процессов и переживают перезапуск
+state_storage = SQLiteStorage(connect_db, ttl=FSM_STATE_TTL, cache_ttl=FSM_CACHE_TTL)
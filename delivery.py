@@ -0,0 +1,317 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from collections import Counter, deque
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+# Очереди исходящих сообщений в порядке приоритета
+LANE_INTERACTIVE = 'interactive'
+LANE_NOTIFICATION = 'notification'
+LANE_BROADCAST = 'broadcast'
+LANES = (LANE_INTERACTIVE, LANE_NOTIFICATION, LANE_BROADCAST)
+
+# Лимиты Telegram: ~30 сообщений/с на бота и ~1 сообщение/с в один чат (короткие всплески допустимы)
+GLOBAL_RATE = 25
+GLOBAL_BURST = 25
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+WORKERS = 8
+BROADCAST_QUEUE_SIZE = 1000
+MAX_RETRY_AFTER_ATTEMPTS = 3
+CHAT_BUCKETS_LIMIT = 10000
+
+# Счётчики доставки (для админки и метрик)
+delivery_stats = Counter()
+
+# Признак того, что запрос к API отправляет воркер сервиса (токен уже списан)
+_queued = contextvars.ContextVar('delivery_queued', default=False)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше burst"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько ждать до появления целого токена"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self) -> float:
+        """Списывает токен без ожидания (баланс может уйти в минус), возвращает нужную паузу"""
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class DeliveryService:
+    """Общий сервис исходящих сообщений Telegram.
+
+    Все отправки проходят через глобальное ведро токенов и темп по чату, при
+    TelegramRetryAfter отправка приостанавливается на указанное время и сообщение
+    повторяется. Очереди обслуживаются по приоритету: интерактивные ответы и
+    уведомления не ждут, пока разойдётся рассылка. Прямые вызовы bot.send_* из
+    хендлеров не ставятся в очередь, но учитываются в общем лимите через
+    middleware сессии.
+    """
+
+    def __init__(self):
+        self._bot = None
+        self._lanes = {lane: deque() for lane in LANES}
+        self._jobs = None
+        self._broadcast_slots = None
+        self._workers = []
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._chats = {}
+        self._paused_until = 0.0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    def queued(self, lane: str = None) -> int:
+        """Количество сообщений в очереди (всего или в одной очереди)"""
+        if lane:
+            return len(self._lanes[lane])
+        return sum(len(queue) for queue in self._lanes.values())
+
+    def start(self, bot, workers: int = WORKERS):
+        """Запускает воркеры доставки (повторный вызов ничего не делает)"""
+        if self.running:
+            return
+        self._bot = bot
+        self._jobs = asyncio.Semaphore(0)
+        self._broadcast_slots = asyncio.Semaphore(BROADCAST_QUEUE_SIZE)
+        bot.session.middleware(DeliveryRequestMiddleware(self))
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"delivery_worker_{i}")
+            for i in range(workers)
+        ]
+
+    async def stop(self, timeout: float = 5.0):
+        """Даёт дослать интерактивные сообщения и уведомления, остальное отменяет"""
+        if not self.running:
+            return
+        deadline = time.monotonic() + timeout
+        while (self._lanes[LANE_INTERACTIVE] or self._lanes[LANE_NOTIFICATION]) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        dropped = 0
+        for queue in self._lanes.values():
+            while queue:
+                _, future, _ = queue.popleft()
+                future.cancel()
+                dropped += 1
+        if dropped:
+            logging.warning(f"Сервис доставки остановлен, не отправлено сообщений: {dropped}")
+
+    def pause(self, seconds: float):
+        """Приостанавливает все отправки (flood control Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def account_direct(self):
+        """Учитывает в общем лимите сообщение, отправленное напрямую из хендлера"""
+        self._global.consume()
+        delivery_stats['sent_direct'] += 1
+
+    async def submit(self, method, lane: str = LANE_INTERACTIVE) -> asyncio.Future:
+        """Ставит метод API (SendMessage, SendPhoto, ...) в очередь, возвращает future с результатом.
+
+        Для очереди рассылки ждёт свободного места, чтобы не держать в памяти всю аудиторию.
+        """
+        if not self.running:
+            raise RuntimeError("Сервис доставки не запущен")
+        if lane == LANE_BROADCAST:
+            await self._broadcast_slots.acquire()
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[lane].append((method, future, 0))
+        self._jobs.release()
+        return future
+
+    async def send(self, method, lane: str = LANE_INTERACTIVE):
+        """Отправляет метод API через очередь и ждёт результата"""
+        return await (await self.submit(method, lane))
+
+    async def send_message(self, chat_id: int, text: str, lane: str = LANE_INTERACTIVE, **kwargs):
+        """Отправляет текстовое сообщение через очередь"""
+        return await self.send(SendMessage(chat_id=chat_id, text=text, **kwargs), lane)
+
+    async def broadcast(self, chat_ids, make_method, on_blocked=None) -> dict:
+        """Рассылка: make_method(chat_id) строит метод API для каждого получателя.
+
+        chat_ids может быть обычным или асинхронным итерируемым. on_blocked(chat_ids) —
+        корутина, получающая заблокировавших бота по окончании. Возвращает
+        статистику в формате {'success', 'failed', 'blocked', 'total'}.
+        """
+        result = Counter()
+        pending = set()
+        blocked = []
+
+        def on_done(future, chat_id):
+            pending.discard(future)
+            if future.cancelled():
+                result['failed'] += 1
+            elif isinstance(future.exception(), TelegramForbiddenError):
+                result['blocked'] += 1
+                blocked.append(chat_id)
+            elif future.exception():
+                result['failed'] += 1
+            else:
+                result['success'] += 1
+
+        async for chat_id in _aiter(chat_ids):
+            method = make_method(chat_id)
+            if method is None:
+                continue
+            future = await self.submit(method, LANE_BROADCAST)
+            result['total'] += 1
+            pending.add(future)
+            future.add_done_callback(functools.partial(on_done, chat_id=chat_id))
+
+        if pending:
+            await asyncio.wait(list(pending))
+        if on_blocked and blocked:
+            await on_blocked(blocked)
+        return {key: result[key] for key in ('success', 'failed', 'blocked', 'total')}
+
+    def _pop(self):
+        for lane in LANES:
+            queue = self._lanes[lane]
+            if queue:
+                method, future, attempts = queue.popleft()
+                # Слот освобождается при первой выдаче; возвращённое после RetryAfter слота уже не держит
+                if lane == LANE_BROADCAST and not attempts:
+                    self._broadcast_slots.release()
+                return lane, (method, future, attempts)
+        return None, None
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= CHAT_BUCKETS_LIMIT:
+                # Забываем чаты, у которых темп уже восстановился
+                self._chats = {key: value for key, value in self._chats.items() if not value.full}
+            bucket = self._chats[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+        return bucket
+
+    async def _wait_for_budget(self):
+        while True:
+            paused = self._paused_until - time.monotonic()
+            if paused > 0:
+                await asyncio.sleep(paused)
+                continue
+            delay = self._global.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            self._global.consume()
+            return
+
+    async def _worker(self):
+        _queued.set(True)
+        while True:
+            await self._jobs.acquire()
+            # Токен берём до выбора сообщения: освободившийся слот достаётся самой приоритетной очереди
+            await self._wait_for_budget()
+            lane, job = self._pop()
+            if job is None:
+                continue
+            try:
+                await self._deliver(lane, *job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка сервиса доставки: {e}", exc_info=True)
+
+    async def _deliver(self, lane: str, method, future: asyncio.Future, attempts: int):
+        if future.done():
+            # Отправитель уже не ждёт результата
+            return
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is not None:
+            wait = self._chat_bucket(chat_id).consume()
+            if wait:
+                await asyncio.sleep(wait)
+        try:
+            result = await self._bot(method)
+        except TelegramRetryAfter as e:
+            delivery_stats['retry_after'] += 1
+            self.pause(e.retry_after)
+            logging.warning(f"Flood control Telegram: пауза {e.retry_after} с (очередь {lane})")
+            if attempts < MAX_RETRY_AFTER_ATTEMPTS:
+                self._lanes[lane].appendleft((method, future, attempts + 1))
+                self._jobs.release()
+                return
+            delivery_stats['failed'] += 1
+            _resolve(future, exception=e)
+        except TelegramForbiddenError as e:
+            delivery_stats['blocked'] += 1
+            _resolve(future, exception=e)
+        except Exception as e:
+            delivery_stats['failed'] += 1
+            delivery_stats[f"failed_{lane}"] += 1
+            _resolve(future, exception=e)
+        else:
+            delivery_stats['sent'] += 1
+            delivery_stats[f"sent_{lane}"] += 1
+            _resolve(future, result=result)
+
+
+class DeliveryRequestMiddleware(BaseRequestMiddleware):
+    """Учитывает прямые отправки бота в общем лимите и ставит паузу при flood control"""
+
+    def __init__(self, service: DeliveryService):
+        self.service = service
+
+    async def __call__(self, make_request, bot, method):
+        if not _queued.get() and type(method).__name__.startswith(('Send', 'Copy', 'Forward')):
+            self.service.account_direct()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.service.pause(e.retry_after)
+            raise
+
+
+def _resolve(future: asyncio.Future, result=None, exception: Exception = None):
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+async def _aiter(iterable):
+    if hasattr(iterable, '__aiter__'):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+delivery = DeliveryService()
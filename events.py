@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class PaymentSucceeded:
+    """Подписка успешно оплачена и уже записана в БД (add_payment вернул True)"""
+    user_id: int
+    chat_id: int
+    period_months: int  # 0 — специальная подписка на 7 дней
+    payment_method: str  # 'yookassa' / 'stars'
+    amount_rub: int
+    was_active: bool = False
+    message_id: Optional[int] = None  # сообщение со ссылкой на оплату, которое нужно удалить
+
+
+class EventBus:
+    """Простая шина доменных событий внутри процесса.
+
+    Каждый подписчик запускается отдельной задачей: подписчики работают параллельно,
+    ошибка одного не влияет на остальных, упавший подписчик перезапускается с паузой.
+    """
+
+    def __init__(self):
+        self._subscribers = defaultdict(list)
+        self._tasks = set()
+
+    def subscribe(self, event_type, retries: int = 2, retry_delay: float = 1.0):
+        """Декоратор для регистрации подписчика на тип события"""
+        def decorator(handler):
+            self._subscribers[event_type].append((handler, retries, retry_delay))
+            return handler
+        return decorator
+
+    def publish(self, event) -> int:
+        """Публикует событие, возвращает количество запущенных подписчиков"""
+        subscribers = self._subscribers.get(type(event), [])
+        for handler, retries, retry_delay in subscribers:
+            task = asyncio.create_task(
+                self._run(handler, event, retries, retry_delay),
+                name=f"{type(event).__name__}:{handler.__name__}"
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        event_stats[f"published_{type(event).__name__}"] += 1
+        return len(subscribers)
+
+    async def _run(self, handler, event, retries: int, retry_delay: float):
+        for attempt in range(retries + 1):
+            try:
+                await handler(event)
+                event_stats[f"handled_{handler.__name__}"] += 1
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt < retries:
+                    logging.warning(f"Подписчик {handler.__name__} упал на {type(event).__name__} (попытка {attempt + 1}): {e}")
+                    await asyncio.sleep(retry_delay * (2 ** attempt))
+                else:
+                    event_stats[f"failed_{handler.__name__}"] += 1
+                    logging.error(f"Подписчик {handler.__name__} не обработал {event}: {e}", exc_info=True)
+
+    @property
+    def pending(self) -> int:
+        """Количество ещё не завершившихся подписчиков"""
+        return len(self._tasks)
+
+    async def shutdown(self, timeout: float = 5.0):
+        """Даёт подписчикам завершиться, оставшиеся отменяет"""
+        if not self._tasks:
+            return
+        tasks = list(self._tasks)
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logging.warning(f"Отменено {len(pending)} незавершённых обработчиков событий")
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+# Счётчики событий и оплат (для админки и метрик)
+event_stats = Counter()
+
+event_bus = EventBus()
+
+
+@event_bus.subscribe(PaymentSucceeded, retries=0)
+async def count_payment(event: PaymentSucceeded):
+    """Обновляет счётчики оплат"""
+    event_stats['payments_total'] += 1
+    event_stats[f"payments_{event.payment_method}"] += 1
+    event_stats['revenue_rub'] += event.amount_rub
@@ -0,0 +1,361 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime, timedelta
+from db import connect_db
+
+# Типы уведомлений: (тип, за сколько до окончания, колонка-флаг в users)
+NOTIFICATION_BUCKETS = (
+    ('3d', timedelta(days=3), 'notified_3d'),
+    ('2d', timedelta(days=2), 'notified_expiring_2d'),
+    ('1d', timedelta(days=1), 'notified_1d'),
+    ('expired', timedelta(0), 'notified_expired'),
+)
+
+# Уведомление «за N дней» актуально сутки после срока, потом уже сработает следующее
+NOTIFICATION_WINDOW = timedelta(days=1)
+
+# Насколько вперёд (по дате окончания) держим подписки в памяти; дальше — догружаем по мере хода времени
+LOAD_HORIZON = timedelta(days=7)
+# Задачи планировщика (scheduler.py): догрузка следующего окна и сверка всего расписания с БД
+REFILL_INTERVAL = 60 * 60
+RELOAD_INTERVAL = 10 * 60
+
+# Неудавшаяся отправка повторяется через RETRY_DELAY × номер попытки; после MAX_SEND_ATTEMPTS
+# уведомление снимается до перезапуска планировщика или смены срока подписки
+MAX_SEND_ATTEMPTS = 5
+RETRY_DELAY = 5 * 60
+
+PAGE_SIZE = 500
+EXPIRY_AT_FORMAT = '%Y-%m-%d %H:%M'
+
+
+class ExpiryNotificationScheduler:
+    """Планировщик уведомлений об окончании подписки на min-куче сроков.
+
+    При старте подгружает из БД (по индексу expiry_at, постранично) только подписки,
+    истекающие в пределах горизонта, и дальше догружает новые окна. Изменения подписки
+    (оплата, продление, выдача, деактивация) передаются через reschedule/unschedule за O(log n);
+    устаревшие записи в куче отбрасываются лениво по номеру версии пользователя.
+    Версии берутся из общего счётчика и не повторяются, поэтому версия хранится,
+    только пока у пользователя есть ожидающие уведомления.
+    Изменения из других процессов бота подхватывает reload — сверкой с БД.
+    Наступившие уведомления отправляются пачкой одновременно (темп задаёт delivery),
+    неудавшиеся повторяются не больше MAX_SEND_ATTEMPTS раз.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._versions = {}  # user_id → версия актуальных записей (только при ожидающих уведомлениях)
+        self._version_seq = itertools.count()
+        self._expiry = {}  # user_id → expiry_at, под который стоят ожидающие уведомления
+        self._pending = {}
+        self._sending = {}  # user_id → число уведомлений, отправляемых прямо сейчас
+        self._failures = {}  # user_id → {(тип, expiry_at): неудачных попыток}
+        self._touched = None  # пользователи, изменённые или уведомлённые во время reload
+        self._loaded_until = None  # граница expiry_at (не включительно), до которой всё загружено
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._send = None
+        self._flush = None
+
+    @property
+    def started(self) -> bool:
+        return self._loaded_until is not None
+
+    def __len__(self) -> int:
+        return sum(self._pending.values())
+
+    def reschedule(self, user_id: int, expiry_date: datetime):
+        """Перепланирует уведомления пользователя под новую дату окончания"""
+        if not self.started:
+            return
+        self._drop_user(user_id)
+        self._failures.pop(user_id, None)
+        expiry_at = expiry_date.strftime(EXPIRY_AT_FORMAT)
+        if expiry_at >= self._loaded_until:
+            # Подгрузится вместе со своим окном
+            return
+        for bucket, _, _ in NOTIFICATION_BUCKETS:
+            self._push(user_id, bucket, expiry_at)
+
+    def unschedule(self, user_id: int):
+        """Снимает все уведомления пользователя (деактивация, блокировка, удаление)"""
+        if self.started:
+            self._drop_user(user_id)
+            self._failures.pop(user_id, None)
+
+    def _drop_user(self, user_id: int):
+        # Записи в куче остаются, но без версии пользователя ни одна из них уже не совпадёт
+        self._versions.pop(user_id, None)
+        self._expiry.pop(user_id, None)
+        self._pending.pop(user_id, None)
+        if self._touched is not None:
+            self._touched.add(user_id)
+
+    def _push(self, user_id: int, bucket: str, expiry_at: str, now: datetime = None):
+        expiry = datetime.strptime(expiry_at, EXPIRY_AT_FORMAT)
+        offset = next(delta for name, delta, _ in NOTIFICATION_BUCKETS if name == bucket)
+        due = expiry - offset
+        now = now or datetime.now()
+        if offset and (now >= expiry or now >= due + NOTIFICATION_WINDOW):
+            # Этот срок уже пропущен — пользователь получит следующее уведомление
+            return
+        if self._failures.get(user_id, {}).get((bucket, expiry_at), 0) >= MAX_SEND_ATTEMPTS:
+            return
+        self._enqueue(user_id, bucket, expiry_at, due.timestamp())
+
+    def _enqueue(self, user_id: int, bucket: str, expiry_at: str, due_ts: float):
+        version = self._versions.get(user_id)
+        if version is None:
+            version = self._versions[user_id] = next(self._version_seq)
+            self._expiry[user_id] = expiry_at
+        seq = next(self._seq)
+        heapq.heappush(self._heap, (due_ts, seq, user_id, version, bucket, expiry_at))
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        if self._heap[0][1] == seq:
+            # Новый ближайший срок — будим цикл
+            self._wakeup.set()
+
+    async def _scan(self, lower: str, until: str):
+        """Подписки с неотправленными уведомлениями и expiry_at в [lower, until), постранично по индексу"""
+        last_expiry, last_user_id = lower, -1
+        flag_columns = ', '.join(flag for _, _, flag in NOTIFICATION_BUCKETS)
+        pending_filter = ' OR '.join(f"COALESCE({flag}, 0) = 0" for _, _, flag in NOTIFICATION_BUCKETS)
+        async with connect_db() as conn:
+            while True:
+                cursor = await conn.execute(
+                    f"""SELECT user_id, expiry_at, {flag_columns}
+                        FROM users
+                        WHERE expiry_at >= ? AND expiry_at < ?
+                          AND (expiry_at > ? OR (expiry_at = ? AND user_id > ?))
+                          AND subscribed = 1 AND ({pending_filter})
+                          AND NOT EXISTS (SELECT 1 FROM bot_users b WHERE b.user_id = users.user_id AND b.blocked_at IS NOT NULL)
+                        ORDER BY expiry_at, user_id
+                        LIMIT ?""",
+                    (lower, until, last_expiry, last_expiry, last_user_id, PAGE_SIZE)
+                )
+                rows = await cursor.fetchall()
+                if rows:
+                    yield rows
+                    last_expiry, last_user_id = rows[-1][1], rows[-1][0]
+                if len(rows) < PAGE_SIZE:
+                    break
+                # Отдаём управление циклу событий между страницами
+                await asyncio.sleep(0)
+
+    def _push_user(self, user_id: int, expiry_at: str, flags, now: datetime):
+        for (bucket, _, _), notified in zip(NOTIFICATION_BUCKETS, flags):
+            if not notified:
+                self._push(user_id, bucket, expiry_at, now)
+
+    async def _load_window(self, until: str):
+        """Догружает подписки с expiry_at в [loaded_until, until)"""
+        loaded = 0
+        now = datetime.now()
+        async for rows in self._scan(self._loaded_until or '', until):
+            for user_id, expiry_at, *flags in rows:
+                self._push_user(user_id, expiry_at, flags, now)
+            loaded += len(rows)
+        self._loaded_until = until
+        if loaded:
+            logging.info(f"Планировщик уведомлений: загружено подписок {loaded} до {until}")
+
+    async def _refill(self):
+        max_offset = max(delta for _, delta, _ in NOTIFICATION_BUCKETS)
+        until = (datetime.now() + max_offset + LOAD_HORIZON).strftime(EXPIRY_AT_FORMAT)
+        if self._loaded_until is None or until > self._loaded_until:
+            await self._load_window(until)
+
+    async def refill(self):
+        """Догружает подписки, вошедшие в горизонт с течением времени"""
+        if self.started:
+            await self._refill()
+
+    async def reload(self):
+        """Сверка с БД загруженного окна: перепланирует только пользователей, чей срок разошёлся.
+
+        Подхватывает изменения подписок, сделанные другими процессами бота
+        (их reschedule не доходит до кучи ведущего процесса). Перед чтением
+        дописываются отметки об отправленных уведомлениях, а пользователи, которых
+        за время чтения перепланировали, уведомили или уведомляют сейчас,
+        не трогаются — в памяти у них данные новее прочитанных.
+        """
+        if not self.started or self._touched is not None:
+            return
+        self._touched = set()
+        try:
+            if self._flush is not None:
+                await self._flush()
+            now = datetime.now()
+            seen = set()
+            changed = 0
+            async for rows in self._scan('', self._loaded_until):
+                for user_id, expiry_at, *flags in rows:
+                    seen.add(user_id)
+                    if self._expiry.get(user_id) == expiry_at:
+                        continue
+                    if user_id in self._touched or user_id in self._sending:
+                        continue
+                    before = self._expiry.get(user_id)
+                    failures = self._failures.get(user_id)
+                    if failures:
+                        # Счётчики попыток остаются только для текущего срока
+                        self._failures[user_id] = {k: n for k, n in failures.items() if k[1] == expiry_at}
+                    self._drop_user(user_id)
+                    self._push_user(user_id, expiry_at, flags, now)
+                    if self._expiry.get(user_id) != before:
+                        changed += 1
+            # Подписки, которых в окне больше нет: деактивированы, продлены за окно или уже уведомлены
+            for user_id in [u for u in self._expiry if u not in seen]:
+                if user_id not in self._touched and user_id not in self._sending:
+                    self._drop_user(user_id)
+                    changed += 1
+            for user_id in [u for u in self._failures if u not in seen and u not in self._expiry]:
+                del self._failures[user_id]
+        finally:
+            self._touched = None
+        if changed:
+            logging.info(f"Планировщик уведомлений: после сверки с БД перепланировано подписок {changed}")
+
+    def _pop_due(self, limit: int = PAGE_SIZE):
+        """Снимает с кучи наступившие и ещё актуальные записи"""
+        now_ts = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now_ts and len(due) < limit:
+            _, _, user_id, version, bucket, expiry_at = heapq.heappop(self._heap)
+            if self._versions.get(user_id) != version:
+                continue
+            left = self._pending.get(user_id, 0) - 1
+            if left > 0:
+                self._pending[user_id] = left
+            else:
+                self._pending.pop(user_id, None)
+                self._versions.pop(user_id, None)
+                self._expiry.pop(user_id, None)
+            due.append((user_id, bucket, expiry_at))
+        return due
+
+    async def _filter_actual(self, due: list) -> list:
+        """Сверяет снятые записи с БД одним запросом по первичному ключу"""
+        user_ids = list({user_id for user_id, _, _ in due})
+        placeholders = ','.join('?' * len(user_ids))
+        flag_columns = ', '.join(flag for _, _, flag in NOTIFICATION_BUCKETS)
+        async with connect_db() as conn:
+            cursor = await conn.execute(
+                f"""SELECT user_id, subscribed, expiry_at, {flag_columns} FROM users
+                    WHERE user_id IN ({placeholders})
+                      AND NOT EXISTS (SELECT 1 FROM bot_users b WHERE b.user_id = users.user_id AND b.blocked_at IS NOT NULL)""",
+                user_ids
+            )
+            rows = {row[0]: row[1:] for row in await cursor.fetchall()}
+
+        actual = []
+        for user_id, bucket, expiry_at in due:
+            row = rows.get(user_id)
+            if not row:
+                continue
+            subscribed, current_expiry_at, *flags = row
+            notified = dict(zip((b for b, _, _ in NOTIFICATION_BUCKETS), flags))
+            if subscribed and current_expiry_at == expiry_at and not notified[bucket]:
+                actual.append((user_id, bucket, expiry_at))
+        return actual
+
+    async def _run(self):
+        while True:
+            try:
+                if not self.started:
+                    await self._refill()
+
+                due = self._pop_due()
+                if due:
+                    await self._send_batch(await self._filter_actual(due))
+                    continue
+
+                timeout = max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка в планировщике уведомлений: {e}", exc_info=True)
+                await asyncio.sleep(60)
+
+    async def _send_one(self, user_id: int, bucket: str, expiry_at: str) -> bool:
+        self._sending[user_id] = self._sending.get(user_id, 0) + 1
+        if self._touched is not None:
+            self._touched.add(user_id)
+        try:
+            return await self._send(user_id, bucket, expiry_at)
+        finally:
+            left = self._sending.pop(user_id) - 1
+            if left:
+                self._sending[user_id] = left
+
+    async def _send_batch(self, batch: list):
+        """Отправляет пачку одновременно и планирует повтор неудавшихся"""
+        results = await asyncio.gather(
+            *(self._send_one(user_id, bucket, expiry_at) for user_id, bucket, expiry_at in batch),
+            return_exceptions=True
+        )
+        for (user_id, bucket, expiry_at), result in zip(batch, results):
+            if isinstance(result, BaseException):
+                logging.error(f"Ошибка отправки уведомления {bucket} пользователю {user_id}: {result}")
+            elif result is not False:
+                failures = self._failures.get(user_id)
+                if failures:
+                    failures.pop((bucket, expiry_at), None)
+                    if not failures:
+                        del self._failures[user_id]
+                continue
+            self._retry_later(user_id, bucket, expiry_at)
+
+    def _retry_later(self, user_id: int, bucket: str, expiry_at: str):
+        if self._expiry.get(user_id, expiry_at) != expiry_at:
+            # Срок уже сменился — старое уведомление не нужно
+            return
+        failures = self._failures.setdefault(user_id, {})
+        attempts = failures[(bucket, expiry_at)] = failures.get((bucket, expiry_at), 0) + 1
+        if attempts >= MAX_SEND_ATTEMPTS:
+            logging.error(f"Уведомление {bucket} пользователю {user_id} не отправлено за {attempts} попыток, снимаем")
+            return
+        self._enqueue(user_id, bucket, expiry_at, time.time() + RETRY_DELAY * attempts)
+
+    def start(self, send, flush=None):
+        """Запускает планировщик.
+
+        send(user_id, notification_type, expiry_at) отправляет уведомление и возвращает
+        False, если отправку стоит повторить; flush() дописывает в БД отложенные отметки об отправленных уведомлениях.
+        """
+        self._send = send
+        self._flush = flush
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="expiry_notifications")
+        return self._task
+
+    async def stop(self):
+        """Останавливает планировщик"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        # При следующем запуске (например, снова став ведущим) расписание загружается из БД заново
+        self._heap.clear()
+        self._versions.clear()
+        self._expiry.clear()
+        self._pending.clear()
+        self._sending.clear()
+        self._failures.clear()
+        self._loaded_until = None
+
+
+expiry_scheduler = ExpiryNotificationScheduler()
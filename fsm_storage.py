@@ -0,0 +1,175 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from metrics import record_cache
+
+# Сколько ключей держит кэш процесса
+CACHE_SIZE = 10000
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS fsm_storage (
+        key TEXT PRIMARY KEY,
+        destiny TEXT NOT NULL,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        expires_at REAL
+    )''',
+    "CREATE INDEX IF NOT EXISTS idx_fsm_storage_destiny ON fsm_storage(destiny)",
+)
+
+
+def _storage_key(key: StorageKey) -> str:
+    return ":".join(str(part) if part is not None else "" for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+    ))
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram в таблице SQLite, общее для всех процессов бота.
+
+    Запись сразу идёт в БД (WAL), чтение — через кэш процесса,
+    которому доверяем cache_ttl секунд (0 — всегда читать из БД). Состояние
+    живёт ttl секунд после последней записи (None — бессрочно); просроченные
+    записи не читаются, удаляет их purge().
+
+    connect — фабрика соединения aiosqlite; соединение одно на хранилище и
+    открывается при первом обращении. Транзакция у соединения тоже одна, поэтому
+    каждая запись от первого оператора до commit() выполняется под _writing:
+    иначе commit() одной корутины зафиксировал бы недоделанную запись другой.
+    """
+
+    def __init__(self, connect, ttl: Optional[float] = None, cache_ttl: float = 0.0, name: str = 'fsm'):
+        self.connect = connect
+        self.ttl = ttl
+        self.cache_ttl = cache_ttl
+        self.name = name
+        self._cache = OrderedDict()  # ключ → (state, data, expires_at, загружено)
+        self._conn = None
+        self._connecting = asyncio.Lock()
+        self._writing = asyncio.Lock()
+
+    async def _db(self):
+        if self._conn is None:
+            async with self._connecting:
+                if self._conn is None:
+                    conn = await self.connect()
+                    for statement in SCHEMA:
+                        await conn.execute(statement)
+                    await conn.commit()
+                    self._conn = conn
+        return self._conn
+
+    async def _read(self, key: StorageKey) -> tuple:
+        raw_key = _storage_key(key)
+        now = time.time()
+        if self.cache_ttl:
+            cached = self._cache.get(raw_key)
+            if cached and time.monotonic() - cached[3] < self.cache_ttl and (cached[2] is None or cached[2] > now):
+                self._cache.move_to_end(raw_key)
+                record_cache(self.name, True)
+                return cached[0], cached[1]
+            record_cache(self.name, False)
+
+        conn = await self._db()
+        cursor = await conn.execute(
+            "SELECT state, data, expires_at FROM fsm_storage WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (raw_key, now)
+        )
+        row = await cursor.fetchone()
+        state, data, expires_at = (row[0], json.loads(row[1]), row[2]) if row else (None, {}, None)
+        self._remember(raw_key, state, data, expires_at)
+        return state, data
+
+    def _remember(self, raw_key: str, state, data: dict, expires_at):
+        if not self.cache_ttl:
+            return
+        self._cache[raw_key] = (state, data, expires_at, time.monotonic())
+        self._cache.move_to_end(raw_key)
+        if len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    async def _write(self, key: StorageKey, **values):
+        """Записывает state и/или data ключа; пустая запись (без состояния и данных) удаляется"""
+        raw_key = _storage_key(key)
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else None
+        columns = {'state': values.get('state'), 'data': json.dumps(values.get('data', {}), ensure_ascii=False)}
+        updates = ", ".join(f"{column} = excluded.{column}" for column in values)
+        conn = await self._db()
+        async with self._writing:
+            # Просроченная запись не должна ожить со старыми данными
+            await conn.execute("DELETE FROM fsm_storage WHERE key = ? AND expires_at <= ?", (raw_key, now))
+            await conn.execute(
+                f'''INSERT INTO fsm_storage (key, destiny, state, data, expires_at) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET {updates}, expires_at = excluded.expires_at''',
+                (raw_key, key.destiny, columns['state'], columns['data'], expires_at)
+            )
+            await conn.execute("DELETE FROM fsm_storage WHERE key = ? AND state IS NULL AND data = '{}'", (raw_key,))
+            await conn.commit()
+
+        cached = self._cache.get(raw_key)
+        if cached:
+            state, data = values.get('state', cached[0]), values.get('data', cached[1])
+            self._remember(raw_key, state, data, expires_at)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._read(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._write(key, data=data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._read(key)
+        return data.copy()
+
+    async def delete(self, key: StorageKey) -> None:
+        """Удаляет состояние и данные ключа"""
+        await self._write(key, state=None, data={})
+
+    async def compare_and_set_state(self, key: StorageKey, expected: Optional[str], state: Optional[str]) -> bool:
+        """Меняет состояние, только если текущее равно expected; True — изменил этот вызов"""
+        raw_key = _storage_key(key)
+        now = time.time()
+        conn = await self._db()
+        async with self._writing:
+            cursor = await conn.execute(
+                """UPDATE fsm_storage SET state = ?, expires_at = ?
+                   WHERE key = ? AND state IS ? AND (expires_at IS NULL OR expires_at > ?)""",
+                (state, now + self.ttl if self.ttl else None, raw_key, expected, now)
+            )
+            await conn.commit()
+        self._cache.pop(raw_key, None)
+        return cursor.rowcount == 1
+
+    async def find(self, destiny_prefix: str) -> list:
+        """Все живые записи, у которых destiny начинается с префикса: [(state, data), ...]"""
+        conn = await self._db()
+        cursor = await conn.execute(
+            "SELECT state, data FROM fsm_storage WHERE destiny GLOB ? AND (expires_at IS NULL OR expires_at > ?)",
+            (destiny_prefix.replace('[', '[[]').replace('*', '[*]').replace('?', '[?]') + '*', time.time())
+        )
+        return [(state, json.loads(data)) for state, data in await cursor.fetchall()]
+
+    async def purge(self) -> int:
+        """Удаляет просроченные записи (периодическая задача планировщика), возвращает их число"""
+        conn = await self._db()
+        async with self._writing:
+            cursor = await conn.execute("DELETE FROM fsm_storage WHERE expires_at <= ?", (time.time(),))
+            await conn.commit()
+        return cursor.rowcount
+
+    async def close(self) -> None:
+        self._cache.clear()
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await conn.close()
@@ -0,0 +1,189 @@
+import contextvars
+import logging
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+import aiohttp
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+from config import UPDATE_LATENCY_BUDGET_MS
+from db import query_observers
+from metrics import update_duration, db_query_duration, external_duration, external_errors
+
+# Сколько последних замеров на хендлер держим для перцентилей
+LATENCY_WINDOW = 1000
+
+
+@dataclass
+class UpdateTrace:
+    """Разбивка времени обработки одного апдейта"""
+    update_id: int
+    handler: str = None
+    sql_count: int = 0
+    sql_time: float = 0.0
+    http_time: dict = field(default_factory=lambda: defaultdict(float))
+
+    def breakdown(self) -> str:
+        parts = [f"SQL: {self.sql_count} запросов, {self.sql_time * 1000:.0f} мс"]
+        parts += [f"{target}: {seconds * 1000:.0f} мс" for target, seconds in self.http_time.items()]
+        return "; ".join(parts)
+
+
+_current_trace = contextvars.ContextVar('update_trace', default=None)
+
+
+class LatencyStats:
+    """Скользящие перцентили задержек по хендлерам"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self.counts = Counter()
+
+    def add(self, name: str, seconds: float):
+        self._samples[name].append(seconds)
+        self.counts[name] += 1
+
+    def percentiles(self, name: str, quantiles=(50, 95, 99)) -> dict:
+        samples = sorted(self._samples.get(name, ()))
+        if not samples:
+            return {}
+        return {f"p{q}": samples[min(len(samples) - 1, len(samples) * q // 100)] for q in quantiles}
+
+    def snapshot(self) -> dict:
+        """{handler: {'count': N, 'p50': с, 'p95': с, 'p99': с}}"""
+        return {name: {'count': self.counts[name], **self.percentiles(name)} for name in self._samples}
+
+
+handler_latency = LatencyStats()
+
+
+def current_trace():
+    """Разбивка текущего апдейта (None вне обработки апдейта)"""
+    return _current_trace.get()
+
+
+def trace_from_stack(frame):
+    """Разбивка апдейта, в обработке которого находится кадр (для семплера из другого потока)"""
+    while frame is not None:
+        if frame.f_code is UpdateTimingMiddleware.__call__.__code__:
+            return frame.f_locals.get('trace')
+        frame = frame.f_back
+    return None
+
+
+def _statement_type(sql: str) -> str:
+    keyword = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    return keyword if keyword in ('SELECT', 'INSERT', 'UPDATE', 'DELETE') else 'OTHER'
+
+
+def _observe_query(sql, parameters, elapsed):
+    db_query_duration.observe(elapsed, _statement_type(sql))
+    trace = _current_trace.get()
+    if trace:
+        trace.sql_count += 1
+        trace.sql_time += elapsed
+
+
+query_observers.append(_observe_query)
+
+
+def record_http(target: str, elapsed: float, failed: bool = False):
+    """Учитывает время внешнего HTTP-вызова (метрики и разбивка текущего апдейта)"""
+    external_duration.observe(elapsed, target)
+    if failed:
+        external_errors.inc(target)
+    trace = _current_trace.get()
+    if trace:
+        trace.http_time[target] += elapsed
+
+
+@contextmanager
+def timed_http(target: str):
+    """Замер синхронного вызова внешнего API (SDK YooKassa)"""
+    started = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        record_http(target, time.perf_counter() - started, failed)
+
+
+def http_trace_config(target: str) -> aiohttp.TraceConfig:
+    """TraceConfig для aiohttp.ClientSession: время запросов учитывается под именем target"""
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params):
+        context.started = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        record_http(target, time.perf_counter() - context.started, params.response.status >= 500)
+
+    async def on_request_exception(session, context, params):
+        record_http(target, time.perf_counter() - context.started, failed=True)
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    """Учитывает время запросов к Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await make_request(bot, method)
+            failed = False
+            return result
+        finally:
+            record_http('telegram', time.perf_counter() - started, failed)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Внутренний middleware: запоминает, какой хендлер обработал апдейт"""
+
+    async def __call__(self, handler, event, data):
+        trace = _current_trace.get()
+        handler_object = data.get('handler')
+        if trace and handler_object:
+            trace.handler = handler_object.callback.__name__
+        return await handler(event, data)
+
+
+class UpdateTimingMiddleware(BaseMiddleware):
+    """Внешний middleware: полное время обработки апдейта с разбивкой по SQL и внешним API"""
+
+    def __init__(self, budget_ms: int = UPDATE_LATENCY_BUDGET_MS):
+        self.budget_ms = budget_ms
+
+    async def __call__(self, handler, event, data):
+        trace = UpdateTrace(update_id=event.update_id)
+        token = _current_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current_trace.reset(token)
+            name = trace.handler or f"unhandled:{event.event_type}"
+            handler_latency.add(name, elapsed)
+            update_duration.observe(elapsed, name)
+            if self.budget_ms and elapsed * 1000 >= self.budget_ms:
+                logging.warning(
+                    f"Медленный апдейт id={trace.update_id} ({name}): {elapsed * 1000:.0f} мс — {trace.breakdown()}"
+                )
+
+
+def setup_instrumentation(dp, bot):
+    """Подключает замеры к диспетчеру и сессии бота"""
+    dp.update.outer_middleware(UpdateTimingMiddleware())
+    for name, observer in dp.observers.items():
+        if name not in ('update', 'error'):
+            observer.middleware(HandlerNameMiddleware())
+    bot.session.middleware(TelegramTimingMiddleware())
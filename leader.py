@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+
+from config import LEADER_LEASE_TTL
+from db import connect_db
+from metrics import registry
+
+leader_changes = registry.counter(
+    'bot_leader_changes_total', "Смены роли процесса (ведущий/ведомый)", ('role',)
+)
+
+
+class LeaderElection:
+    """Выбор одного ведущего процесса через аренду строки в таблице leader_lease.
+
+    Ведущий продлевает аренду каждые ttl/3 секунд; остальные с тем же интервалом
+    пытаются её перехватить, и это удаётся, только когда аренда просрочена.
+    При штатной остановке аренда освобождается сразу, при падении процесса —
+    переходит к другому через ttl секунд. Если продлить аренду не получается
+    (например, БД занята), процесс считает себя ведущим не дольше срока уже
+    полученной аренды и затем слагает полномочия.
+
+    on_elected/on_demoted — корутины запуска и остановки фоновых задач.
+    """
+
+    def __init__(self, name: str = 'jobs', ttl: float = LEADER_LEASE_TTL):
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self._valid_until = 0.0
+        self._task = None
+        self._on_elected = None
+        self._on_demoted = None
+        registry.gauge('bot_leader', "1 — процесс ведёт фоновые задачи", lambda: int(self.is_leader))
+
+    async def _acquire(self) -> bool:
+        """Захватывает или продлевает аренду; True — аренда наша"""
+        now = time.time()
+        async with connect_db() as conn:
+            cursor = await conn.execute(
+                """INSERT INTO leader_lease (name, holder, expires_at) VALUES (?, ?, ?)
+                   ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                   WHERE leader_lease.holder = excluded.holder OR leader_lease.expires_at < ?
+                   RETURNING holder""",
+                (self.name, self.holder, now + self.ttl, now)
+            )
+            acquired = await cursor.fetchone() is not None
+            await conn.commit()
+        return acquired
+
+    async def _release(self):
+        async with connect_db() as conn:
+            await conn.execute("DELETE FROM leader_lease WHERE name = ? AND holder = ?", (self.name, self.holder))
+            await conn.commit()
+
+    async def _run(self):
+        interval = self.ttl / 3
+        while True:
+            started = time.monotonic()
+            try:
+                held = await self._acquire()
+                if held:
+                    self._valid_until = started + self.ttl
+            except Exception as e:
+                logging.warning(f"Не удалось продлить аренду ведущего: {e}")
+                held = self.is_leader and time.monotonic() < self._valid_until
+
+            if held and not self.is_leader:
+                self.is_leader = True
+                leader_changes.inc('leader')
+                logging.info(f"Процесс {self.holder} стал ведущим: запускаем фоновые задачи")
+                await self._call(self._on_elected)
+            elif not held and self.is_leader:
+                self.is_leader = False
+                leader_changes.inc('follower')
+                logging.warning(f"Процесс {self.holder} потерял роль ведущего: останавливаем фоновые задачи")
+                await self._call(self._on_demoted)
+
+            await asyncio.sleep(interval)
+
+    async def _call(self, callback):
+        try:
+            await callback()
+        except Exception as e:
+            logging.error(f"Ошибка при смене роли ведущего: {e}", exc_info=True)
+
+    def start(self, on_elected, on_demoted):
+        """Запускает участие в выборах; задачи запускаются/останавливаются колбэками"""
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        self._task = asyncio.create_task(self._run(), name=f"leader_{self.name}")
+        return self._task
+
+    async def stop(self):
+        """Останавливает задачи (если ведущий) и сразу освобождает аренду для другого процесса"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        if self.is_leader:
+            self.is_leader = False
+            await self._call(self._on_demoted)
+        try:
+            await self._release()
+        except Exception as e:
+            logging.warning(f"Не удалось освободить аренду ведущего: {e}")
+
+
+leader = LeaderElection()
@@ -0,0 +1,110 @@
+import asyncio
+import functools
+import weakref
+
+from metrics import registry
+
+single_flight_calls = registry.counter(
+    'bot_single_flight_calls_total', "Вызовы с объединением одинаковых запросов: выполнены или присоединились к идущему",
+    ('operation', 'result')
+)
+
+
+class KeyedLockRegistry:
+    """Реестр asyncio.Lock по ключу (например, по user_id).
+
+    Блокировка живёт, пока на неё есть ссылки (владелец и ожидающие задачи),
+    после чего запись удаляется из реестра автоматически через weakref.
+    Разные ключи никак не мешают друг другу.
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+
+    def get(self, key) -> asyncio.Lock:
+        """Возвращает блокировку для ключа, создавая её при необходимости"""
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    def locked(self, key) -> bool:
+        """Проверяет, удерживается ли сейчас блокировка для ключа"""
+        lock = self._locks.get(key)
+        return bool(lock and lock.locked())
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+# Общий реестр блокировок для изменений подписки/платежей пользователя
+user_locks = KeyedLockRegistry()
+
+
+def serialized_per_user(func):
+    """Декоратор: сериализует вызовы корутины по первому аргументу (user_id).
+
+    Внутри обёрнутой функции нельзя вызывать другие обёрнутые функции для того же
+    пользователя — asyncio.Lock не реентерабелен, используйте их внутренние версии.
+    """
+    @functools.wraps(func)
+    async def wrapper(user_id, *args, **kwargs):
+        async with user_locks.get(user_id):
+            return await func(user_id, *args, **kwargs)
+    return wrapper
+
+
+class SingleFlight:
+    """Объединение одинаковых одновременных вызовов (single-flight).
+
+    Пока корутина для ключа (операция, аргументы) выполняется, остальные вызовы
+    с тем же ключом не запускают её повторно, а ждут тот же результат или ту же
+    ошибку. После завершения ключ освобождается — это не кэш: следующий вызов
+    снова идёт в БД или API. Результат общий для всех ждущих, поэтому менять
+    его нельзя. Отмена одного из ждущих не прерывает вызов для остальных.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key: tuple, func, *args, **kwargs):
+        """Выполняет func(*args, **kwargs) или присоединяется к уже идущему вызову с тем же ключом"""
+        operation = key[0]
+        task = self._calls.get(key)
+        if task is None:
+            single_flight_calls.inc(operation, 'executed')
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._forget, key))
+        else:
+            single_flight_calls.inc(operation, 'coalesced')
+        return await asyncio.shield(task)
+
+    def _forget(self, key: tuple, task: asyncio.Future):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Ошибку забираем, даже если все ждущие отменены, иначе asyncio предупреждает о ней в логе
+        if not task.cancelled():
+            task.exception()
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+# Общий реестр идущих вызовов для single_flight
+single_flights = SingleFlight()
+
+
+def single_flight(operation: str):
+    """Декоратор: одновременные вызовы корутины с одинаковыми аргументами выполняются один раз.
+
+    Ключ — (operation, аргументы), поэтому аргументы должны быть хешируемыми.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = (operation, args, tuple(sorted(kwargs.items())))
+            return await single_flights.do(key, func, *args, **kwargs)
+        return wrapper
+    return decorator
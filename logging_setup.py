@@ -0,0 +1,161 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+from config import (
+    LOG_FILE, LOG_LEVEL, LOG_LEVELS, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_WHEN,
+    LOG_DEBUG_SAMPLE_LIMIT, LOG_DEBUG_SAMPLE_WINDOW,
+)
+from instrumentation import current_trace
+
+CONSOLE_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+_listener = None
+
+
+class SizedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """Ротация по времени (when) и дополнительно по размеру файла (max_bytes).
+
+    При ротации по размеру внутри одного периода к имени добавляется номер
+    (bot.log.2025-09-10.1), такие файлы тоже удаляются по backupCount.
+    """
+
+    def __init__(self, filename, when='midnight', max_bytes=0, backup_count=0):
+        super().__init__(filename, when=when, backupCount=backup_count, encoding='utf-8')
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes and self.stream is not None:
+            self.stream.seek(0, os.SEEK_END)
+            return self.stream.tell() + len(self.format(record).encode("utf-8")) + 1 >= self.max_bytes
+        return False
+
+    def rotation_filename(self, default_name):
+        name, index = default_name, 0
+        while os.path.exists(name):
+            index += 1
+            name = f"{default_name}.{index}"
+        return super().rotation_filename(name)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON (UTF-8, без экранирования кириллицы)"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key in ('update_id', 'suppressed'):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DebugSampler(logging.Filter):
+    """Пропускает не больше limit DEBUG-записей с одного места вызова за окно window секунд.
+
+    Отброшенные записи считаются; их число попадает в поле suppressed следующей
+    пропущенной записи с того же места.
+    """
+
+    def __init__(self, limit: int, window: float):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._sites = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not self.limit:
+            return True
+        site = (record.pathname, record.lineno)
+        now = time.monotonic()
+        started, passed, dropped = self._sites.get(site, (now, 0, 0))
+        if now - started >= self.window:
+            started, passed = now, 0
+        if passed >= self.limit:
+            self._sites[site] = (started, passed, dropped + 1)
+            return False
+        if dropped:
+            record.suppressed = dropped
+        self._sites[site] = (started, passed + 1, 0)
+        return True
+
+
+class ContextQueueHandler(QueueHandler):
+    """QueueHandler, который в потоке loop только готовит запись: форматирование и запись — в фоне"""
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        # id апдейта берётся из контекста обработчика (в фоновом потоке его уже нет)
+        if getattr(record, 'update_id', None) is None:
+            trace = current_trace()
+            if trace:
+                record.update_id = trace.update_id
+        return record
+
+
+def parse_levels(spec: str) -> dict:
+    """'aiogram.event=WARNING,database=DEBUG' → {'aiogram.event': 'WARNING', 'database': 'DEBUG'}"""
+    levels = {}
+    for item in spec.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging():
+    """Логирование через очередь: в loop — только постановка записи, файл и консоль пишет фоновый поток"""
+    global _listener
+    if _listener:
+        return
+
+    file_handler = SizedTimedRotatingFileHandler(
+        LOG_FILE, when=LOG_ROTATE_WHEN, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT
+    )
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = ContextQueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE_LIMIT, LOG_DEBUG_SAMPLE_WINDOW))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает очередь и закрывает файлы (вызывается и при выходе процесса)"""
+    global _listener
+    if _listener:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from config import LOOP_LAG_THRESHOLD_MS
+from instrumentation import trace_from_stack
+from metrics import registry
+
+# Как часто event loop отмечается, что он жив
+HEARTBEAT_INTERVAL = 0.1
+
+# Сколько последних кадров стека блокирующего кода попадает в лог
+STACK_DEPTH = 15
+
+loop_lag = registry.histogram(
+    'bot_event_loop_lag_seconds', "Задержка пробуждения event loop относительно расписания",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+loop_stalls = registry.counter(
+    'bot_event_loop_stalls_total', "Блокировки event loop дольше порога (со снятым стеком)"
+)
+
+
+class LoopWatchdog:
+    """Сторож event loop.
+
+    Задача в loop раз в HEARTBEAT_INTERVAL отмечается и замеряет задержку своего
+    пробуждения. Отдельный поток-семплер следит за отметками: если loop молчит дольше
+    порога, значит кто-то выполняет синхронный код в корутине — семплер снимает стек
+    потока loop и пишет его в лог вместе с id обрабатываемого апдейта.
+    """
+
+    def __init__(self, threshold_ms: int = LOOP_LAG_THRESHOLD_MS):
+        self.threshold = threshold_ms / 1000
+        self.last_lag = 0.0
+        self._beat = time.monotonic()
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+        registry.gauge('bot_event_loop_lag_last_seconds', "Последний замер задержки event loop", lambda: self.last_lag)
+
+    def start(self):
+        if self._task or not self.threshold:
+            return
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop_watchdog")
+        self._thread = threading.Thread(
+            target=self._sample, args=(threading.get_ident(),), name="loop-watchdog-sampler", daemon=True
+        )
+        self._thread.start()
+
+    async def stop(self):
+        if not self._task:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.to_thread(self._thread.join, 1.0)
+        self._task = self._thread = None
+
+    async def _heartbeat(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            self._beat = time.monotonic()
+            self.last_lag = max(0.0, time.perf_counter() - started - HEARTBEAT_INTERVAL)
+            loop_lag.observe(self.last_lag)
+            if self.last_lag >= self.threshold:
+                logging.warning(f"Event loop был заблокирован на {self.last_lag * 1000:.0f} мс")
+
+    def _sample(self, loop_thread_id: int):
+        reported_beat = None
+        while not self._stopped.wait(min(self.threshold / 2, HEARTBEAT_INTERVAL)):
+            beat = self._beat
+            if beat == reported_beat or time.monotonic() - beat - HEARTBEAT_INTERVAL < self.threshold:
+                continue
+            # Одна запись на одну блокировку: следующая — только после новой отметки loop
+            reported_beat = beat
+            frame = sys._current_frames().get(loop_thread_id)
+            if frame is None:
+                continue
+            trace = trace_from_stack(frame)
+            update = f"апдейт id={trace.update_id} ({trace.handler or 'хендлер не определён'})" if trace else "вне апдейта"
+            stack = "".join(traceback.format_stack(frame)[-STACK_DEPTH:])
+            del frame
+            loop_stalls.inc()
+            logging.warning(
+                f"Event loop заблокирован дольше {self.threshold * 1000:.0f} мс, {update}. Стек:\n{stack}"
+            )
+
+
+loop_watchdog = LoopWatchdog()
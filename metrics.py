@@ -0,0 +1,178 @@
+import logging
+from bisect import bisect_left
+from collections import Counter
+
+from aiohttp import web
+
+# Границы корзин гистограмм (секунды): от быстрых SQL до медленных вызовов панели
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: наблюдение — bisect и два сложения"""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = labels
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            # [счётчики корзин..., +Inf, сумма]
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.label_names + ('le',)
+        for label_values, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(names, label_values + (bound,))} {cumulative}")
+            labels = _labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CounterMetric:
+    """Монотонный счётчик с метками"""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = labels
+        self._values = Counter()
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] += amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.label_names, values)} {amount}" for values, amount in self._values.items()]
+        return lines
+
+
+class GaugeCallback:
+    """Метрика, значение которой считывается в момент запроса /metrics.
+
+    callback возвращает число или {значение метки: число} (тогда нужна одна метка).
+    """
+
+    def __init__(self, name: str, help_text: str, callback, kind: str = 'gauge', label: str = None):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        self.kind = kind
+        self.label = label
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        value = self.callback()
+        if isinstance(value, dict):
+            lines += [f"{self.name}{_labels((self.label,), (key,))} {amount}" for key, amount in value.items()]
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            return self._metrics[metric.name]
+        self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> CounterMetric:
+        return self._add(CounterMetric(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, callback, kind: str = 'gauge', label: str = None) -> GaugeCallback:
+        """Регистрирует (или заменяет) метрику, читаемую из состояния бота при запросе"""
+        metric = GaugeCallback(name, help_text, callback, kind, label)
+        self._metrics[name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines += metric.render()
+            except Exception as e:
+                logging.debug(f"Не удалось собрать метрику {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+update_duration = registry.histogram(
+    'bot_update_duration_seconds', "Время обработки апдейта по хендлерам", ('handler',)
+)
+db_query_duration = registry.histogram(
+    'bot_db_query_duration_seconds', "Время SQL-запросов по типу оператора", ('statement',)
+)
+external_duration = registry.histogram(
+    'bot_external_request_duration_seconds', "Время запросов к внешним API (panel, yookassa, telegram)", ('target',)
+)
+external_errors = registry.counter(
+    'bot_external_request_errors_total', "Ошибки запросов к внешним API", ('target',)
+)
+cache_requests = registry.counter(
+    'bot_cache_requests_total', "Обращения к кэшам: попадания и промахи", ('cache', 'result')
+)
+
+
+def record_cache(cache: str, hit: bool):
+    """Учитывает попадание/промах кэша (доля попаданий считается в Prometheus)"""
+    cache_requests.inc(cache, 'hit' if hit else 'miss')
+
+
+async def _handle_metrics(request):
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+class MetricsServer:
+    """Встроенный HTTP-сервер с метриками в текстовом формате Prometheus (GET /metrics)"""
+
+    def __init__(self):
+        self._runner = None
+
+    async def start(self, host: str, port: int):
+        if self._runner:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', _handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
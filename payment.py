@@ -1,21 +1,64 @@
 import uuid
+import time
 import asyncio
-import aiosqlite
 import logging
 import requests
+from aiogram.fsm.storage.base import StorageKey
 from yookassa import Configuration, Payment
-from config import YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, YOOKASSA_RETURN_URL, DB_PATH
-from database import add_payment, accrue_referral_commissions, calculate_amount_for_period
-from datetime import datetime
+from config import YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, YOOKASSA_RETURN_URL
+from database import add_payment, check_user_payment, calculate_amount_for_period
+from events import event_bus, PaymentSucceeded
+from instrumentation import timed_http
+from db import connect_db
+from fsm_storage import SQLiteStorage
+from locks import single_flight
 # Настройка ЮKассы
 Configuration.configure(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
 
-# Глобальный набор для отслеживания активных проверок
-active_checks = set()
-
-# Глобальный список для отслеживания активных задач проверки платежей
+# Задачи проверки платежей этого процесса (сами ожидающие платежи — в payment_checks)
 active_payment_tasks = set()
 
+# Сколько ждём подтверждения платежа и как часто спрашиваем ЮKassa
+PAYMENT_CHECK_WINDOW = 10 * 60
+PAYMENT_CHECK_INTERVAL = 10
+PAYMENT_DESTINY = 'payment:'
+
+# Ожидающие платежи: переживают перезапуск и видны всем процессам; запись живёт чуть дольше окна проверки
+payment_checks = SQLiteStorage(connect_db, ttl=PAYMENT_CHECK_WINDOW + 5 * 60, name='payment_checks')
+
+
+def _payment_key(bot, payment_data: dict) -> StorageKey:
+    return StorageKey(
+        bot_id=bot.id, chat_id=payment_data['chat_id'], user_id=payment_data['user_id'],
+        destiny=PAYMENT_DESTINY + payment_data['payment_id']
+    )
+
+
+@single_flight('yookassa_payment')
+async def fetch_payment(payment_id: str):
+    """Платёж из ЮKassa; SDK синхронный, поэтому запрос идёт в отдельном потоке"""
+    with timed_http('yookassa'):
+        return await asyncio.to_thread(Payment.find_one, payment_id)
+
+
+async def resume_payment_checks(bot) -> int:
+    """Возобновляет проверки платежей, прерванные перезапуском; возвращает их число"""
+    resumed = 0
+    for state, payment_data in await payment_checks.find(PAYMENT_DESTINY):
+        if state == 'crediting':
+            # Проверка остановилась между подтверждением и записью подписки — повторно не начисляем
+            logging.error(
+                f"Платеж {payment_data['payment_id']} пользователя {payment_data['user_id']} подтверждён, "
+                f"но начисление могло не завершиться — проверьте вручную"
+            )
+            await payment_checks.delete(_payment_key(bot, payment_data))
+            continue
+        asyncio.create_task(check_payment_status(payment_data, bot))
+        resumed += 1
+    if resumed:
+        logging.info(f"Возобновлено проверок платежей: {resumed}")
+    return resumed
+
 async def cancel_all_payment_tasks():
     """Отменяет все активные задачи проверки платежей"""
     if active_payment_tasks:
@@ -68,23 +111,25 @@ async def create_payment(period: str, user_id: int):
             ]
         }
 
-        payment = Payment.create({
-            "amount": {
-                "value": amount_value,
-                "currency": "RUB"
-            },
-            "confirmation": {
-                "type": "redirect",
-                "return_url": YOOKASSA_RETURN_URL
-            },
-            "capture": True,
-            "description": description,
-            "receipt": receipt,
-            "metadata": {
-                "user_id": str(user_id),
-                "period": period
-            }
-        }, str(uuid.uuid4()))
+        with timed_http('yookassa'):
+            # SDK синхронный — запрос в отдельном потоке, чтобы не останавливать цикл событий
+            payment = await asyncio.to_thread(Payment.create, {
+                "amount": {
+                    "value": amount_value,
+                    "currency": "RUB"
+                },
+                "confirmation": {
+                    "type": "redirect",
+                    "return_url": YOOKASSA_RETURN_URL
+                },
+                "capture": True,
+                "description": description,
+                "receipt": receipt,
+                "metadata": {
+                    "user_id": str(user_id),
+                    "period": period
+                }
+            }, str(uuid.uuid4()))
         
         return {
             'confirmation_url': payment.confirmation.confirmation_url,
@@ -98,6 +143,9 @@ async def create_payment(period: str, user_id: int):
 async def check_payment_status(payment_data: dict, bot):
     """Автоматически проверяет статус платежа"""
     payment_id = payment_data['payment_id']
+    key = _payment_key(bot, payment_data)
+    # При остановке бота (отмена задачи) запись остаётся, и проверка продолжится после запуска
+    finished = False
     
     # Добавляем текущую задачу в список активных
     current_task = asyncio.current_task()
@@ -105,30 +153,23 @@ async def check_payment_status(payment_data: dict, bot):
         active_payment_tasks.add(current_task)
     
     try:
-        for _ in range(60):  # 10 минут (60 попыток * 10 секунд)
+        if 'started_at' not in payment_data:
+            payment_data = {**payment_data, 'started_at': time.time()}
+            await payment_checks.set_data(key, payment_data)
+        deadline = payment_data['started_at'] + PAYMENT_CHECK_WINDOW
+
+        while time.time() < deadline:
             try:
-                payment = Payment.find_one(payment_id)
+                payment = await fetch_payment(payment_id)
                 
                 if payment.status == "succeeded":
+                    # После смены ведущего платёж могут проверять два процесса — начисляет тот, кто первым сменил состояние
+                    if not await payment_checks.compare_and_set_state(key, None, 'crediting'):
+                        logging.info(f"Платеж {payment_id} уже начисляется другой проверкой")
+                        return False
                     # Проверяем, была ли подписка активной ДО продления
-                    was_active = False
                     try:
-                        async with aiosqlite.connect(DB_PATH) as conn:
-                            cursor = await conn.execute(
-                                "SELECT expiry_date FROM users WHERE user_id=?",
-                                (payment_data['user_id'],)
-                            )
-                            row_before = await cursor.fetchone()
-                            if row_before and row_before[0]:
-                                expiry_str = row_before[0]
-                                for fmt in ('%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
-                                    try:
-                                        dt = datetime.strptime(expiry_str, fmt)
-                                        was_active = datetime.now() < dt
-                                        if was_active or True:
-                                            break
-                                    except ValueError:
-                                        continue
+                        was_active = await check_user_payment(payment_data['user_id'])
                     except Exception:
                         was_active = False
                     # Добавляем оплату в БД
@@ -144,69 +185,26 @@ async def check_payment_status(payment_data: dict, bot):
                         period_months,
                         payment_method='yookassa'
                     )
+                    finished = True
                     
                     if not success:
                         logging.error("Не удалось обновить подписку в БД")
                         return False
-                    
-                    
-                    # Удаляем сообщение с платежом
-                    try:
-                        await bot.delete_message(
-                            chat_id=payment_data['chat_id'],
-                            message_id=payment_data['message_id']
-                        )
-                    except Exception as e:
-                        logging.warning(f"Не удалось удалить сообщение: {e}")
-
-                    # Получаем дату окончания и форматируем её
-                    async with aiosqlite.connect(DB_PATH) as conn:
-                        cursor = await conn.execute(
-                            "SELECT expiry_date FROM users WHERE user_id=?",
-                            (payment_data['user_id'],)
-                        )
-                        row = await cursor.fetchone()
-                        if row and row[0]:
-                            try:
-                                from datetime import datetime as dt
-                                expiry_date = dt.strptime(row[0], '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y %H:%M')
-                            except ValueError:
-                                expiry_date = row[0]
-                        else:
-                            expiry_date = "не определена"
-
-                    # Отправляем сообщение об успешной оплате
-                    action_word = "продлена" if was_active else "активирована"
-                    
-                    # Определяем текст срока подписки
-                    if payment_data['period'] == 'special':
-                        period_text = "7 дней"
-                    else:
-                        period_text = f"{payment_data['period']} мес."
-                    
-                    await bot.send_message(
-                        chat_id=payment_data['chat_id'],
-                        text=f"""
-<b>✅ Оплата успешно выполнена</b>
 
-✨Ваша подписка на <b>Shard VPN</b> {action_word}!
-
-📅Срок подписки: <b>{period_text}</b>
-⏳Дата окончания: <b>{expiry_date}</b>
-
-<blockquote><i>🔹 Нажмите «Активировать VPN», чтобы начать пользоваться.</i></blockquote>
-""",
-                        message_effect_id="5046509860389126442"
-                    )
-                    # Реферальные начисления
-                    try:
-                        amount_rub = calculate_amount_for_period(period_months)
-                        await accrue_referral_commissions(payment_data['user_id'], amount_rub, method='yookassa', bot=bot)
-                    except Exception as e:
-                        logging.error(f"Ошибка начисления реферальных: {e}")
+                    # Подтверждение пользователю, реферальные начисления и статистика — подписчики события
+                    event_bus.publish(PaymentSucceeded(
+                        user_id=payment_data['user_id'],
+                        chat_id=payment_data['chat_id'],
+                        period_months=period_months,
+                        payment_method='yookassa',
+                        amount_rub=calculate_amount_for_period(period_months),
+                        was_active=was_active,
+                        message_id=payment_data['message_id']
+                    ))
                     return True
                     
                 elif payment.status in ("canceled", "failed"):
+                    finished = True
                     return False
                     
             except Exception as e:
@@ -223,11 +221,12 @@ async def check_payment_status(payment_data: dict, bot):
                     logging.error(f"Ошибка проверки платежа: {error_text}", exc_info=True)
             
             try:
-                await asyncio.sleep(10)
+                await asyncio.sleep(PAYMENT_CHECK_INTERVAL)
             except asyncio.CancelledError:
                 logging.info(f"Проверка платежа {payment_id} отменена")
                 return False
         
+        finished = True
         logging.warning(f"Платеж {payment_id} не завершился в течение 10 минут")
         return False
         
@@ -235,9 +234,15 @@ async def check_payment_status(payment_data: dict, bot):
         logging.info(f"Проверка платежа {payment_id} отменена")
         return False
     except Exception as e:
+        finished = True
         logging.error(f"Критическая ошибка в check_payment_status: {str(e)}", exc_info=True)
         return False
     finally:
+        if finished:
+            try:
+                await payment_checks.delete(key)
+            except Exception as e:
+                logging.error(f"Не удалось удалить запись проверки платежа {payment_id}: {e}")
         # Удаляем задачу из списка активных
         if current_task:
-            active_payment_tasks.discard(current_task)
\ No newline at end of file
+            active_payment_tasks.discard(current_task)
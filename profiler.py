@@ -0,0 +1,140 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+PROFILE_MODES = ('sample', 'cpu')
+
+# Интервал семплера стека и ограничения запуска
+SAMPLE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 300
+DEFAULT_TOP = 40
+
+_running = asyncio.Lock()
+
+# Кадры самого event loop есть в каждом семпле и в сводку не попадают
+_LOOP_INTERNALS = (os.path.join('asyncio', 'base_events.py'), os.path.join('asyncio', 'runners.py'),
+                   os.path.join('asyncio', 'events.py'))
+_IDLE = "<ожидание событий (простой)>"
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_filename}:{frame.f_lineno} {code.co_name}"
+
+
+def _sample_stacks(thread_id: int, stop: threading.Event, samples: Counter, own: Counter):
+    """Поток-семплер: раз в SAMPLE_INTERVAL снимает стек потока event loop"""
+    while not stop.wait(SAMPLE_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            continue
+        if frame.f_code.co_filename.endswith('selectors.py'):
+            own[_IDLE] += 1
+        else:
+            own[_frame_name(frame)] += 1
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            key = f"{code.co_filename}:{code.co_firstlineno} {code.co_name}"
+            if key not in seen and not code.co_filename.endswith(_LOOP_INTERNALS):
+                seen.add(key)
+                samples[key] += 1
+            frame = frame.f_back
+        samples['<всего>'] += 1
+
+
+def _format_samples(samples: Counter, own: Counter, top: int) -> str:
+    total = samples.pop('<всего>', 0)
+    if not total:
+        return "Нет семплов\n"
+    lines = [f"Семплов: {total} (каждые {SAMPLE_INTERVAL * 1000:.0f} мс)\n", "== Собственное время (строка) =="]
+    lines += [f"{count / total:7.1%} {count:7}  {name}" for name, count in own.most_common(top)]
+    lines += ["", "== Включая вложенные вызовы (функция) =="]
+    lines += [f"{count / total:7.1%} {count:7}  {name}" for name, count in samples.most_common(top)]
+    return "\n".join(lines) + "\n"
+
+
+async def _profile_sample(seconds: float, top: int) -> str:
+    samples, own = Counter(), Counter()
+    stop = threading.Event()
+    sampler = threading.Thread(
+        target=_sample_stacks, args=(threading.get_ident(), stop, samples, own), name="profiler-sampler", daemon=True
+    )
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop.set()
+        await asyncio.to_thread(sampler.join)
+    return _format_samples(samples, own, top)
+
+
+async def _profile_cpu(seconds: float, top: int) -> str:
+    # cProfile следит за потоком, в котором включён — это поток event loop со всеми хендлерами
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profile.disable()
+    output = io.StringIO()
+    stats = pstats.Stats(profile, stream=output)
+    output.write("== По собственному времени ==\n")
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+    output.write("\n== По суммарному времени ==\n")
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+    return output.getvalue()
+
+
+def is_profiling() -> bool:
+    return _running.locked()
+
+
+async def run_profile(seconds: float, mode: str = 'sample', memory: bool = False, top: int = DEFAULT_TOP) -> str:
+    """Профилирует работающий процесс seconds секунд и возвращает текстовый отчёт.
+
+    sample — семплирование стека потока loop (почти без накладных расходов),
+    cpu — cProfile (точные счётчики вызовов, но заметно замедляет бота на время замера).
+    memory — дополнительно сравнить снимки tracemalloc в начале и конце.
+    Вне замера профилировщик ничего не делает; одновременно идёт только один замер.
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Неизвестный режим профилирования: {mode}")
+    seconds = max(1.0, min(float(seconds), MAX_PROFILE_SECONDS))
+    if _running.locked():
+        raise RuntimeError("Профилирование уже запущено")
+
+    async with _running:
+        started_tracemalloc = memory and not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start(10)
+        before = tracemalloc.take_snapshot() if memory else None
+        started = time.strftime('%d.%m.%Y %H:%M:%S')
+        try:
+            if mode == 'cpu':
+                report = await _profile_cpu(seconds, top)
+            else:
+                report = await _profile_sample(seconds, top)
+            if memory:
+                after = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                report += (
+                    f"\n== Память (tracemalloc): сейчас {current / 1024 / 1024:.1f} МБ, "
+                    f"пик {peak / 1024 / 1024:.1f} МБ ==\nПрирост за время замера:\n"
+                )
+                report += "\n".join(str(stat) for stat in after.compare_to(before, 'lineno')[:top]) + "\n"
+                report += "\nКрупнейшие аллокации:\n"
+                report += "\n".join(str(stat) for stat in after.statistics('lineno')[:top]) + "\n"
+        finally:
+            if started_tracemalloc:
+                tracemalloc.stop()
+
+    header = f"Профиль {mode}, {seconds:.0f} с, начало {started}{', с памятью' if memory else ''}\n\n"
+    return header + report
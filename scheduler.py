@@ -0,0 +1,241 @@
+import asyncio
+import html
+import logging
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from metrics import registry
+
+# Сколько последних запусков каждой задачи хранится для админки
+HISTORY_SIZE = 20
+# Повтор после ошибки: 10 с, 20 с, 40 с ... но не дольше интервала задачи и не дольше MAX_BACKOFF
+BASE_BACKOFF = 10.0
+MAX_BACKOFF = 15 * 60
+
+job_duration = registry.histogram(
+    'bot_job_duration_seconds', "Время выполнения фоновых задач", ('job',),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+job_runs = registry.counter(
+    'bot_job_runs_total', "Запуски фоновых задач по результату", ('job', 'result')
+)
+
+_CRON_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def _parse_cron_field(field: str, low: int, high: int) -> frozenset:
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(value) for value in part.split('-'))
+        else:
+            start = end = int(part)
+            if step > 1:
+                end = high
+        if step < 1 or start < low or end > high or start > end:
+            raise ValueError(f"Неверное поле cron: {field}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class Cron:
+    """Расписание cron из 5 полей: минута, час, день месяца, месяц, день недели (0 и 7 — воскресенье)"""
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"В cron-выражении должно быть 5 полей: {expression}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            _parse_cron_field(field, low, high) for field, (low, high) in zip(fields, _CRON_RANGES)
+        )
+        self.weekdays = frozenset(day % 7 for day in weekdays)
+        # Как в cron: если заданы и день месяца, и день недели — подходит любой из них
+        self._any_day = fields[2] != '*' and fields[4] != '*'
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        return (day or weekday) if self._any_day else (day and weekday)
+
+    def next_after(self, moment: datetime) -> datetime:
+        """Ближайшее время срабатывания строго после moment"""
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"cron-выражение никогда не срабатывает: {self.expression}")
+
+
+class Job:
+    """Фоновая задача: корутина func без аргументов по интервалу или cron-расписанию"""
+
+    def __init__(self, name: str, func, interval: float = None, cron: str = None, jitter: float = 0.0,
+                 run_at_start: bool = False, timeout: float = None):
+        if (interval is None) == (cron is None):
+            raise ValueError(f"Для задачи {name} нужен ровно один из параметров interval или cron")
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.cron = Cron(cron) if cron else None
+        self.jitter = jitter
+        self.run_at_start = run_at_start
+        self.timeout = timeout
+        self.history = deque(maxlen=HISTORY_SIZE)  # (начало, длительность, результат, ошибка)
+        self.failures = 0
+        self.running = False
+        self.next_run = None
+
+    def delay_until_next(self) -> float:
+        """Секунды до следующего запуска по расписанию (с разбросом jitter)"""
+        if self.cron:
+            now = datetime.now()
+            delay = (self.cron.next_after(now) - now).total_seconds()
+        else:
+            delay = self.interval
+        return delay + random.uniform(0, self.jitter)
+
+    def backoff(self) -> float:
+        limit = min(MAX_BACKOFF, self.interval) if self.interval else MAX_BACKOFF
+        return min(limit, BASE_BACKOFF * 2 ** (self.failures - 1))
+
+
+class JobScheduler:
+    """Планировщик фоновых задач с надзором.
+
+    У каждой задачи свой цикл: следующий запуск планируется только после окончания
+    текущего, поэтому запуски одной задачи не пересекаются (если запуск затянулся,
+    пропущенные срабатывания не накапливаются). Ошибка не останавливает задачу —
+    повтор через экспоненциально растущую паузу, после успеха — снова по расписанию.
+    Итоги запусков пишутся в историю задачи и в метрики bot_job_*.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self._tasks = {}
+        self._stopping = asyncio.Event()
+
+    def add(self, name: str, func, **schedule) -> Job:
+        """Регистрирует задачу (interval=секунды или cron='m h dom mon dow', jitter, run_at_start, timeout)"""
+        if name in self.jobs:
+            raise ValueError(f"Задача {name} уже зарегистрирована")
+        job = self.jobs[name] = Job(name, func, **schedule)
+        if self._tasks:
+            self._launch(job)
+        return job
+
+    @property
+    def started(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._stopping = asyncio.Event()
+        for job in self.jobs.values():
+            self._launch(job)
+        logging.info(f"Планировщик задач запущен: {', '.join(self.jobs)}")
+
+    def _launch(self, job: Job):
+        self._tasks[job.name] = asyncio.create_task(self._supervise(job), name=f"job_{job.name}")
+
+    async def _supervise(self, job: Job):
+        delay = random.uniform(0, job.jitter) if job.run_at_start else job.delay_until_next()
+        while True:
+            job.next_run = datetime.now() + timedelta(seconds=delay)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=delay)
+                return
+            except asyncio.TimeoutError:
+                pass
+            job.next_run = None
+            await self.run_once(job)
+            delay = job.backoff() if job.failures else job.delay_until_next()
+
+    async def run_once(self, job: Job) -> bool:
+        """Выполняет задачу сейчас (если она уже не выполняется); True — успешно"""
+        if job.running:
+            logging.info(f"Задача {job.name} ещё выполняется, запуск пропущен")
+            return False
+        job.running = True
+        started_at = datetime.now()
+        started = time.perf_counter()
+        result, error = 'ok', None
+        try:
+            if job.timeout:
+                await asyncio.wait_for(job.func(), timeout=job.timeout)
+            else:
+                await job.func()
+        except asyncio.CancelledError:
+            result, error = 'cancelled', "прервана остановкой"
+            raise
+        except Exception as e:
+            result, error = 'error', f"{type(e).__name__}: {e}"
+            job.failures += 1
+            logging.error(f"Ошибка фоновой задачи {job.name} (подряд: {job.failures}): {e}", exc_info=True)
+        else:
+            job.failures = 0
+        finally:
+            elapsed = time.perf_counter() - started
+            job.running = False
+            job.history.append((started_at, elapsed, result, error))
+            job_duration.observe(elapsed, job.name)
+            job_runs.inc(job.name, result)
+        return error is None
+
+    async def stop(self, timeout: float = 10.0):
+        """Не начинает новых запусков, ждёт текущие до timeout секунд и прерывает оставшиеся"""
+        if not self._tasks:
+            return
+        self._stopping.set()
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            logging.warning(f"Задача {task.get_name()} не завершилась за {timeout:g} с, прерываем")
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for job in self.jobs.values():
+            job.next_run = None
+
+
+def format_jobs(scheduler: JobScheduler, history: int = 3) -> str:
+    """Текст для админки: расписание, следующий запуск и последние запуски каждой задачи"""
+    if not scheduler.jobs:
+        return "Фоновых задач нет"
+    lines = [] if scheduler.started else ["⏸ Планировщик не запущен (этот процесс не ведущий)", ""]
+    for job in scheduler.jobs.values():
+        schedule = f"cron {job.cron.expression}" if job.cron else f"каждые {job.interval:g} с"
+        state = "выполняется" if job.running else (
+            f"след. {job.next_run.strftime('%d.%m %H:%M:%S')}" if job.next_run else "не запланирована"
+        )
+        lines.append(f"<b>{job.name}</b> — {schedule}, {state}")
+        if job.failures:
+            lines.append(f"  ошибок подряд: {job.failures}")
+        for started_at, elapsed, result, error in list(job.history)[-history:][::-1]:
+            mark = {'ok': '✅', 'error': '❌'}.get(result, '⛔')
+            line = f"  {mark} {started_at.strftime('%d.%m %H:%M:%S')} {elapsed * 1000:.0f} мс"
+            if error:
+                line += f" — {html.escape(error[:120])}"
+            lines.append(line)
+    return "\n".join(lines)
+
+
+job_scheduler = JobScheduler()
@@ -0,0 +1,215 @@
+"""
+Отчёт по bot.log: перцентили времени обработки апдейтов по дням и часам,
+частота ошибок, перезапуски бота.
+
+    python scripts/log_report.py                       # bot.log и ротированные bot.log.*
+    python scripts/log_report.py logs/ --hourly        # все логи из каталога, с разбивкой по часам
+    python scripts/log_report.py bot.log --csv out.csv
+
+Файлы читаются через mmap: поиск строк делает regex-движок по байтам без
+построчного чтения, поэтому многогигабайтные логи обрабатываются за секунды.
+Понимает и старый текстовый формат (в т.ч. в cp1251), и JSON-строки logging_setup.
+"""
+import argparse
+import csv
+import glob
+import json
+import mmap
+import os
+import re
+import sys
+from array import array
+from collections import Counter, defaultdict
+
+DURATION_RE = re.compile(rb"Update id=\d+ is (not )?handled\. Duration (\d+) ms")
+# Отдельные шаблоны с литеральным началом: альтернатива в одном regex сканирует в разы медленнее
+ERROR_RES = (re.compile(rb" - (?:ERROR|CRITICAL) - "), re.compile(rb'"level": "(?:ERROR|CRITICAL)"'))
+RESTART_RE = re.compile(rb"Start polling")
+
+JSON_PREFIX = b'{"ts": "'
+_DIGITS_RE = re.compile(r"\d+")
+
+# Сколько самых частых ошибок показывать в отчёте
+TOP_ERRORS = 15
+
+
+def decode(raw: bytes) -> str:
+    """UTF-8, а для старых записей — cp1251"""
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw.decode('cp1251', errors='replace')
+
+
+class LogStats:
+    def __init__(self):
+        self.durations = defaultdict(lambda: array('I'))  # (день, час) → мс
+        self.not_handled = Counter()
+        self.errors = Counter()  # (день, час) → число ошибок
+        self.error_messages = Counter()
+        self.restarts = []
+        self.legacy_encoded = 0
+
+    def scan_file(self, path: str):
+        if os.path.getsize(path) == 0:
+            return
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            self._scan(data)
+
+    def _scan(self, data):
+        for match in DURATION_RE.finditer(data):
+            key = _period(data, _line_start(data, match.start()))
+            if key is None:
+                continue
+            self.durations[key].append(int(match.group(2)))
+            if match.group(1):
+                self.not_handled[key] += 1
+
+        for error_re in ERROR_RES:
+            for match in error_re.finditer(data):
+                start = _line_start(data, match.start())
+                key = _period(data, start)
+                if key is None:
+                    continue
+                end = data.find(b"\n", match.end())
+                self.errors[key] += 1
+                self.error_messages[self._error_message(data[start:end if end != -1 else len(data)], match.end() - start)] += 1
+
+        for match in RESTART_RE.finditer(data):
+            start = _line_start(data, match.start())
+            line = data[start:start + 32]
+            offset = len(JSON_PREFIX) if line.startswith(JSON_PREFIX) else 0
+            self.restarts.append(line[offset:offset + 19].decode('ascii', errors='replace').replace('T', ' '))
+
+    def _error_message(self, line: bytes, message_start: int) -> str:
+        if line.startswith(JSON_PREFIX):
+            try:
+                message = json.loads(line)['msg']
+            except (ValueError, KeyError):
+                message = decode(line)
+        else:
+            raw = line[message_start:]
+            try:
+                message = raw.decode('utf-8')
+            except UnicodeDecodeError:
+                self.legacy_encoded += 1
+                message = raw.decode('cp1251', errors='replace')
+        # Числа (id, суммы, коды) не различают ошибки между собой
+        return _DIGITS_RE.sub("N", message.strip())[:200]
+
+
+def _line_start(data, position: int) -> int:
+    return data.rfind(b"\n", 0, position) + 1
+
+
+def _period(data, start: int):
+    """(YYYY-MM-DD, HH) из начала строки в текстовом или JSON-формате"""
+    head = data[start:start + 24]
+    offset = len(JSON_PREFIX) if head.startswith(JSON_PREFIX) else 0
+    day, hour = head[offset:offset + 10], head[offset + 11:offset + 13]
+    if len(day) != 10 or day[4:5] != b"-" or not hour.isdigit():
+        return None
+    return day.decode('ascii'), hour.decode('ascii')
+
+
+def percentile(sorted_values, q: int) -> int:
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, len(sorted_values) * q // 100)]
+
+
+def summarize(stats: LogStats, hourly: bool) -> list:
+    """Строки отчёта: период, апдейты, необработанные, p50/p95/p99/max, ошибки и ошибок на апдейт"""
+    grouped = defaultdict(lambda: array('I'))
+    not_handled, errors = Counter(), Counter()
+    periods = set(stats.durations) | set(stats.errors)
+    for day, hour in periods:
+        period = f"{day} {hour}:00" if hourly else day
+        grouped[period].extend(stats.durations.get((day, hour), ()))
+        not_handled[period] += stats.not_handled[(day, hour)]
+        errors[period] += stats.errors[(day, hour)]
+
+    rows = []
+    for period in sorted(grouped):
+        values = sorted(grouped[period])
+        updates = len(values)
+        rows.append({
+            'period': period,
+            'updates': updates,
+            'not_handled': not_handled[period],
+            'p50_ms': percentile(values, 50),
+            'p95_ms': percentile(values, 95),
+            'p99_ms': percentile(values, 99),
+            'max_ms': values[-1] if values else 0,
+            'errors': errors[period],
+            'error_rate': round(errors[period] / updates, 4) if updates else 0,
+        })
+    return rows
+
+
+def print_report(stats: LogStats, rows: list, files: list):
+    print(f"Файлов: {len(files)}, апдейтов: {sum(row['updates'] for row in rows)}, "
+          f"ошибок: {sum(row['errors'] for row in rows)}, перезапусков: {len(stats.restarts)}")
+    if stats.legacy_encoded:
+        print(f"Записей в cp1251: {stats.legacy_encoded}")
+    print()
+    print(f"{'Период':<17} {'апдейты':>8} {'p50':>6} {'p95':>6} {'p99':>6} {'max':>7} {'ошибки':>7} {'на апд.':>8}")
+    for row in rows:
+        print(f"{row['period']:<17} {row['updates']:>8} {row['p50_ms']:>6} {row['p95_ms']:>6} "
+              f"{row['p99_ms']:>6} {row['max_ms']:>7} {row['errors']:>7} {row['error_rate']:>8.3f}")
+
+    if stats.error_messages:
+        print("\nЧастые ошибки:")
+        for message, count in stats.error_messages.most_common(TOP_ERRORS):
+            print(f"{count:>7}  {message}")
+
+    if stats.restarts:
+        print("\nПерезапуски (Start polling):")
+        for restart in sorted(stats.restarts):
+            print(f"  {restart}")
+
+
+def write_csv(rows: list, path: str):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]) if rows else ['period'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def collect_files(paths: list) -> list:
+    """Файлы логов: явные пути, каталоги (bot.log*) и маски; по порядку изменения"""
+    files = []
+    for path in paths or ['bot.log*']:
+        if os.path.isdir(path):
+            files += glob.glob(os.path.join(path, 'bot.log*'))
+        else:
+            files += glob.glob(path) or ([path] if os.path.exists(path) else [])
+    return sorted(set(files), key=os.path.getmtime)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Аналитика bot.log: задержки апдейтов, ошибки, перезапуски")
+    parser.add_argument('paths', nargs='*', help="файлы, каталоги или маски (по умолчанию bot.log*)")
+    parser.add_argument('--hourly', action='store_true', help="разбивка по часам вместо дней")
+    parser.add_argument('--csv', metavar='FILE', help="записать таблицу по периодам в CSV")
+    args = parser.parse_args()
+
+    files = collect_files(args.paths)
+    if not files:
+        print("Файлы логов не найдены")
+        sys.exit(1)
+
+    stats = LogStats()
+    for path in files:
+        stats.scan_file(path)
+
+    rows = summarize(stats, args.hourly)
+    if args.csv:
+        write_csv(rows, args.csv)
+        print(f"Записано периодов: {len(rows)} → {args.csv}")
+    else:
+        print_report(stats, rows, files)
+
+
+if __name__ == "__main__":
+    main()
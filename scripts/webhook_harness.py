@@ -0,0 +1,95 @@
+"""
+Нагрузочная проверка webhook-режима: шлёт синтетические апдейты на локальный сервер.
+
+    BOT_MODE=webhook WEBHOOK_URL=https://example.com/webhook WEBHOOK_SECRET=s python bot.py
+    python scripts/webhook_harness.py --secret s --count 2000 --concurrency 50 --duplicates 0.1
+
+По умолчанию текст сообщений не совпадает ни с одним хендлером, поэтому бот не ходит
+в Telegram и замеряется чистый приём и диспетчеризация. Доля --duplicates отправляется
+повторно с тем же update_id (проверка отсева повторов). Один запрос идёт с неверным
+секретом и должен получить 401.
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+import aiohttp
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': 'Harness'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Harness'},
+            'text': text,
+        },
+    }
+
+
+async def run(args):
+    base_id = random.randint(10 ** 8, 2 * 10 ** 8)
+    updates = [make_update(base_id + i, args.user_base + i % args.users, args.text) for i in range(args.count)]
+    duplicates = random.sample(updates, int(len(updates) * args.duplicates))
+    payloads = updates + duplicates
+    random.shuffle(payloads)
+
+    statuses = Counter()
+    latencies = []
+    queue = asyncio.Queue()
+    for payload in payloads:
+        queue.put_nowait(payload)
+
+    async def worker(session):
+        while not queue.empty():
+            payload = queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                async with session.post(args.url, json=payload, headers={SECRET_HEADER: args.secret}) as response:
+                    statuses[response.status] += 1
+            except aiohttp.ClientError as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async with session.post(args.url, json=updates[0], headers={SECRET_HEADER: args.secret + 'x'}) as response:
+            print(f"Неверный секрет: HTTP {response.status} (ожидается 401)")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def percentile(q):
+        return latencies[min(len(latencies) - 1, len(latencies) * q // 100)] * 1000 if latencies else 0
+
+    print(f"Отправлено: {len(payloads)} ({len(duplicates)} повторов) за {elapsed:.2f} с, "
+          f"{len(payloads) / elapsed:.0f} запросов/с")
+    print(f"Ответы: {dict(statuses)}")
+    print(f"Время ответа, мс: p50 {percentile(50):.1f}, p95 {percentile(95):.1f}, p99 {percentile(99):.1f}")
+    print("Повторы должны быть видны в логе бота как «Повторный апдейт ... пропущен»")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетические апдейты для webhook-режима")
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    parser.add_argument('--secret', default='')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duplicates', type=float, default=0.05, help="доля повторно отправленных апдейтов")
+    parser.add_argument('--users', type=int, default=100, help="сколько разных пользователей")
+    parser.add_argument('--user-base', type=int, default=900000000, help="первый синтетический user_id")
+    parser.add_argument('--text', default='harness ping', help="текст сообщений (по умолчанию без хендлера)")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
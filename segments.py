@@ -0,0 +1,161 @@
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from database import PAID_PAYMENT_SQL as PAID_PAYMENT_FILTER
+from db import connect_db
+
+PAGE_SIZE = 1000
+EXPIRY_AT_FORMAT = '%Y-%m-%d %H:%M'
+
+# Оплата пользователя строки t — то же определение, что у database.has_paid_subscription
+PAID_PAYMENT_SQL = f"p.user_id = t.user_id AND {PAID_PAYMENT_FILTER}"
+
+# Для сегментов по таблице users: пользователь не заблокировал бота
+NOT_BLOCKED_SQL = "NOT EXISTS (SELECT 1 FROM bot_users b WHERE b.user_id = t.user_id AND b.blocked_at IS NOT NULL)"
+
+
+@dataclass(frozen=True)
+class Segment:
+    """Именованная аудитория: таблица-источник (алиас t) и условие на строку.
+
+    Условия используют только индексированные колонки (user_id, expiry_at,
+    referrer_id, payments.user_id), параметры :now / :until подставляются при компиляции.
+    Аудитория рассылки (compile/count/iter) не включает заблокировавших бота.
+    """
+    title: str
+    table: str
+    where: str
+    list_order: str = "t.user_id DESC"
+    include_blocked: bool = False
+
+    @property
+    def audience_where(self) -> str:
+        """Условие для отправки: без пользователей, заблокировавших бота"""
+        if self.include_blocked:
+            return self.where
+        if self.table == 'bot_users':
+            return f"({self.where}) AND t.blocked_at IS NULL"
+        return f"({self.where}) AND {NOT_BLOCKED_SQL}"
+
+
+SEGMENTS = {
+    'all': Segment("все пользователи бота", 'bot_users', "1"),
+    'active': Segment(
+        "активные подписки", 'users',
+        "t.subscribed = 1 AND t.expiry_at > :now",
+        list_order="t.expiry_at DESC"
+    ),
+    'inactive': Segment(
+        "без активной подписки", 'bot_users',
+        "NOT EXISTS (SELECT 1 FROM users u WHERE u.user_id = t.user_id AND u.subscribed = 1 AND u.expiry_at > :now)"
+    ),
+    'expired': Segment(
+        "истекшие подписки", 'users',
+        "t.subscribed = 1 AND t.expiry_at <= :now",
+        list_order="t.expiry_at DESC"
+    ),
+    'expiring': Segment(
+        "подписка истекает в ближайшие дни", 'users',
+        "t.subscribed = 1 AND t.expiry_at > :now AND t.expiry_at <= :until",
+        list_order="t.expiry_at ASC"
+    ),
+    'never-paid': Segment(
+        "ни разу не оплачивали", 'bot_users',
+        f"NOT EXISTS (SELECT 1 FROM payments p WHERE {PAID_PAYMENT_SQL})"
+    ),
+    'trial-only': Segment(
+        "только пробный период", 'bot_users',
+        "EXISTS (SELECT 1 FROM payments p WHERE p.user_id = t.user_id AND p.payment_method = 'trial') "
+        f"AND NOT EXISTS (SELECT 1 FROM payments p WHERE {PAID_PAYMENT_SQL})"
+    ),
+    'referrers': Segment(
+        "пригласили хотя бы одного пользователя", 'bot_users',
+        "EXISTS (SELECT 1 FROM bot_users r WHERE r.referrer_id = t.user_id)"
+    ),
+    'blocked': Segment(
+        "заблокировали бота", 'bot_users',
+        "t.blocked_at IS NOT NULL",
+        include_blocked=True
+    ),
+}
+
+# Срок для 'expiring' без явного числа дней
+DEFAULT_EXPIRING_DAYS = 3
+
+_SEGMENT_RE = re.compile(r'^(?P<name>[a-z-]+?)(?:-(?P<days>\d+))?$')
+
+
+def _lookup(name: str):
+    match = _SEGMENT_RE.match(name or '')
+    segment = SEGMENTS.get(match.group('name')) if match else None
+    if segment is None or (match.group('days') and ':until' not in segment.where):
+        raise ValueError(f"Неизвестный сегмент: {name}")
+    return segment, int(match.group('days') or DEFAULT_EXPIRING_DAYS)
+
+
+def parse_segment(name: str):
+    """Разбирает имя сегмента ('active', 'expiring-7'), возвращает (Segment, параметры)"""
+    segment, days = _lookup(name)
+    now = datetime.now()
+    params = {'now': now.strftime(EXPIRY_AT_FORMAT)}
+    if ':until' in segment.where:
+        params['until'] = (now + timedelta(days=days)).strftime(EXPIRY_AT_FORMAT)
+    return segment, params
+
+
+def segment_title(name: str) -> str:
+    """Человекочитаемое название сегмента"""
+    segment, days = _lookup(name)
+    if ':until' in segment.where:
+        return f"подписка истекает в ближайшие {days} дн."
+    return segment.title
+
+
+def compile_segment(name: str):
+    """SQL выборки user_id сегмента и его параметры (для INSERT ... SELECT и подзапросов)"""
+    segment, params = parse_segment(name)
+    return f"SELECT t.user_id FROM {segment.table} t WHERE {segment.audience_where}", params
+
+
+async def count_segment(name: str) -> int:
+    """Размер сегмента (для экрана подтверждения рассылки)"""
+    segment, params = parse_segment(name)
+    async with connect_db() as conn:
+        cursor = await conn.execute(f"SELECT COUNT(*) FROM {segment.table} t WHERE {segment.audience_where}", params)
+        row = await cursor.fetchone()
+    return row[0] if row else 0
+
+
+async def iter_segment(name: str, page_size: int = PAGE_SIZE):
+    """Асинхронно отдаёт user_id сегмента постранично по первичному ключу (без fetchall всей аудитории)"""
+    segment, params = parse_segment(name)
+    query = (
+        f"SELECT t.user_id FROM {segment.table} t "
+        f"WHERE {segment.audience_where} AND t.user_id > :after ORDER BY t.user_id LIMIT :limit"
+    )
+    after = -1
+    while True:
+        async with connect_db() as conn:
+            cursor = await conn.execute(query, {**params, 'after': after, 'limit': page_size})
+            rows = await cursor.fetchall()
+        for (user_id,) in rows:
+            yield user_id
+        if len(rows) < page_size:
+            return
+        after = rows[-1][0]
+
+
+async def list_segment(name: str, limit: int = 20):
+    """Первые пользователи сегмента для экранов админки: [(user_id, expiry_date)]"""
+    segment, params = parse_segment(name)
+    if segment.table == 'users':
+        query = f"SELECT t.user_id, t.expiry_date FROM users t WHERE {segment.where} ORDER BY {segment.list_order} LIMIT :limit"
+    else:
+        query = (
+            f"SELECT t.user_id, u.expiry_date FROM bot_users t LEFT JOIN users u ON u.user_id = t.user_id "
+            f"WHERE {segment.where} ORDER BY {segment.list_order} LIMIT :limit"
+        )
+    async with connect_db() as conn:
+        cursor = await conn.execute(query, {**params, 'limit': limit})
+        return await cursor.fetchall()
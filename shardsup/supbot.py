@@ -1,8 +1,18 @@
 import asyncio
+import functools
+import os
+import sys
+
+import aiosqlite
 from aiogram import Bot, Dispatcher, F
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.types import Message
 from dotenv import load_dotenv
-import os
+
+# Общий модуль хранилища лежит в корне проекта
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fsm_storage import SQLiteStorage
+
 load_dotenv()
 # Токен бота
 TOKEN = os.getenv('BOT_TOKEN')
@@ -10,11 +20,27 @@ TOKEN = os.getenv('BOT_TOKEN')
 # ID супергруппы с админами (где будут создаваться темы)
 ADMIN_GROUP_ID = int(os.getenv('ADMIN_GROUP_ID'))
 
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'support_bot.db')
+
+# Связь пользователь ↔ тема в группе админов: бессрочно, переживает перезапуск
+storage = SQLiteStorage(functools.partial(aiosqlite.connect, DB_PATH), cache_ttl=24 * 60 * 60)
+
 bot = Bot(token=TOKEN)
-dp = Dispatcher()
+dp = Dispatcher(storage=storage)
 
-# Словарь: user_id -> message_thread_id
-user_threads = {}
+THREAD_DESTINY = 'support_thread'
+
+
+def user_thread_key(user_id: int) -> StorageKey:
+    """Ключ пользователя: в данных — message_thread_id его темы"""
+    return StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id, destiny=THREAD_DESTINY)
+
+
+def thread_user_key(thread_id: int) -> StorageKey:
+    """Ключ темы в группе админов: в данных — user_id автора заявки"""
+    return StorageKey(
+        bot_id=bot.id, chat_id=ADMIN_GROUP_ID, user_id=ADMIN_GROUP_ID, thread_id=thread_id, destiny=THREAD_DESTINY
+    )
 
 
 # Приветственное сообщение при /start
@@ -34,14 +60,15 @@ async def user_message(message: Message):
     user_id = message.from_user.id
 
     # Проверяем, есть ли уже тема для пользователя
-    if user_id not in user_threads:
+    thread_id = (await storage.get_data(user_thread_key(user_id))).get('thread_id')
+    if thread_id is None:
         topic = await bot.create_forum_topic(
             chat_id=ADMIN_GROUP_ID,
             name=f"Заявка от {message.from_user.full_name} ({user_id})"
         )
-        user_threads[user_id] = topic.message_thread_id
-
-    thread_id = user_threads[user_id]
+        thread_id = topic.message_thread_id
+        await storage.set_data(user_thread_key(user_id), {'thread_id': thread_id})
+        await storage.set_data(thread_user_key(thread_id), {'user_id': user_id})
 
     # Пересылаем разные типы сообщений
     if message.text:
@@ -62,21 +89,20 @@ async def user_message(message: Message):
 @dp.message(F.chat.id == ADMIN_GROUP_ID)
 async def admin_message(message: Message):
     if message.message_thread_id:
-        for user_id, thread_id in user_threads.items():
-            if thread_id == message.message_thread_id:
-                if message.text:
-                    await bot.send_message(user_id, message.text)
-                elif message.photo:
-                    await bot.send_photo(user_id, message.photo[-1].file_id, caption=message.caption or "")
-                elif message.document:
-                    await bot.send_document(user_id, message.document.file_id, caption=message.caption or "")
-                elif message.video:
-                    await bot.send_video(user_id, message.video.file_id, caption=message.caption or "")
-                elif message.voice:
-                    await bot.send_voice(user_id, message.voice.file_id, caption=message.caption or "")
-                elif message.sticker:
-                    await bot.send_sticker(user_id, message.sticker.file_id)
-                break
+        user_id = (await storage.get_data(thread_user_key(message.message_thread_id))).get('user_id')
+        if user_id is not None:
+            if message.text:
+                await bot.send_message(user_id, message.text)
+            elif message.photo:
+                await bot.send_photo(user_id, message.photo[-1].file_id, caption=message.caption or "")
+            elif message.document:
+                await bot.send_document(user_id, message.document.file_id, caption=message.caption or "")
+            elif message.video:
+                await bot.send_video(user_id, message.video.file_id, caption=message.caption or "")
+            elif message.voice:
+                await bot.send_voice(user_id, message.voice.file_id, caption=message.caption or "")
+            elif message.sticker:
+                await bot.send_sticker(user_id, message.sticker.file_id)
 
 
 async def main():
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import re
+from dataclasses import dataclass
+
+from config import SLOW_QUERY_MS
+from db import connect_db, query_observers
+
+# Сколько разных медленных запросов держим в отчёте
+MAX_TRACKED_STATEMENTS = 200
+
+# EXPLAIN QUERY PLAN имеет смысл только для выборок и изменений данных
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_NAMED_RE = re.compile(r"[:@$][A-Za-z_]\w*")
+_IN_LIST_RE = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_sql(sql: str) -> str:
+    """Приводит запрос к шаблону: литералы и параметры → ?, списки IN (?, ?, ...) → IN (...)"""
+    sql = _STRING_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _NAMED_RE.sub("?", sql)
+    sql = _IN_LIST_RE.sub("IN (...)", sql)
+    return _SPACE_RE.sub(" ", sql).strip()
+
+
+def _is_many(parameters) -> bool:
+    """Параметры executemany: список строк параметров"""
+    return isinstance(parameters, list) and bool(parameters) and isinstance(parameters[0], (list, tuple, dict))
+
+
+def parameters_shape(parameters) -> str:
+    """Форма параметров без значений: типы позиционных или имена именованных"""
+    if parameters is None:
+        return "-"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + "}"
+    if _is_many(parameters):
+        return f"{len(parameters)} × {parameters_shape(parameters[0])}"
+    if isinstance(parameters, (list, tuple)):
+        return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+    # executemany с генератором: строки уже прочитаны
+    return type(parameters).__name__
+
+
+@dataclass
+class SlowStatement:
+    sql: str
+    parameters: str
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    plan: str = None
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class SlowQueryLog:
+    """Журнал медленных SQL-запросов.
+
+    Наблюдает за всеми запросами через db.query_observers. Запрос дольше порога
+    учитывается в агрегате по нормализованному тексту; для каждого нового шаблона
+    один раз снимается EXPLAIN QUERY PLAN (в отдельной задаче, с теми же параметрами).
+    """
+
+    def __init__(self, threshold_ms: int = SLOW_QUERY_MS):
+        self.threshold = threshold_ms / 1000
+        self._statements = {}
+
+    def observe(self, sql: str, parameters, elapsed: float):
+        if not self.threshold or elapsed < self.threshold or sql.lstrip()[:7].upper() == 'EXPLAIN':
+            return
+        normalized = normalize_sql(sql)
+        statement = self._statements.get(normalized)
+        if statement is None:
+            if len(self._statements) >= MAX_TRACKED_STATEMENTS:
+                # Вытесняем самый лёгкий по суммарному времени
+                lightest = min(self._statements, key=lambda key: self._statements[key].total)
+                del self._statements[lightest]
+            statement = self._statements[normalized] = SlowStatement(normalized, parameters_shape(parameters))
+            self._capture_plan(statement, sql, parameters)
+        statement.count += 1
+        statement.total += elapsed
+        statement.max = max(statement.max, elapsed)
+        logging.warning(
+            f"Медленный SQL ({elapsed * 1000:.0f} мс): {normalized} | параметры: {statement.parameters}"
+        )
+
+    def _capture_plan(self, statement: SlowStatement, sql: str, parameters):
+        keyword = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+        if keyword not in _EXPLAINABLE or not isinstance(parameters, (dict, list, tuple, type(None))):
+            return
+        if _is_many(parameters):
+            parameters = parameters[0]
+        try:
+            asyncio.get_running_loop().create_task(self._explain(statement, sql, parameters), name="slow_query_explain")
+        except RuntimeError:
+            pass
+
+    async def _explain(self, statement: SlowStatement, sql: str, parameters):
+        try:
+            async with connect_db() as conn:
+                cursor = await conn.execute(f"EXPLAIN QUERY PLAN {sql}", parameters or ())
+                rows = await cursor.fetchall()
+        except Exception as e:
+            statement.plan = f"не удалось получить план: {e}"
+            return
+        statement.plan = format_plan(rows)
+        if statement.plan:
+            logging.warning(f"План медленного запроса {statement.sql}:\n{statement.plan}")
+
+    def top(self, limit: int = 10, order_by: str = 'total') -> list:
+        """Самые тяжёлые запросы (по суммарному времени, максимуму или числу)"""
+        return sorted(self._statements.values(), key=lambda item: getattr(item, order_by), reverse=True)[:limit]
+
+    def reset(self):
+        self._statements.clear()
+
+
+def format_plan(rows) -> str:
+    """Дерево EXPLAIN QUERY PLAN: строки (id, parent, notused, detail)"""
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return "\n".join(lines)
+
+
+slow_query_log = SlowQueryLog()
+query_observers.append(slow_query_log.observe)
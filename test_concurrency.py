@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Стресс-тест блокировок пользователя: 100 параллельных изменений подписки одного пользователя
+"""
+
+import asyncio
+import time
+import aiosqlite
+from datetime import datetime, timedelta
+import database
+from database import (
+    init_db,
+    add_bot_user,
+    add_payment,
+    extend_user_subscription,
+)
+from locks import user_locks
+from config import DB_PATH
+
+TEST_USER_ID = 999100
+OTHER_USER_ID = 999101
+OPERATIONS = 100
+
+
+class ConcurrencyTester:
+    def __init__(self):
+        self.panel_calls = 0
+        self._original_extend_vpn_config = database.extend_vpn_config
+
+    async def fake_extend_vpn_config(self, user_id: int, days: int) -> bool:
+        """Имитация запроса к панели VPN (с задержкой, чтобы операции перекрывались)"""
+        self.panel_calls += 1
+        await asyncio.sleep(0.01)
+        return True
+
+    async def setup_test_user(self, user_id: int, expiry: datetime):
+        """Создает пользователя с заданной датой окончания подписки"""
+        await add_bot_user(user_id=user_id, first_name=f"Test{user_id}")
+        async with aiosqlite.connect(DB_PATH) as conn:
+            await conn.execute(
+                "INSERT OR REPLACE INTO users (user_id, subscribed, payment_date, expiry_date, config, last_update) VALUES (?, 1, ?, ?, ?, ?)",
+                (user_id, expiry.strftime('%d.%m.%Y %H:%M'), expiry.strftime('%d.%m.%Y %H:%M'), 'test-config', expiry.strftime('%d.%m.%Y %H:%M'))
+            )
+            await conn.commit()
+
+    async def get_expiry(self, user_id: int) -> datetime:
+        async with aiosqlite.connect(DB_PATH) as conn:
+            cursor = await conn.execute("SELECT expiry_date FROM users WHERE user_id = ?", (user_id,))
+            row = await cursor.fetchone()
+        return datetime.strptime(row[0], '%d.%m.%Y %H:%M')
+
+    async def test_single_user_serialization(self) -> bool:
+        """100 параллельных операций (продление на 1 день и оплата 7 дней) для одного пользователя"""
+        print(f"\n🔒 {OPERATIONS} параллельных операций для пользователя {TEST_USER_ID}...")
+
+        start_expiry = datetime.now().replace(second=0, microsecond=0) + timedelta(days=1)
+        await self.setup_test_user(TEST_USER_ID, start_expiry)
+
+        extends = OPERATIONS // 2
+        payments = OPERATIONS - extends
+        operations = [extend_user_subscription(TEST_USER_ID, 1) for _ in range(extends)]
+        operations += [add_payment(TEST_USER_ID, 0, payment_method='test') for _ in range(payments)]
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*operations)
+        elapsed = time.perf_counter() - started
+
+        expected = start_expiry + timedelta(days=extends * 1 + payments * 7)
+        actual = await self.get_expiry(TEST_USER_ID)
+
+        print(f"   - Успешных операций: {sum(1 for r in results if r)}/{OPERATIONS}")
+        print(f"   - Вызовов панели: {self.panel_calls}")
+        print(f"   - Ожидаемая дата окончания: {expected.strftime('%d.%m.%Y %H:%M')}")
+        print(f"   - Фактическая дата окончания: {actual.strftime('%d.%m.%Y %H:%M')}")
+        print(f"   - Время: {elapsed:.2f} с")
+
+        ok = all(results) and actual == expected
+        print("✅ Дата окончания посчитана верно" if ok else "❌ Потеряны обновления")
+        return ok
+
+    async def test_users_stay_parallel(self) -> bool:
+        """Операции разных пользователей не ждут друг друга"""
+        print("\n🔀 Проверка параллельности для разных пользователей...")
+
+        start_expiry = datetime.now().replace(second=0, microsecond=0) + timedelta(days=1)
+        await self.setup_test_user(OTHER_USER_ID, start_expiry)
+
+        async with user_locks.get(TEST_USER_ID):
+            # Пока первый пользователь заблокирован, второй должен обслуживаться
+            try:
+                result = await asyncio.wait_for(extend_user_subscription(OTHER_USER_ID, 1), timeout=5)
+            except asyncio.TimeoutError:
+                result = False
+
+        print("✅ Разные пользователи обрабатываются параллельно" if result else "❌ Операция другого пользователя заблокирована")
+        return bool(result)
+
+    async def cleanup_test_data(self):
+        """Очищает тестовые данные"""
+        async with aiosqlite.connect(DB_PATH) as conn:
+            for user_id in (TEST_USER_ID, OTHER_USER_ID):
+                await conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+                await conn.execute("DELETE FROM payments WHERE user_id = ?", (user_id,))
+                await conn.execute("DELETE FROM bot_users WHERE user_id = ?", (user_id,))
+            await conn.commit()
+        print(f"\n🧹 Тестовые данные очищены, блокировок в реестре: {len(user_locks)}")
+
+    async def run_all_tests(self) -> bool:
+        """Запускает все тесты"""
+        print("🚀 Стресс-тест блокировок пользователя")
+        print("=" * 50)
+
+        await init_db()
+        database.extend_vpn_config = self.fake_extend_vpn_config
+        try:
+            ok = await self.test_single_user_serialization()
+            ok = await self.test_users_stay_parallel() and ok
+        finally:
+            database.extend_vpn_config = self._original_extend_vpn_config
+            await self.cleanup_test_data()
+        return ok
+
+
+if __name__ == "__main__":
+    try:
+        passed = asyncio.run(ConcurrencyTester().run_all_tests())
+        raise SystemExit(0 if passed else 1)
+    except KeyboardInterrupt:
+        print("\n👋 Тестирование прервано пользователем")
@@ -0,0 +1,107 @@
+import logging
+import math
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message
+
+from config import THROTTLE_LIMITS
+from metrics import registry
+
+throttled = registry.counter(
+    'bot_throttled_total', "Нажатия, отклонённые ограничением частоты, по классу хендлера", ('handler_class',)
+)
+
+# Пустые и давно не тронутые корзины выбрасываются раз в столько проверок
+PRUNE_EVERY = 1000
+
+
+def parse_limits(spec: str) -> dict:
+    """'payment=3/60,vpn=3/30' → {'payment': (3, 60.0), 'vpn': (3, 30.0)}: не больше N нажатий за T секунд"""
+    limits = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        name, limit = item.split('=', 1)
+        count, seconds = limit.split('/')
+        limits[name.strip()] = (int(count), float(seconds))
+    return limits
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничение частоты по (пользователь, класс хендлера) алгоритмом token bucket.
+
+    Класс задаётся флагом хендлера: @dp.callback_query(..., flags={'throttle': 'payment'}).
+    Корзина вмещает N токенов и пополняется со скоростью N/T в секунду, так что
+    короткая серия из N нажатий проходит, а дальше — не чаще одного за T/N секунд.
+    Middleware внутренний: работает после фильтров и до хендлера, поэтому лишние
+    нажатия не доходят ни до БД, ни до внешних API. На callback отвечаем коротким
+    уведомлением (иначе у пользователя крутятся часики), на сообщение — один раз
+    за серию превышений.
+    """
+
+    def __init__(self, limits: dict):
+        self.limits = limits
+        self._buckets = {}  # (user_id, класс) → [токены, время обновления, предупреждён]
+        self._checks = 0
+
+    def _take(self, key: tuple, capacity: int, period: float) -> float:
+        """Берёт токен; 0 — можно, иначе через сколько секунд появится следующий"""
+        now = time.monotonic()
+        rate = capacity / period
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [capacity, now, False]
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            bucket[2] = False
+            return 0.0
+        bucket[0] = tokens
+        return (1 - tokens) / rate
+
+    def _prune(self):
+        now = time.monotonic()
+        for key, (tokens, updated, _) in list(self._buckets.items()):
+            _, period = self.limits[key[1]]
+            if now - updated >= period:
+                # Корзина уже полная — то же самое, что её отсутствие
+                del self._buckets[key]
+
+    async def __call__(self, handler, event, data):
+        handler_class = get_flag(data, 'throttle')
+        user = data.get('event_from_user')
+        if handler_class not in self.limits or user is None:
+            return await handler(event, data)
+
+        self._checks += 1
+        if self._checks >= PRUNE_EVERY:
+            self._checks = 0
+            self._prune()
+
+        key = (user.id, handler_class)
+        retry_after = self._take(key, *self.limits[handler_class])
+        if not retry_after:
+            return await handler(event, data)
+
+        throttled.inc(handler_class)
+        text = f"⏳ Слишком часто. Попробуйте через {math.ceil(retry_after)} с"
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(text)
+            elif isinstance(event, Message) and not self._buckets[key][2]:
+                self._buckets[key][2] = True
+                await event.answer(text)
+        except Exception as e:
+            logging.debug(f"Не удалось ответить на лишнее нажатие: {e}")
+        return None
+
+
+def setup_throttling(dp, limits: dict = None):
+    """Подключает ограничение частоты к сообщениям и callback-запросам"""
+    middleware = ThrottlingMiddleware(parse_limits(THROTTLE_LIMITS) if limits is None else limits)
+    dp.message.middleware(middleware)
+    dp.callback_query.middleware(middleware)
+    return middleware
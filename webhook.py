@@ -0,0 +1,188 @@
+import asyncio
+import hmac
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+from collections import OrderedDict
+
+from aiogram.types import Update
+from aiohttp import web
+
+from db import connect_db
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Сколько последних update_id помнит процесс для отсева повторов
+DEDUP_CACHE_SIZE = 10000
+# Сколько держим update_id в общей таблице (для нескольких процессов); повторы Telegram приходят в пределах минут
+DEDUP_TTL = 60 * 60
+DEDUP_BATCH_SIZE = 500
+
+
+class UpdateDeduplicator:
+    """Отсев повторно доставленных апдейтов по update_id.
+
+    Внутри процесса — LRU последних id. Если процессов несколько (SO_REUSEPORT),
+    повтор может прийти в другой процесс, поэтому id дополнительно фиксируются
+    в таблице webhook_updates. Одновременные апдейты процесса записываются одной
+    транзакцией (INSERT OR IGNORE ... RETURNING) через одно соединение, чтобы
+    процессы не толкались за блокировку записи на каждом апдейте.
+    """
+
+    def __init__(self, shared: bool = False, size: int = DEDUP_CACHE_SIZE):
+        self.shared = shared
+        self.size = size
+        self._seen = OrderedDict()
+        self._waiting = {}
+        self._flush_task = None
+        self._conn = None
+
+    async def is_new(self, update_id: int) -> bool:
+        if update_id in self._seen:
+            return False
+        self._seen[update_id] = None
+        if len(self._seen) > self.size:
+            self._seen.popitem(last=False)
+        if not self.shared:
+            return True
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[update_id] = future
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush(), name="webhook_dedup_flush")
+        return await future
+
+    async def _flush(self):
+        while self._waiting:
+            batch = dict(itertools.islice(self._waiting.items(), DEDUP_BATCH_SIZE))
+            for update_id in batch:
+                del self._waiting[update_id]
+            try:
+                inserted = await self._insert(list(batch))
+            except Exception as e:
+                # Лучше обработать возможный повтор, чем потерять апдейт
+                logging.error(f"Ошибка записи update_id для отсева повторов: {e}")
+                inserted = set(batch)
+            for update_id, future in batch.items():
+                if not future.done():
+                    future.set_result(update_id in inserted)
+
+    async def _insert(self, update_ids: list) -> set:
+        if self._conn is None:
+            self._conn = await connect_db()
+        values = ", ".join("(?, strftime('%s', 'now'))" for _ in update_ids)
+        cursor = await self._conn.execute(
+            f"INSERT OR IGNORE INTO webhook_updates (update_id, received_at) VALUES {values} RETURNING update_id",
+            update_ids
+        )
+        inserted = {row[0] for row in await cursor.fetchall()}
+        await self._conn.commit()
+        return inserted
+
+    async def close(self):
+        if self._flush_task:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+async def cleanup_webhook_updates() -> int:
+    """Удаляет из webhook_updates id старше DEDUP_TTL (периодическая задача планировщика)"""
+    async with connect_db() as conn:
+        cursor = await conn.execute(
+            "DELETE FROM webhook_updates WHERE received_at < strftime('%s', 'now') - ?", (DEDUP_TTL,)
+        )
+        await conn.commit()
+        return cursor.rowcount
+
+
+class WebhookHandler:
+    """Приём апдейтов от Telegram: проверка секрета, отсев повторов, ограничение параллельной обработки.
+
+    Ответ 200 отдаётся сразу после постановки апдейта в обработку. Когда заняты все
+    max_concurrency слотов, запрос ждёт свободного — Telegram сам притормаживает отправку.
+    """
+
+    def __init__(self, dp, bot, secret: str, max_concurrency: int, shared_dedup: bool = False):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.dedup = UpdateDeduplicator(shared=shared_dedup)
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._tasks = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logging.warning(f"Некорректный апдейт в webhook: {e}")
+            return web.Response(status=400)
+
+        if not await self.dedup.is_new(update.update_id):
+            logging.info(f"Повторный апдейт id={update.update_id} пропущен")
+            return web.Response()
+
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update), name=f"webhook_update_{update.update_id}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            logging.error(f"Ошибка обработки апдейта id={update.update_id}: {e}", exc_info=True)
+        finally:
+            self._slots.release()
+
+    async def drain(self, timeout: float = 10.0):
+        """Ждёт обработки уже принятых апдейтов"""
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+
+async def serve_webhook(handler: WebhookHandler, host: str, port: int, path: str, reuse_port: bool = False):
+    """Поднимает aiohttp-сервер webhook и ждёт SIGINT/SIGTERM"""
+    app = web.Application()
+    app.router.add_post(path, handler.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port, reuse_port=reuse_port).start()
+    logging.info(f"Webhook слушает {host}:{port}{path}")
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    try:
+        await stopped.wait()
+    finally:
+        # Сначала перестаём принимать новые апдейты, потом дообрабатываем принятые
+        await runner.cleanup()
+        await handler.drain()
+        await handler.dedup.close()
+
+
+def run_workers(target, count: int):
+    """Запускает count процессов target(index) на одном порту (SO_REUSEPORT) и ждёт их завершения"""
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=target, args=(index,), name=f"webhook-worker-{index}") for index in range(count)]
+    for index, worker in enumerate(workers):
+        # Номер процесса нужен уже при импорте (config.BOT_WORKER: файл лога, порт метрик)
+        os.environ['BOT_WORKER'] = str(index)
+        worker.start()
+    os.environ.pop('BOT_WORKER', None)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()